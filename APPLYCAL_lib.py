@@ -0,0 +1,212 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Native apply of gain tables (alternative to applycal calwt=False)
+#
+# - reads the gain tables (T or G Jones) once and interpolates
+#   (nearest or linear in amplitude and phase) the per antenna
+#   gains of the entire chain onto the time grid of the MS
+#
+# - streams the visibilities per spw in row chunks into a reused
+#   buffer (getcolnp) and corrects them in place in a thread pool
+#
+#      CORRECTED_DATA = DATA / (g_i g_j^*)
+#
+# - data without a valid solution are flagged (applymode calflag)
+#
+# - the memory is bounded by chunk_mb per chunk
+#
+import os
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+#
+# LIBS
+#
+
+global chunk_mb, nthreads
+
+chunk_mb = 256
+nthreads = min(8,os.cpu_count())
+
+
+def read_gaintable(caltable):
+    """
+    solutions of a gain table
+    """
+    from casacore.tables import table
+
+    with table(caltable,ack=False) as cal:
+        sol = {}
+        sol['time']   = cal.getcol('TIME')
+        sol['spw']    = cal.getcol('SPECTRAL_WINDOW_ID')
+        sol['ant']    = cal.getcol('ANTENNA1')
+        sol['gain']   = cal.getcol('CPARAM')
+        sol['flag']   = cal.getcol('FLAG')
+        sol['viscal'] = cal.getkeyword('VisCal') if 'VisCal' in cal.getkeywords() else 'G Jones'
+
+    return sol
+
+
+def interpolate_gains(t_sol,g_sol,f_sol,t_out,mode='linear'):
+    """
+    interpolate the solutions of one antenna and spw
+    g_sol [nsol,npar,nchan], returns gains and flags [ntime,npar,nchan]
+    """
+    ntime, npar, nchan = len(t_out), g_sol.shape[1], g_sol.shape[2]
+    gains = np.ones((ntime,npar,nchan),dtype=complex)
+    flags = np.zeros((ntime,npar,nchan),dtype=bool)
+
+    for p in range(npar):
+        for c in range(nchan):
+            valid = ~f_sol[:,p,c]
+            if valid.sum() == 0:
+                flags[:,p,c] = True
+                continue
+
+            t, g = t_sol[valid], g_sol[valid,p,c]
+            if mode == 'nearest' or valid.sum() == 1:
+                pos   = np.searchsorted(t,t_out)
+                left  = np.clip(pos-1,0,len(t)-1)
+                right = np.clip(pos,0,len(t)-1)
+                gains[:,p,c] = g[np.where(np.abs(t_out - t[left]) <= np.abs(t[right] - t_out),left,right)]
+            else:
+                amp   = np.interp(t_out,t,np.abs(g))
+                phase = np.interp(t_out,t,np.unwrap(np.angle(g)))
+                gains[:,p,c] = amp * np.exp(1j * phase)
+
+    flags |= gains == 0
+
+    return gains, flags
+
+
+def chain_gains(gaintable,interp,times,nant,spw):
+    """
+    product of the interpolated gains of all tables of one spw
+    returns gains [ntime,nant,2,nchan] and flags [ntime,nant]
+    """
+    gains = np.ones((len(times),nant,2,1),dtype=complex)
+    flags = np.zeros((len(times),nant),dtype=bool)
+
+    for caltable,mode in zip(gaintable,interp):
+        sol  = read_gaintable(caltable)
+        mode = 'nearest' if str(mode).split(',')[0].replace('PD','') == 'nearest' else 'linear'
+
+        in_spw = sol['spw'] == spw
+        if in_spw.sum() == 0:
+            flags[:] = True
+            continue
+
+        nchan = sol['gain'].shape[2]
+        if nchan > gains.shape[3]:
+            gains = np.repeat(gains,nchan,axis=3)
+
+        for a in range(nant):
+            sel = in_spw & (sol['ant'] == a)
+            if sel.sum() == 0:
+                flags[:,a] = True
+                continue
+            order = np.argsort(sol['time'][sel])
+            g, f  = interpolate_gains(sol['time'][sel][order],sol['gain'][sel][order],sol['flag'][sel][order],times,mode)
+            # T Jones has one parameter for both receptors
+            if g.shape[1] == 1:
+                g = np.repeat(g,2,axis=1)
+            gains[:,a] *= g
+            flags[:,a] |= f.any(axis=(1,2))
+
+    return gains, flags
+
+
+def correct_chunk(data,flag,gains,gflags,tidx,a1,a2,receptors):
+    """
+    correct the visibilities in place
+    data [nrow,nchan,ncorr], gains [ntime,nant,2,ngchan]
+    """
+    gi  = gains[tidx,a1][:,receptors[:,0],:]
+    gj  = gains[tidx,a2][:,receptors[:,1],:]
+    fac = np.transpose(gi * np.conj(gj),(0,2,1))
+
+    bad = gflags[tidx,a1] | gflags[tidx,a2]
+    fac[bad] = 1.
+
+    np.divide(data,fac.astype(data.dtype),out=data)
+    flag[bad] = True
+
+    return bad.sum()
+
+
+def apply_gaintables(msfile,gaintable,interp,outcolumn='CORRECTED_DATA',memory_mb=None,threads=None):
+    """
+    apply the chain of gain tables to DATA and write outcolumn
+    returns the number of newly flagged rows
+    """
+    from casacore.tables import table, maketabdesc, makecoldesc
+
+    memory_mb = memory_mb if memory_mb != None else chunk_mb
+    threads   = threads if threads != None else nthreads
+
+    with table(msfile+'/ANTENNA',ack=False) as ant:
+        nant = ant.nrows()
+    with table(msfile+'/DATA_DESCRIPTION',ack=False) as dd:
+        ddid_spw = dd.getcol('SPECTRAL_WINDOW_ID')
+        ddid_pol = dd.getcol('POLARIZATION_ID')
+    with table(msfile+'/POLARIZATION',ack=False) as pol:
+        corr_product = [pol.getcell('CORR_PRODUCT',p) for p in range(pol.nrows())]
+
+    nflagged = 0
+    with table(msfile,readonly=False,ack=False) as t:
+        if outcolumn not in t.colnames():
+            t.addcols(maketabdesc(makecoldesc(outcolumn,t.getcoldesc('DATA'))))
+
+        ddids = t.getcol('DATA_DESC_ID')
+        times = t.getcol('TIME')
+        ant1  = t.getcol('ANTENNA1')
+        ant2  = t.getcol('ANTENNA2')
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for ddid in np.unique(ddids):
+                rows      = np.flatnonzero(ddids == ddid)
+                spw       = int(ddid_spw[ddid])
+                receptors = np.array(corr_product[ddid_pol[ddid]]).reshape(-1,2)
+                utimes, tidx_all = np.unique(times[rows],return_inverse=True)
+
+                gains, gflags = chain_gains(gaintable,interp,utimes,nant,spw)
+
+                shape     = t.getcell('DATA',int(rows[0])).shape
+                row_bytes = np.prod(shape) * 8 * 2
+                nrows     = int(max(1,memory_mb * 1024**2 // row_bytes))
+
+                # buffers reused for all chunks
+                #
+                data_buf = np.empty((min(nrows,len(rows)),)+shape,dtype=np.complex64)
+                flag_buf = np.empty((min(nrows,len(rows)),)+shape,dtype=bool)
+
+                for start in range(0,len(rows),nrows):
+                    chunk = rows[start:start+nrows]
+                    sel   = t.selectrows(chunk)
+                    data  = data_buf[:len(chunk)]
+                    flag  = flag_buf[:len(chunk)]
+                    sel.getcolnp('DATA',data)
+                    sel.getcolnp('FLAG',flag)
+
+                    # correct sub chunks in the threads
+                    #
+                    bounds = np.linspace(0,len(chunk),threads+1).astype(int)
+                    jobs   = [pool.submit(correct_chunk,data[b0:b1],flag[b0:b1],gains,gflags,tidx_all[start+b0:start+b1],\
+                                              ant1[chunk[b0:b1]],ant2[chunk[b0:b1]],receptors) for b0,b1 in zip(bounds[:-1],bounds[1:]) if b1 > b0]
+                    newflags = sum([j.result() for j in jobs])
+
+                    sel.putcol(outcolumn,data)
+                    if newflags > 0:
+                        sel.putcol('FLAG',flag)
+                    nflagged += newflags
+
+    return nflagged
@@ -14,10 +14,10 @@ import shutil
 import glob
 import json
 
-import casatasks
 import numpy as np
 
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 #
 # singularity exec --bind ${PWD}:/data CONTAINER.simg python3 /data/APPLY_CALIB_SPLIT.py
@@ -25,7 +25,7 @@ from collections import OrderedDict
 
 # Pupose is to splitt out a file
 
-def apply_calibration(MSFILE,homedir,gaintable=[],interp=[]):
+def apply_calibration(MSFILE,homedir,gaintable=[],interp=[],doapplynative=False,nthreads=None):
     """
     Apply the calibration and split the data
     """
@@ -36,10 +36,15 @@ def apply_calibration(MSFILE,homedir,gaintable=[],interp=[]):
 
     if len(gaintable) > 0:
         # apply all the calibration
-        casatasks.applycal(vis=msfile,gaintable=gaintable,interp=interp,parang=False, calwt=False, flagbackup=False)
+        if doapplynative:
+            import APPLYCAL_lib as APPLYCAL
+            APPLYCAL.apply_gaintables(msfile,gaintable,interp,threads=nthreads)
+        else:
+            import casatasks
+            casatasks.applycal(vis=msfile,gaintable=gaintable,interp=interp,parang=False, calwt=False, flagbackup=False)
 
 
-def split_data(MSFILE,MSOUTPUT,homedir,fieldid,spw):
+def split_data(MSFILE,MSOUTPUT,homedir,fieldid,spw,chanbin=1,timebin='0s'):
     """
     split the data
     """
@@ -47,8 +52,122 @@ def split_data(MSFILE,MSOUTPUT,homedir,fieldid,spw):
     msfile    = MSFILE
     outmsfile = homedir + MSOUTPUT
 
+    import casatasks
+
     # generates a new dataset with corrected DATA column 
-    casatasks.split(vis=msfile,outputvis=outmsfile,keepmms=True,field=fieldid,spw=spw,scan="",antenna="",correlation="",timerange="",intent="",array="",uvrange="",observation="",feed="",datacolumn="corrected",keepflags=True,width=1,timebin="0s",combine="")
+    casatasks.split(vis=msfile,outputvis=outmsfile,keepmms=True,field=fieldid,spw=spw,scan="",antenna="",correlation="",timerange="",intent="",array="",uvrange="",observation="",feed="",datacolumn="corrected",keepflags=True,width=chanbin,timebin=timebin,combine="")
+
+    return homedir, MSOUTPUT
+
+
+def write_callib(callibfile,gaintable,interp):
+    """
+    write a calibration library file of the gain tables
+    (one line per table, applied to all fields and spws)
+
+    the CASA interp 'time,freq' (e.g. 'linear,linearflag') is
+    split into tinterp and finterp
+    """
+    with open(callibfile,'w') as fout:
+        for tab,inp in zip(gaintable,interp):
+            interp_parts = [i.strip() for i in str(inp).split(',')]
+            line         = "caltable='"+tab+"' calwt=False"
+            if len(interp_parts[0]) > 0:
+                line    += " tinterp='"+interp_parts[0]+"'"
+            if len(interp_parts) > 1 and len(interp_parts[1]) > 0:
+                line    += " finterp='"+interp_parts[1]+"'"
+            print(line,file=fout)
+
+    return callibfile
+
+
+def apply_and_split(MSFILE,MSOUTPUT,homedir,fieldid,spw,gaintable=[],interp=[],chanbin=1,timebin='0s'):
+    """
+    apply the calibration on the fly while splitting the data
+    (single pass, the original MS is not changed)
+    """
+
+    # https://casadocs.readthedocs.io/en/stable/api/tt/casatasks.manipulation.mstransform.html
+
+    import casatasks
+
+    msfile     = MSFILE
+    outmsfile  = homedir + MSOUTPUT
+    callibfile = write_callib(outmsfile.rstrip('/').replace('.ms','')+'_callib.txt',gaintable,interp)
+
+    casatasks.mstransform(vis=msfile,outputvis=outmsfile,createmms=False,field=str(fieldid),spw=spw,datacolumn="corrected",keepflags=True,\
+                              docallib=True,callib=callibfile,\
+                              chanaverage=chanbin > 1,chanbin=chanbin,timeaverage=timebin != '0s',timebin=timebin)
+
+    return homedir, MSOUTPUT
+
+
+def expand_spw_selection(spw,nspw):
+    """
+    expand a spw selection (e.g. '0~3,5:100~200') into
+    a list of single spw selections
+    """
+    if len(spw.strip()) == 0:
+        return [str(s) for s in range(nspw)]
+
+    spw_list = []
+    for sel in spw.split(','):
+        sel = sel.strip()
+        if len(sel) == 0:
+            continue
+        spwid, chansel = (sel.split(':',1) + [''])[:2]
+        if '~' in spwid:
+            spw_range = range(int(spwid.split('~')[0]),int(spwid.split('~')[1])+1)
+        else:
+            spw_range = [int(spwid)]
+        for s in spw_range:
+            spw_list.append(str(s) + (':'+chansel if len(chansel) > 0 else ''))
+
+    return spw_list
+
+
+def split_worker(para):
+    """
+    split one group of spws (runs in its own process)
+    """
+    MSFILE,MSOUTPUT,homedir,fieldid,spw,gaintable,interp,chanbin,timebin,doonepass = para
+
+    if doonepass:
+        apply_and_split(MSFILE,MSOUTPUT,homedir,fieldid,spw,gaintable,interp,chanbin,timebin)
+    else:
+        split_data(MSFILE,MSOUTPUT,homedir,fieldid,spw,chanbin,timebin)
+
+    return homedir + MSOUTPUT
+
+
+def parallel_split(MSFILE,MSOUTPUT,homedir,fieldid,spw,nproc,gaintable=[],interp=[],chanbin=1,timebin='0s',doonepass=False):
+    """
+    split the spws in parallel (one process per group of spws)
+    and virtually concatenate the parts into one dataset
+    """
+    import MSINFO_lib as MSINFO
+
+    nspw     = len(MSINFO.get_ms_metadata(MSFILE,'')['spw'])
+    spw_list = expand_spw_selection(spw,nspw)
+    ngroups  = min(nproc,len(spw_list))
+    groups   = [g for g in np.array_split(np.array(spw_list,dtype=object),ngroups) if len(g) > 0]
+
+    jobs = []
+    for g in groups:
+        part_name = MSOUTPUT.rstrip('/').replace('.ms','')+'_SPW'+str(g[0]).split(':')[0]+'-'+str(g[-1]).split(':')[0]+'.ms'
+        jobs.append([MSFILE,part_name,homedir,fieldid,','.join(g),gaintable,interp,chanbin,timebin,doonepass])
+        print('\n- split part ',part_name,' spw ',','.join(g))
+
+    # CASA is not fork safe
+    #
+    import multiprocessing
+    with ProcessPoolExecutor(max_workers=ngroups,mp_context=multiprocessing.get_context('spawn')) as pool:
+        parts = list(pool.map(split_worker,jobs))
+
+    # one dataset for wsclean and CASA (the parts are moved into the output)
+    #
+    import casatasks
+    casatasks.virtualconcat(vis=parts,concatvis=homedir+MSOUTPUT,copypointing=True,keepcopy=False)
 
     return homedir, MSOUTPUT
 
@@ -61,6 +180,8 @@ def find_CASA_logfile(checkdir='HOME',homedir=''):
 
     user_home_dir  = os.environ[checkdir]
     casa_log_files = sorted(glob.glob(user_home_dir+'/casa*log'), key=os.path.getmtime)
+    if len(casa_log_files) == 0:
+        return ''
     latest_logfile = casa_log_files[-1]
 
     return latest_logfile
@@ -99,8 +220,23 @@ def main():
     parser.add_option('--DOSPLIT', dest='dosplit', action='store_true',default=False,
                       help='Splitt the data into a new file [default False].')
 
+    parser.add_option('--NATIVEAPPLY', dest='doapplynative', action='store_true',default=False,
+                      help='Apply the calibration tables with the native multi-threaded engine (APPLYCAL_lib) [default False use applycal].')
+
+    parser.add_option('--ONEPASS', dest='doonepass', action='store_true',default=False,
+                      help='With --DOAPPLY and --DOSPLIT apply the calibration on the fly while splitting, the original MS is not changed [default False].')
+
+    parser.add_option('--CHANBIN', dest='chanbin', default=1, type=int,
+                      help='Average the channels while splitting [default 1 no averaging].')
+
+    parser.add_option('--TIMEBIN', dest='timebin', default='0s', type=str,
+                      help='Average in time while splitting e.g. 16s [default 0s no averaging].')
+
+    parser.add_option('--NPROC', dest='nproc', default=1, type=int,
+                      help='Split the spectral windows in parallel processes and virtually concatenate the output [default 1].')
+
     parser.add_option('--NOFGINFO', dest='fginfo', action='store_false',default=True,
-                      help='Provide no CASA FG information [default runs casa, see casa log file].')
+                      help='Provide no FG information [default flagged fractions per antenna, baseline, spw, channel, scan and correlation in MS_FLAGSTATS.json/.npz].')
 
     parser.add_option('--SPWD', dest='spwd', default='', type=str,
                       help='Choose which spectral windows to split [default use all].')
@@ -129,6 +265,11 @@ def main():
     calinterp           = opts.calinterp
     doapply             = opts.doapply
     dosplit             = opts.dosplit
+    doonepass           = opts.doonepass and doapply and dosplit
+    chanbin             = opts.chanbin
+    timebin             = opts.timebin
+    nproc               = opts.nproc
+    doapplynative       = opts.doapplynative
     fieldid             = opts.fieldid
     fginfo              = opts.fginfo
     spwd                = opts.spwd
@@ -136,6 +277,7 @@ def main():
     MSOUTPUT            = MSFILE.replace('.ms','_split.ms')
 
 
+    gaintable, interp = [], []
     if doapply:
         print('\n=== Apply calibration ===\n')
         if caltab != '[]' and calinterp != '[]': 
@@ -148,17 +290,28 @@ def main():
                 print('CASA gaintable input: ',gaintable)
                 print('CASA interp input   : ',interp)
                 #
-                apply_calibration(MSFILE,cwd,gaintable,interp)
+                if not doonepass:
+                    apply_calibration(MSFILE,cwd,gaintable,interp,doapplynative,nproc if nproc > 1 else None)
         else:
             print('Caution --CAL_TAB and --CAL_INTERPOL not defined. ',caltab,calinterp)
+            doonepass = False
 
 
     if dosplit:
         print('\n=== Split Data ===\n')
         if len(spwd) > 0:
             print('\n- SPWD: ',spwd)
-
-        split_homedir, split_MSOUTPUT = split_data(MSFILE,MSOUTPUT,'',fieldid,spwd)
+        if chanbin > 1 or timebin != '0s':
+            print('\n- average channels: ',chanbin,' time: ',timebin)
+
+        if nproc > 1:
+            print('\n- split in ',nproc,' processes')
+            split_homedir, split_MSOUTPUT = parallel_split(MSFILE,MSOUTPUT,'',fieldid,spwd,nproc,gaintable,interp,chanbin,timebin,doonepass)
+        elif doonepass:
+            print('\n- apply the calibration on the fly')
+            split_homedir, split_MSOUTPUT = apply_and_split(MSFILE,MSOUTPUT,'',fieldid,spwd,gaintable,interp,chanbin,timebin)
+        else:
+            split_homedir, split_MSOUTPUT = split_data(MSFILE,MSOUTPUT,'',fieldid,spwd,chanbin,timebin)
         MSFILE = split_MSOUTPUT
         
 
@@ -167,18 +320,22 @@ def main():
 
         # provide info about the total flagging of the dataset
         #
+        import FLAGSTATS_lib as FLAGSTATS
         cwdMSFILE = MSFILE
-        casatasks.flagdata(vis=cwdMSFILE, mode='summary')
-        print('\n- see CASA log file')
+        flagstats = FLAGSTATS.get_flag_statistics(cwdMSFILE,'',max(nproc,4))
+        fractions = FLAGSTATS.save_flag_statistics(flagstats,cwdMSFILE.rstrip('/').replace('.ms','')+'_FLAGSTATS','')
+        FLAGSTATS.print_flag_fractions(fractions)
+        print('\n- see ',cwdMSFILE.rstrip('/').replace('.ms','')+'_FLAGSTATS.json')
 
     # store casa log file to current directory 
     #
     current_casa_log = find_CASA_logfile(checkdir='HOME',homedir='')
-    if len(cwd) > 0:
-        shutil.move(current_casa_log,cwd)   
-    else:
-        cwd  = os.environ['PWD']
-        shutil.move(current_casa_log,cwd)           
+    if len(current_casa_log) > 0:
+        if len(cwd) > 0:
+            shutil.move(current_casa_log,cwd)   
+        else:
+            cwd  = os.environ['PWD']
+            shutil.move(current_casa_log,cwd)           
     #
     # ====================================
 
@@ -0,0 +1,343 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Lifecycle of the image products of the self-calibration
+#
+# - the retention of the products is defined per product type in
+#   the ARTIFACT_RETENTION section of the imaging default file
+#
+#      keep_all  : keep all images
+#      keep_mfs  : keep only the MFS images (delete the channel images)
+#      keep_last : keep only the images of the latest round
+#      delete    : delete all products (incl. the PyBDSF directories
+#                  and logs) and the emptied product directory
+#
+#   rules can be combined e.g. ["keep_mfs","keep_last"]
+#
+# - products are moved with renames (same filesystem) and
+#   deleted in a background thread
+#
+# - a disk quota (and minimum free space) is enforced before each
+#   imaging step, by waiting for pending deletions and pruning
+#   the images of the oldest rounds
+#
+import os
+import re
+import glob
+import time
+import queue
+import shutil
+import threading
+
+
+#
+# LIBS
+#
+
+global retention_rules, disk_quota_bytes, min_free_bytes, artifact_registry, artifact_stats
+global deletion_queue, deletion_thread, trash_dirs
+
+# the managed product types
+#
+retention_policies = ['keep_all','keep_mfs','keep_last','delete']
+
+retention_rules    = {'mask_images':['delete'],'model_images':['keep_all'],'final_images':['keep_all']}
+
+disk_quota_bytes   = 0
+min_free_bytes     = 0
+
+artifact_registry  = []
+artifact_stats     = {'moved_files':0,'deleted_bytes':0,'pruned_bytes':0,'throttle_s':0.,'quota_exceeded':None}
+
+deletion_queue     = queue.Queue()
+deletion_thread    = None
+
+trash_dir          = '.2GC_TRASH'
+trash_dirs         = set()
+
+channel_image      = re.compile(r'-\d{4}-[^/]*\.fits$')
+
+
+def validate_retention_rules(artifact_input):
+    """
+    check the ARTIFACT_RETENTION input
+    returns a list of errors
+    """
+    errors = []
+    for k in artifact_input.keys():
+        if k in ['disk_quota_gb','min_free_gb']:
+            if not isinstance(artifact_input[k],(int,float)) or artifact_input[k] < 0:
+                errors.append('ARTIFACT_RETENTION '+k+' needs to be a positive number')
+        elif k in retention_rules:
+            rules = artifact_input[k] if isinstance(artifact_input[k],list) else [artifact_input[k]]
+            for r in rules:
+                if r not in retention_policies:
+                    errors.append('ARTIFACT_RETENTION '+k+' unknown rule '+str(r)+' use '+str(retention_policies))
+        else:
+            errors.append('ARTIFACT_RETENTION unknown product type '+k+' use '+str(list(retention_rules.keys())))
+
+    return errors
+
+
+def set_retention_rules(artifact_input):
+    """
+    set the retention rules and the disk quota
+    """
+    global disk_quota_bytes, min_free_bytes
+
+    for k in artifact_input.keys():
+        if k == 'disk_quota_gb':
+            disk_quota_bytes = artifact_input[k] * 1024**3
+        elif k == 'min_free_gb':
+            min_free_bytes   = artifact_input[k] * 1024**3
+        else:
+            retention_rules[k] = artifact_input[k] if isinstance(artifact_input[k],list) else [artifact_input[k]]
+
+
+def path_size(path):
+    """
+    size of a file or directory in bytes
+    """
+    if os.path.isfile(path) or os.path.islink(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root,f))
+            except OSError:
+                pass
+    return size
+
+
+def deletion_worker():
+    """
+    background deletion of the queued files
+    """
+    while True:
+        path = deletion_queue.get()
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path,ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+        except OSError as err:
+            print('Could not delete ',path,' ',err)
+        deletion_queue.task_done()
+
+
+def delete(path,count=True):
+    """
+    delete a file or directory in the background
+    the path is renamed into the trash first so that
+    the name is free immediately
+    """
+    global deletion_thread
+
+    path = path.rstrip('/')
+    if not os.path.lexists(path):
+        return 0
+
+    nbytes = path_size(path) if count else 0
+
+    trash = os.path.join(os.path.dirname(os.path.abspath(path)),trash_dir)
+    try:
+        os.makedirs(trash,exist_ok=True)
+        trash_dirs.add(trash)
+        trash_path = os.path.join(trash,os.path.basename(path.rstrip('/'))+'_'+str(time.time_ns()))
+        os.rename(path,trash_path)
+        path = trash_path
+    except OSError:
+        pass
+
+    if deletion_thread == None:
+        deletion_thread = threading.Thread(target=deletion_worker,daemon=True)
+        deletion_thread.start()
+
+    deletion_queue.put(path)
+    artifact_stats['deleted_bytes'] += nbytes
+
+    return nbytes
+
+
+def wait_for_deletions():
+    """
+    wait until all queued deletions are done and remove the trash
+    """
+    t_start = time.time()
+    deletion_queue.join()
+
+    for trash in list(trash_dirs):
+        if os.path.isdir(trash) and len(os.listdir(trash)) == 0:
+            os.rmdir(trash)
+        trash_dirs.discard(trash)
+
+    # remove the artifact directories if there is nothing left
+    #
+    for a in artifact_registry:
+        if os.path.isdir(a['dir']) and len(os.listdir(a['dir'])) == 0:
+            os.rmdir(a['dir'])
+
+    return time.time() - t_start
+
+
+def move_files(files,destdir):
+    """
+    move files into a directory (rename on the same filesystem)
+    """
+    os.makedirs(destdir,exist_ok=True)
+
+    moved = []
+    for f in files:
+        dest = os.path.join(destdir,os.path.basename(f))
+        try:
+            os.rename(f,dest)
+        except OSError:
+            shutil.move(f,dest)
+        moved.append(dest)
+
+    artifact_stats['moved_files'] += len(moved)
+
+    return moved
+
+
+def apply_retention(artifact,rules):
+    """
+    delete the products of an artifact according to the rules
+    """
+    nbytes = 0
+    images = [f for f in artifact['files'] if f.endswith('.fits') and os.path.exists(f)]
+
+    if 'delete' in rules:
+        for f in artifact['files']:
+            nbytes += delete(f)
+
+        # the product directory if nothing else is left
+        # (its trash is deleted with it)
+        #
+        if os.path.isdir(artifact['dir']) and set(os.listdir(artifact['dir'])) <= set([trash_dir]):
+            delete(artifact['dir'],count=False)
+
+    elif 'keep_mfs' in rules:
+        for f in images:
+            if channel_image.search(f):
+                nbytes += delete(f)
+
+    artifact['files'] = [f for f in artifact['files'] if os.path.exists(f)]
+
+    return nbytes
+
+
+def store_products(outname,destdir,kind,sc_marker=0,homedir='',rules=None):
+    """
+    move all products of outname into destdir and
+    apply the retention rules of the product type
+    """
+    get_files = sorted(glob.glob(homedir+outname+'*'),key=os.path.getmtime)
+    files     = move_files(get_files,homedir+destdir)
+
+    if rules == None:
+        rules = retention_rules.get(kind,['keep_all'])
+
+    artifact = {'kind':kind,'round':sc_marker,'dir':homedir+destdir,'files':files}
+    artifact_registry.append(artifact)
+
+    apply_retention(artifact,rules)
+
+    # only the latest round
+    #
+    if 'keep_last' in rules:
+        for a in artifact_registry:
+            if a['kind'] == kind and a is not artifact:
+                apply_retention(a,['delete'])
+
+    return files
+
+
+def disk_usage(homedir=''):
+    """
+    bytes used by the registered artifacts and free bytes of the disk
+    """
+    used = 0
+    for a in artifact_registry:
+        used += sum([path_size(f) for f in a['files'] if os.path.exists(f)])
+
+    free = shutil.disk_usage(homedir if len(homedir) > 0 else '.').free
+
+    return used, free
+
+
+def quota_exceeded(homedir,required_bytes):
+    """
+    check the disk quota and the minimum free space
+    """
+    used, free = disk_usage(homedir)
+
+    if disk_quota_bytes > 0 and used + required_bytes > disk_quota_bytes:
+        return True
+
+    if min_free_bytes > 0 and free - required_bytes < min_free_bytes:
+        return True
+
+    return False
+
+
+def enforce_disk_quota(homedir='',required_bytes=0):
+    """
+    make room for the next step, first wait for pending deletions
+    then prune the images of the oldest rounds (the final images
+    are never pruned)
+    """
+    if not quota_exceeded(homedir,required_bytes):
+        return True
+
+    # throttle
+    #
+    artifact_stats['throttle_s'] += wait_for_deletions()
+
+    # prune, first the channel images then all images
+    #
+    for rules in [['keep_mfs'],['delete']]:
+        for a in artifact_registry:
+            if not quota_exceeded(homedir,required_bytes):
+                return True
+            if a['kind'] != 'final_images':
+                pruned = apply_retention(a,rules)
+                if pruned > 0:
+                    print('Disk quota, pruned ',pruned/1024**3,' GB of ',a['dir'])
+                    artifact_stats['pruned_bytes'] += pruned
+                    artifact_stats['throttle_s']   += wait_for_deletions()
+
+    if quota_exceeded(homedir,required_bytes):
+        used, free = disk_usage(homedir)
+        print('Disk quota exceeded, need ',required_bytes/1024**3,' GB, artifacts use ',used/1024**3,' GB, free ',free/1024**3,' GB')
+        artifact_stats['quota_exceeded'] = {'required_bytes':required_bytes,'used_bytes':used,'free_bytes':free}
+        return False
+
+    return True
+
+
+def wsclean_output_bytes(imsize,chan_out,nproducts=5):
+    """
+    disk space of the images of a wsclean run
+    """
+    nimages = chan_out + 1 if chan_out > 1 else 1
+
+    return nproducts * nimages * imsize**2 * 4
+
+
+def get_artifact_summary():
+    """
+    summary of the artifact handling
+    """
+    summary = dict(artifact_stats)
+    summary['rules']  = dict(retention_rules)
+    summary['stored'] = [{'kind':a['kind'],'round':a['round'],'dir':a['dir'],'nfiles':len(a['files'])} for a in artifact_registry]
+
+    return summary
@@ -0,0 +1,251 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Host aware settings of the wsclean parallelism and memory
+#
+# - reads the number of cores, the NUMA layout and the free
+#   memory of the host and selects -j, -parallel-gridding,
+#   -parallel-reordering, -parallel-deconvolution and -mem
+#   for the requested image size
+#
+# - optional short trials (dirty images of a few time steps)
+#   to select the fastest -parallel-gridding
+#
+# - without trials the -parallel-gridding of the fastest previous
+#   runs on the host is used (run history database RUNDB_lib)
+#
+# - the parallelism is cached per host and image configuration
+#   in 2GC_AUTOTUNE.json, -mem is derived from the free memory
+#   at each run
+#
+import os
+import glob
+import time
+import shutil
+import socket
+
+import numpy as np
+
+import CAL2GC_lib as C2GC
+import PLAN_lib as PLAN
+import BACKEND_lib as BACKEND
+import RUNDB_lib as RUNDB
+
+
+#
+# LIBS
+#
+
+global autotune_file, autotune_keys, min_history_steps, mem_margin
+
+autotune_file = '2GC_AUTOTUNE.json'
+
+# the wsclean settings provided by the autotuner
+#
+autotune_keys = ['-j','-parallel-gridding','-parallel-reordering','-parallel-deconvolution','-mem']
+
+# wsclean steps of previous runs needed per -parallel-gridding
+#
+min_history_steps = 3
+
+# fraction of the available memory not given to wsclean
+#
+mem_margin = 0.1
+
+
+def get_host_info():
+    """
+    return cores, NUMA layout and memory of the host
+    """
+    host = PLAN.get_node_resources()
+
+    host['hostname']   = socket.gethostname()
+    host['numa_nodes'] = max(1,len(glob.glob('/sys/devices/system/node/node[0-9]*')))
+
+    return host
+
+
+def autotune_key(host,imsize,chan_out):
+    """
+    cache key of the host and the image configuration
+    """
+    return host['hostname']+'_'+str(host['cores'])+'_'+str(imsize)+'_'+str(chan_out)
+
+
+def image_grid_memory(host,imsize,chan_out):
+    """
+    memory of the images (all channels) and of one gridder [bytes]
+    """
+    image_mem  = PLAN.estimate_memory('wsclean',host,imsize,chan_out,0,1.,{'-parallel-gridding':0})
+    grid_mem   = PLAN.estimate_memory('wsclean',host,imsize,1,0,1.,{'-parallel-gridding':1}) - \
+                     PLAN.estimate_memory('wsclean',host,imsize,1,0,1.,{'-parallel-gridding':0})
+
+    return image_mem, grid_mem
+
+
+def tune_wsclean_mem(host,imsize,chan_out,parallel_gridding):
+    """
+    percentage of the memory wsclean is allowed to use: the available
+    memory less a margin, but not below the memory of the images and
+    the gridders
+    """
+    image_mem, grid_mem = image_grid_memory(host,imsize,chan_out)
+
+    used_mem = image_mem + parallel_gridding * grid_mem
+    mem      = int(min(90,100. * (1. - mem_margin) * host['mem_available'] / host['mem_total']))
+    mem      = max(mem,int(np.ceil(100. * used_mem / host['mem_total'])))
+
+    return int(min(100,max(1,mem)))
+
+
+def tune_wsclean_para(host,imsize,chan_out):
+    """
+    select the wsclean parallelism and memory settings
+    """
+    cores          = host['cores']
+    cores_per_numa = max(1,cores // host['numa_nodes'])
+
+    # memory of the images (all channels) and of one gridder
+    #
+    image_mem, grid_mem = image_grid_memory(host,imsize,chan_out)
+
+    # keep at least half of the available memory for the visibilities
+    #
+    free_for_grids    = max(0.,0.5 * host['mem_available'] - image_mem)
+    parallel_gridding = int(min(chan_out,cores_per_numa,max(1,free_for_grids // max(grid_mem,1.))))
+
+    # reordering is I/O bound
+    #
+    parallel_reordering = int(min(chan_out,cores,8))
+
+    # sub-images for parallel deconvolution of large images
+    #
+    if imsize >= 4096 and cores >= 4:
+        parallel_deconvolution = int(max(1024,(imsize // int(np.sqrt(cores))) // 256 * 256))
+    else:
+        parallel_deconvolution = 0
+
+    tuned_para = {}
+    tuned_para['-j']                   = cores
+    tuned_para['-parallel-gridding']   = parallel_gridding
+    tuned_para['-parallel-reordering'] = parallel_reordering
+    if parallel_deconvolution > 0:
+        tuned_para['-parallel-deconvolution'] = parallel_deconvolution
+    tuned_para['-mem']                 = tune_wsclean_mem(host,imsize,chan_out,parallel_gridding)
+
+    return tuned_para
+
+
+def trial_wsclean_para(MSFILE,homedir,wsc_para,tuned_para,trial_timesteps=10):
+    """
+    run short dirty images of a few time steps
+    and select the fastest -parallel-gridding
+
+    failed trials (e.g. out of memory) are not considered, if all
+    trials fail the heuristic -parallel-gridding is kept
+    """
+    trialdir   = 'AUTOTUNE_TRIAL/'
+    os.makedirs(homedir+trialdir,exist_ok=True)
+
+    candidates = sorted(set([1,2,4,tuned_para['-parallel-gridding']]))
+    candidates = [c for c in candidates if c <= tuned_para['-parallel-gridding']]
+
+    timings = {}
+    for pg in candidates:
+        trial_para = C2GC.concat_dic(wsc_para,tuned_para)
+        trial_para['-parallel-gridding'] = pg
+        trial_para['-niter']             = 0
+        trial_para['-interval']          = '0 '+str(trial_timesteps)
+        trial_para['-no-update-model-required'] = ''
+
+        t_start = time.time()
+        rcode   = BACKEND.wsclean(MSFILE,trialdir+'TRIAL_PG'+str(pg),homedir,trial_para,C2GC.wsclean_argv(MSFILE,trialdir+'TRIAL_PG'+str(pg),homedir,trial_para))
+        if rcode != 0:
+            print('Autotune trial -parallel-gridding ',pg,' failed (return code ',rcode,')')
+            continue
+        timings[pg] = time.time() - t_start
+        print('Autotune trial -parallel-gridding ',pg,' ',timings[pg],' s')
+
+    shutil.rmtree(homedir+trialdir,ignore_errors=True)
+
+    if len(timings) > 0:
+        tuned_para['-parallel-gridding'] = min(timings,key=timings.get)
+    else:
+        print('Autotune all trials failed, keep -parallel-gridding ',tuned_para['-parallel-gridding'])
+
+    return tuned_para, timings
+
+
+def history_wsclean_para(host,chan_out,tuned_para,homedir=''):
+    """
+    select the -parallel-gridding with the lowest wsclean runtime
+    per work of previous runs on this host (not above the tuned
+    value, which is kept in the cache)
+    """
+    history = RUNDB.get_autotune_history(RUNDB.get_rundb_file(homedir),host['hostname'],chan_out)
+
+    rates = {}
+    for rec in history:
+        work = PLAN.step_work('wsclean',rec['imsize'],rec['chan_out'],rec['ms_bytes'],rec['spw_fraction'])
+        if work > 0 and rec['parallel_gridding'] <= tuned_para['-parallel-gridding']:
+            rates.setdefault(rec['parallel_gridding'],[]).append(rec['seconds'] / work)
+
+    rates = {pg:float(np.median(r)) for pg,r in rates.items() if len(r) >= min_history_steps}
+    if len(rates) > 1:
+        tuned_para['-parallel-gridding'] = min(rates,key=rates.get)
+        print('Autotune -parallel-gridding ',tuned_para['-parallel-gridding'],' from previous runs (s per byte ',rates,')')
+
+    return tuned_para
+
+
+def with_current_mem(host,imsize,chan_out,tuned_para):
+    """
+    the tuned settings with -mem of the current free memory
+    """
+    tuned_para         = dict(tuned_para)
+    tuned_para['-mem'] = tune_wsclean_mem(host,imsize,chan_out,tuned_para['-parallel-gridding'])
+
+    return tuned_para
+
+
+def get_autotuned_wsclean_para(MSFILE,homedir,wsc_para,imsize,chan_out,do_trials=False,usecache=True,savecache=True):
+    """
+    return the tuned wsclean settings of this host and image configuration
+    (the cache is not written with savecache=False e.g. for the plan)
+    """
+    host = get_host_info()
+    key  = autotune_key(host,imsize,chan_out)
+
+    if os.path.exists(homedir+autotune_file):
+        autotune_cache = C2GC.get_json(autotune_file,homedir)
+    else:
+        autotune_cache = {}
+
+    if usecache and key in autotune_cache:
+        cached_para = {k:v for k,v in autotune_cache[key]['wsclean_para'].items() if k != '-mem'}
+        if autotune_cache[key]['trials']:
+            return with_current_mem(host,imsize,chan_out,cached_para)
+        if not do_trials:
+            return with_current_mem(host,imsize,chan_out,history_wsclean_para(host,chan_out,cached_para,homedir))
+
+    tuned_para = tune_wsclean_para(host,imsize,chan_out)
+    timings    = {}
+    if do_trials:
+        tuned_para, timings = trial_wsclean_para(MSFILE,homedir,wsc_para,tuned_para)
+
+    # only the parallelism is cached
+    #
+    if savecache:
+        autotune_cache[key] = {'host':host,'imsize':imsize,'chan_out':chan_out,'trials':do_trials,'trial_timings':timings,\
+                                   'wsclean_para':{k:v for k,v in tuned_para.items() if k != '-mem'},'time':time.time()}
+        C2GC.save_to_json(autotune_cache,autotune_file,homedir)
+
+    if not do_trials:
+        return with_current_mem(host,imsize,chan_out,history_wsclean_para(host,chan_out,dict(tuned_para),homedir))
+
+    return with_current_mem(host,imsize,chan_out,tuned_para)
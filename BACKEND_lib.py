@@ -0,0 +1,278 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Backends of the external tools (wsclean, PyBDSF source finding,
+# CASA tasks and shadems)
+#
+# - real : runs the tools (default)
+#
+# - stub : writes outputs of realistic size (FITS images, logs,
+#          region files, caltables) after a configurable latency,
+#          allows to run the entire pipeline without CASA, wsclean
+#          or PyBDSF installed (see BENCHMARK_2GC_PIPELINE.py)
+#
+# the backend is selected via set_backend or the environment
+# variable C2GC_BACKEND
+#
+# the running tool and the wsclean output are passed to the live
+# progress (PROGRESS_lib)
+#
+import os
+import sys
+import time
+import json
+import shutil
+import subprocess
+
+import numpy as np
+
+import PROFILE_lib as PROF
+import PROGRESS_lib as PROGRESS
+
+
+#
+# LIBS
+#
+
+global backend_name, stub_latency
+
+backend_name = os.environ.get('C2GC_BACKEND','real')
+
+# latency [s] of the stub tools
+#
+stub_latency = {'wsclean':0.,'sourcefinding':0.,'casa':0.,'shadems':0.}
+
+
+def set_backend(name,latency={}):
+    """
+    select the backend (real or stub) and the latency of the stub tools
+    """
+    global backend_name
+
+    if name not in ['real','stub']:
+        raise ValueError('unknown backend '+str(name))
+
+    backend_name = name
+    for k in latency.keys():
+        stub_latency[k] = latency[k]
+
+
+def wsclean(MSFILE,outname,homedir,wsc_para,wsclean_argv):
+    """
+    run wsclean (argument list), the output is passed
+    on to stdout and the progress
+    """
+    PROGRESS.set_task('wsclean',wsc_para)
+
+    if backend_name == 'real':
+        with subprocess.Popen(wsclean_argv,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,text=True,errors='replace',bufsize=1) as proc:
+            for line in proc.stdout:
+                sys.stdout.write(line)
+                PROGRESS.wsclean_line(line)
+        return proc.returncode
+
+    with PROF.trace_stage('stub_wsclean','stub'):
+        lines = stub_wsclean_output(wsc_para)
+        for line in lines:
+            time.sleep(stub_latency['wsclean'] / len(lines))
+            PROGRESS.wsclean_line(line)
+        if len(lines) == 0:
+            time.sleep(stub_latency['wsclean'])
+        stub_wsclean(outname,homedir,wsc_para)
+
+    return 0
+
+
+def sourcefinding(mode,filename,homedir,source_finding):
+    """
+    run the source finding (mode mask or cataloging)
+    """
+    PROGRESS.set_task('pybdsf')
+
+    if backend_name == 'real':
+        return os.system(source_finding)
+
+    with PROF.trace_stage('stub_sourcefinding','stub'):
+        time.sleep(stub_latency['sourcefinding'])
+        stub_sourcefinding(mode,filename)
+
+    return 0
+
+
+def shadems(shadeit,homedir,figurename):
+    """
+    run shadems
+    """
+    PROGRESS.set_task('shadems')
+
+    if backend_name == 'real':
+        return os.system(shadeit)
+
+    with PROF.trace_stage('stub_shadems','stub'):
+        time.sleep(stub_latency['shadems'])
+        for corr in ['XX','YY']:
+            with open(homedir+'plot-'+corr+'-'+figurename+'.png','wb') as fout:
+                fout.write(b'\x89PNG\r\n\x1a\n' + bytes(1024))
+
+    return 0
+
+
+def casa(task,**kwargs):
+    """
+    run a CASA task (the casatasks are only loaded when needed)
+    """
+    PROGRESS.set_task(task)
+
+    if backend_name == 'real':
+        import casatasks
+        return getattr(casatasks,task)(**kwargs)
+
+    with PROF.trace_stage('stub_casa_'+task,'stub'):
+        time.sleep(stub_latency['casa'])
+        return stub_casa(task,**kwargs)
+
+
+#
+# stub implementation
+#
+
+def stub_fits(filename,imsize,nchan=1,bunit='JY/BEAM',noise=1E-5,seed=1):
+    """
+    write a FITS image of realistic size
+    """
+    from astropy.io import fits
+
+    rng  = np.random.default_rng(seed)
+    data = (rng.standard_normal((1,nchan,imsize,imsize),dtype=np.float32) * noise)
+
+    header = fits.Header()
+    header['BUNIT']  = bunit
+    header['CTYPE1'] = 'RA---SIN'
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CDELT1'] = -1./3600.
+    header['CDELT2'] = 1./3600.
+    header['CRPIX1'] = imsize/2
+    header['CRPIX2'] = imsize/2
+
+    fits.writeto(filename,data,header=header,overwrite=True)
+
+
+def stub_wsclean_output(wsc_para,nmajor=3,niter_major=100):
+    """
+    lines of the wsclean output of the deconvolution
+    """
+    lines = []
+    if int(get_para(wsc_para,'-niter','0')) == 0:
+        return lines
+
+    noise     = 1E-5
+    threshold = max(float(get_para(wsc_para,'-auto-threshold','0').split()[0]) * noise,\
+                        PROGRESS.parse_threshold(get_para(wsc_para,'-threshold','0')) or 0.)
+    threshold = threshold if threshold > 0 else 1E-4
+    peak      = 100. * threshold
+    lines.append('Estimated standard deviation of background noise: '+'{:.2f}'.format(noise*1E6)+' µJy')
+    for major in range(1,nmajor+1):
+        lines.append('== Deconvolving ('+str(major)+') ==')
+        for it in range(0,niter_major,niter_major//4):
+            lines.append('Iteration '+str((major-1)*niter_major+it)+', scale 0 px : '+'{:.3f}'.format(peak*1E3)+' mJy at 10,10')
+            peak = max(threshold,peak * 0.6)
+        lines.append('Next major iteration at: '+'{:.3f}'.format(peak*1E3)+' mJy')
+    lines.append('Stopped on peak '+'{:.3f}'.format(threshold*1E3)+' mJy, because the auto-threshold was reached.')
+
+    return lines
+
+
+def stub_wsclean(outname,homedir,wsc_para):
+    """
+    write the images of a wsclean run
+    """
+    size     = max([int(s) for s in get_para(wsc_para,'-size','256 256').split()])
+    chan_out = int(get_para(wsc_para,'-channels-out','1'))
+
+    products = ['dirty','psf','residual','model','image']
+
+    if chan_out > 1:
+        prefixes = [outname+'-'+str(c).zfill(4) for c in range(chan_out)] + [outname+'-MFS']
+    else:
+        prefixes = [outname]
+
+    for p in prefixes:
+        for im in products:
+            if im == 'model':
+                stub_fits(homedir+p+'-'+im+'.fits',size,bunit='JY/PIXEL',noise=1E-6)
+            else:
+                stub_fits(homedir+p+'-'+im+'.fits',size)
+
+    if get_para(wsc_para,'-save-source-list') != None:
+        with open(homedir+outname+'-sources.txt','w') as fout:
+            print("Format = Name, Type, Ra, Dec, I, SpectralIndex, LogarithmicSI, ReferenceFrequency='1284000000', MajorAxis, MinorAxis, Orientation",file=fout)
+            for i in range(100):
+                print('s0c'+str(i)+',POINT,00:00:00.0,-30.00.00.0,'+str(1E-3*(i+1))+',[-0.7],true,1284000000,,,',file=fout)
+
+
+def stub_sourcefinding(mode,filename):
+    """
+    write the PyBDSF log and region files
+    """
+    imagename  = os.path.basename(filename)
+    pybdsf_dir = filename.replace('.fits','').replace('.FITS','')+'_pybdsf/'
+    os.makedirs(pybdsf_dir,exist_ok=True)
+
+    with open(pybdsf_dir+imagename+'.pybdsf.log','w') as fout:
+        for i in range(1000):
+            print('Fitting island '+str(i)+' ... done',file=fout)
+        print('Background rms map: ... std. dev: 1.2e-05 (Jy/beam)',file=fout)
+        print('Beam shape (major, minor, pos angle) : (2.1e-03, 1.8e-03, 32.5) degrees',file=fout)
+        print('Number of sources formed from Gaussians : 100',file=fout)
+        print('Total flux density in model : 0.5 Jy',file=fout)
+
+    if mode == 'mask':
+        with open(pybdsf_dir+imagename.replace('.fits','').replace('.FITS','')+'_mask.crtf','w') as fout:
+            print('#CRTFv0',file=fout)
+            for i in range(100):
+                print('ellipse [['+str(i*1E-3)+'deg, -30deg], [10arcsec, 5arcsec], 45deg]',file=fout)
+
+
+def stub_casa(task,**kwargs):
+    """
+    emulate the outputs of the CASA tasks
+    """
+    if task == 'importfits':
+        from astropy.io import fits
+        os.makedirs(kwargs['imagename'],exist_ok=True)
+        header = fits.getheader(kwargs['fitsimage'])
+        with open(kwargs['imagename']+'/table.info','w') as fout:
+            json.dump({'imsize':header['NAXIS1']},fout)
+
+    elif task == 'makemask':
+        shutil.copytree(kwargs['inpimage'],kwargs['output'],dirs_exist_ok=True)
+
+    elif task == 'exportfits':
+        with open(kwargs['imagename']+'/table.info') as f:
+            imsize = json.load(f)['imsize']
+        stub_fits(kwargs['fitsimage'],imsize,bunit='',noise=0.)
+
+    elif task == 'gaincal':
+        os.makedirs(kwargs['caltable'],exist_ok=True)
+        with open(kwargs['caltable']+'/table.f0','wb') as fout:
+            fout.write(bytes(64*1024))
+
+    elif task == 'split' or task == 'mstransform':
+        shutil.copytree(kwargs['vis'],kwargs['outputvis'],dirs_exist_ok=True)
+
+    return None
+
+
+def get_para(wsc_para,option,default=None):
+    """
+    value of a wsclean option (keys may contain spaces)
+    """
+    for k in wsc_para.keys():
+        if k.strip() == option:
+            return str(wsc_para[k]).strip()
+    return default
@@ -0,0 +1,256 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Detection of misbehaving antennas from the gain solutions
+#
+# - antennas: the per antenna phase RMS, amplitude scatter and
+#   flagged fraction of the solutions (CALSTATS_lib) are compared
+#   with the robust (median, MAD) statistics across all antennas
+#
+# - time ranges: the phase (and amplitude) deviations of the
+#   individual solutions from the antenna mean are compared with
+#   the robust statistics of all solutions of the same time
+#
+# - the decisions are converted into a single flagdata list and the
+#   re-solved time ranges are merged into the caltable
+#
+import json
+import datetime
+
+import numpy as np
+
+import CALSTATS_lib as CALSTATS
+
+
+#
+# LIBS
+#
+
+global min_sigma, max_outlier_fraction
+
+# lower limits of the robust sigma across the antennas (avoids
+# flagging on a very homogeneous array)
+#
+min_sigma = {'phase_rms_deg':1.,'amp_scatter':0.01,'flagged_fraction':0.02,'phase_dev_deg':2.,'amp_dev':0.02}
+
+# antennas with more outlier solutions are flagged entirely
+#
+max_outlier_fraction = 0.3
+
+
+def robust_limit(values,nsigma,min_sig):
+    """
+    median + nsigma * robust sigma (MAD)
+    """
+    values = np.asarray(values,dtype=float)
+    median = np.nanmedian(values)
+    sigma  = max(1.4826 * np.nanmedian(np.abs(values - median)),min_sig)
+
+    return median + nsigma * sigma
+
+
+def casa_timestring(mjd_seconds):
+    """
+    CASA time string of MJD seconds
+    """
+    t = datetime.datetime(1858,11,17) + datetime.timedelta(seconds=float(mjd_seconds))
+
+    return t.strftime('%Y/%m/%d/%H:%M:%S.')+str(t.microsecond // 100000)
+
+
+def solution_deviations(sol,exclude=None):
+    """
+    phase [deg] and relative amplitude deviation of each solution
+    from the mean of its antenna and spw (max over channels and
+    receptors, nan if flagged), excluded solutions do not enter
+    the mean
+    """
+    valid  = ~sol['flag']
+    key    = sol['ant'] * (np.max(sol['spw']) + 1) + sol['spw']
+    gain   = np.where(valid,sol['gain'],0)
+    amp    = np.abs(gain)
+    phasor = np.where(amp > 0,gain / np.where(amp > 0,amp,1),0)
+    use    = valid if exclude is None else valid & ~exclude[:,None,None]
+
+    nkey   = int(np.max(key)) + 1
+    mean   = np.zeros((nkey,)+gain.shape[1:],dtype=complex)
+    np.add.at(mean,key,np.where(use,phasor,0))
+    asum   = np.zeros((nkey,)+gain.shape[1:])
+    np.add.at(asum,key,np.where(use,amp,0))
+    nvalid = np.zeros((nkey,)+gain.shape[1:])
+    np.add.at(nvalid,key,use)
+
+    dphase = np.abs(np.angle(phasor * np.conj(mean[key]),deg=True))
+    damp   = np.abs(amp / np.maximum(asum / np.maximum(nvalid,1),1E-12)[key] - 1)
+
+    with np.errstate(all='ignore'):
+        dphase = np.nanmax(np.where(valid,dphase,np.nan),axis=(1,2))
+        damp   = np.nanmax(np.where(valid,damp,np.nan),axis=(1,2))
+
+    return dphase, damp
+
+
+def find_bad_antennas(caltable,refant='',nsigma=5.,calmode='p'):
+    """
+    antennas and time ranges with outlier solutions
+    returns the list of decisions
+    """
+    stats     = CALSTATS.caltable_statistics(caltable)
+    sol       = CALSTATS.read_caltable(caltable)
+    names     = sol['antenna_names']
+    refants   = str(refant).split(',')
+    decisions = []
+
+    # outlier solutions, robust statistics of all antennas
+    # per solution time (second pass with the antenna means
+    # without the outliers of the first pass)
+    #
+    times   = np.unique(sol['time'])
+    tidx    = np.searchsorted(times,sol['time'])
+    outlier = None
+    for iteration in range(2):
+        dphase, damp = solution_deviations(sol,outlier)
+        deviations   = [['phase_dev_deg',dphase]] + ([['amp_dev',damp]] if 'a' in calmode else [])
+
+        outlier = np.zeros(len(sol['time']),dtype=bool)
+        for m,dev in deviations:
+            for ti in range(len(times)):
+                sel = tidx == ti
+                if np.sum(np.isfinite(dev[sel])) < 3:
+                    continue
+                limit = robust_limit(dev[sel],nsigma,min_sigma[m])
+                outlier[sel] |= np.nan_to_num(dev[sel]) > limit
+
+    # entire antennas, the scatter is determined without the
+    # outlier solutions (these are flagged as time ranges)
+    #
+    nant    = len(names)
+    good    = np.isfinite(dphase) & ~outlier
+    ngood   = np.maximum(np.bincount(sol['ant'],weights=good,minlength=nant),1)
+    values  = {}
+    values['phase_rms_deg']    = np.sqrt(np.bincount(sol['ant'],weights=np.where(good,dphase,0)**2,minlength=nant) / ngood)
+    values['amp_scatter']      = np.sqrt(np.bincount(sol['ant'],weights=np.where(good,damp,0)**2,minlength=nant) / ngood)
+    values['flagged_fraction'] = np.array([stats['antenna'].get(n,{'flagged_fraction':0.})['flagged_fraction'] for n in names])
+    outlier_fraction           = np.bincount(sol['ant'],weights=outlier,minlength=nant) / np.maximum(np.bincount(sol['ant'],minlength=nant),1)
+
+    ants    = [names.index(a) for a in stats['antenna']]
+    metrics = ['phase_rms_deg','flagged_fraction'] + (['amp_scatter'] if 'a' in calmode else [])
+    bad_ant = set()
+    for m in metrics:
+        limit = robust_limit(values[m][ants],nsigma,min_sigma[m])
+        for a in ants:
+            if values[m][a] > limit and names[a] not in bad_ant:
+                decisions.append({'antenna':names[a],'timerange':'','reason':m,'value':float(values[m][a]),'limit':float(limit),\
+                                      'flag':names[a] not in refants})
+                bad_ant.add(names[a])
+
+    for a in ants:
+        if outlier_fraction[a] > max_outlier_fraction and names[a] not in bad_ant:
+            decisions.append({'antenna':names[a],'timerange':'','reason':'outlier solutions','value':float(outlier_fraction[a]),\
+                                  'limit':max_outlier_fraction,'flag':names[a] not in refants})
+            bad_ant.add(names[a])
+
+    # time ranges of the remaining antennas
+    #
+    for a in np.unique(sol['ant'][outlier]):
+        if names[a] in bad_ant:
+            continue
+        sel  = outlier & (sol['ant'] == a)
+        t_sel, i_sel = sol['time'][sel], sol['interval'][sel]
+        # merge neighbouring solution intervals
+        #
+        order  = np.argsort(t_sel)
+        t_sel, i_sel = t_sel[order], i_sel[order]
+        starts, ends = t_sel - np.maximum(i_sel / 2,0.5), t_sel + np.maximum(i_sel / 2,0.5)
+        t0, t1, nsol = starts[0], ends[0], 1
+        for s,e in zip(list(starts[1:])+[None],list(ends[1:])+[None]):
+            if s != None and s <= t1 + 1.:
+                t1, nsol = max(t1,e), nsol + 1
+                continue
+            decisions.append({'antenna':names[a],'timerange':casa_timestring(t0)+'~'+casa_timestring(t1),\
+                                  'time':[float(t0),float(t1)],'reason':'outlier solutions','value':nsol,\
+                                  'limit':nsigma,'flag':names[a] not in refants})
+            if s != None:
+                t0, t1, nsol = s, e, 1
+
+    return decisions
+
+
+def flag_commands(decisions):
+    """
+    flagdata list of the decisions to be flagged
+    """
+    commands = []
+    for d in decisions:
+        if d['flag']:
+            cmd = "antenna='"+d['antenna']+"'"
+            if len(d['timerange']) > 0:
+                cmd += " timerange='"+d['timerange']+"'"
+            commands.append(cmd)
+
+    return commands
+
+
+def resolve_timerange(decisions):
+    """
+    time range to be re-solved
+    (empty string for the entire observation)
+    """
+    flagged = [d for d in decisions if d['flag']]
+    if len(flagged) == 0 or any([len(d['timerange']) == 0 for d in flagged]):
+        return ''
+
+    return ','.join([d['timerange'] for d in flagged])
+
+
+def merge_caltable(caltable,resolved_caltable,decisions):
+    """
+    replace the solutions of the re-solved time ranges
+    """
+    from casacore.tables import table
+
+    ranges = [d['time'] for d in decisions if d['flag'] and 'time' in d]
+
+    with table(caltable,readonly=False,ack=False) as cal, table(resolved_caltable,ack=False) as new:
+        times   = cal.getcol('TIME')
+        replace = np.zeros(len(times),dtype=bool)
+        for t0,t1 in ranges:
+            replace |= (times >= t0) & (times <= t1)
+        cal.removerows(np.flatnonzero(replace))
+
+        new_times = new.getcol('TIME')
+        keep      = np.zeros(len(new_times),dtype=bool)
+        for t0,t1 in ranges:
+            keep |= (new_times >= t0) & (new_times <= t1)
+        if keep.sum() > 0:
+            new.selectrows(np.flatnonzero(keep)).copyrows(cal)
+
+    return int(replace.sum()), int(keep.sum())
+
+
+def save_decisions(decisions,filename):
+    """
+    log of the decisions
+    """
+    with open(filename,'w') as fout:
+        json.dump(decisions,fout,indent=1)
+
+
+def print_decisions(decisions,caltable):
+    """
+    print the decisions
+    """
+    if len(decisions) == 0:
+        print('\n No bad antennas found in ',caltable,'\n')
+        return
+
+    print('\n Bad antennas in ',caltable)
+    for d in decisions:
+        print('   ',d['antenna'],' ',d['timerange'] if len(d['timerange']) > 0 else 'entire observation',' ',d['reason'],\
+                  ' ',d['value'],' limit ',d['limit'],' flagged' if d['flag'] else ' reference antenna not flagged')
+    print('\n')
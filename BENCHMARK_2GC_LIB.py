@@ -0,0 +1,267 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Offline micro-benchmarks of the CAL2GC_lib hot paths
+#
+# - generates synthetic FITS images (single plane and channel
+#   cubes), PyBDSF log files and CRTF region files
+#
+# - times get_imagestats, sum_imageflux, get_info_from_pybdsflog,
+#   the mask generation (needs CASA) and the wsclean command
+#   building and reports throughput [MB/s] and peak memory
+#
+# - the results are saved in a baseline file and a later
+#   run can be compared to flag regressions
+#
+# python3 BENCHMARK_2GC_LIB.py --SAVE
+# python3 BENCHMARK_2GC_LIB.py --COMPARE
+#
+import os
+import sys
+import time
+import shutil
+import tempfile
+#
+import numpy as np
+import CAL2GC_lib as C2GC
+import PROFILE_lib as PROF
+#
+from optparse import OptionParser
+
+
+def make_synthetic_fits(filename,imsize,nchan=1,nsources=100,seed=1):
+    """
+    generate a synthetic image (noise and point sources)
+    """
+    from astropy.io import fits
+
+    rng  = np.random.default_rng(seed)
+    data = np.zeros((1,nchan,imsize,imsize),dtype=np.float32)
+    for c in range(nchan):
+        data[0,c] = rng.standard_normal((imsize,imsize),dtype=np.float32) * 1E-5
+        pos       = rng.integers(0,imsize,size=(nsources,2))
+        data[0,c,pos[:,0],pos[:,1]] += rng.uniform(1E-4,1E-1,nsources).astype(np.float32)
+
+    header = fits.Header()
+    header['BUNIT']  = 'JY/BEAM'
+    header['CTYPE1'] = 'RA---SIN'
+    header['CTYPE2'] = 'DEC--SIN'
+    header['CTYPE3'] = 'FREQ'
+    header['CTYPE4'] = 'STOKES'
+    header['CDELT1'] = -1./3600.
+    header['CDELT2'] = 1./3600.
+    header['CRPIX1'] = imsize/2
+    header['CRPIX2'] = imsize/2
+    header['CRVAL1'] = 0.
+    header['CRVAL2'] = -30.
+    header['CRVAL3'] = 1.28E9
+    header['CDELT3'] = 1E7
+    header['CRVAL4'] = 1.
+    header['CDELT4'] = 1.
+
+    fits.writeto(filename,data,header=header,overwrite=True)
+
+    return filename
+
+
+def make_synthetic_pybdsflog(filename,nruns=50):
+    """
+    generate a synthetic PyBDSF log file
+    """
+    with open(filename,'w') as fout:
+        for r in range(nruns):
+            print('--------------------------------------------------------------------------------',file=fout)
+            print('PyBDSF version 1.10.3',file=fout)
+            for i in range(200):
+                print('Fitting island '+str(i)+' ... done',file=fout)
+            print('Background rms map: ... std. dev: '+str(1E-5*(r+1))+' (Jy/beam)',file=fout)
+            print('Beam shape (major, minor, pos angle) : (2.1e-03, 1.8e-03, 32.5) degrees',file=fout)
+            print('Number of sources formed from Gaussians : '+str(100+r),file=fout)
+            print('Total flux density in model : '+str(0.1*(r+1))+' Jy',file=fout)
+
+    return filename
+
+
+def make_synthetic_regionfile(filename,nsources=1000,seed=1):
+    """
+    generate a synthetic CRTF region file
+    """
+    rng = np.random.default_rng(seed)
+    with open(filename,'w') as fout:
+        print('#CRTFv0',file=fout)
+        for i in range(nsources):
+            ra  = rng.uniform(-1,1)
+            dec = -30 + rng.uniform(-1,1)
+            print('ellipse [['+str(ra)+'deg, '+str(dec)+'deg], [10arcsec, 5arcsec], 45deg]',file=fout)
+
+    return filename
+
+
+def bench(func,nbytes=0,nrepeat=3):
+    """
+    time a function (best of nrepeat) and its peak memory
+    """
+    timings = []
+    rss_start = PROF.read_rss()
+    PROF.reset_peak_rss()
+    for n in range(nrepeat):
+        t_start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t_start)
+    peak_rss = PROF.read_peak_rss()
+
+    result = {}
+    result['seconds']        = min(timings)
+    result['peak_mem_bytes'] = max(0,peak_rss - rss_start)
+    if nbytes > 0:
+        result['mbytes_per_s'] = nbytes / 1024**2 / max(result['seconds'],1E-9)
+
+    return result
+
+
+def run_benchmarks(benchdir,sizes,nchan,nrepeat,domask):
+    """
+    run all benchmarks
+    """
+    results = {}
+
+    # images
+    #
+    for imsize in sizes:
+        for nc in sorted(set([1,nchan])):
+            name      = 'IMAGE_'+str(imsize)+'_'+str(nc)
+            imagename = name+'.fits'
+            make_synthetic_fits(benchdir+imagename,imsize,nc)
+            nbytes    = os.path.getsize(benchdir+imagename)
+
+            results['get_imagestats_'+name] = bench(lambda: C2GC.get_imagestats(imagename,benchdir),nbytes,nrepeat)
+            results['sum_imageflux_'+name]  = bench(lambda: C2GC.sum_imageflux(imagename,benchdir,threshold=0),nbytes,nrepeat)
+            print(name,results['get_imagestats_'+name],results['sum_imageflux_'+name])
+
+            if domask and nc == 1:
+                make_synthetic_regionfile(benchdir+name+'.crtf')
+                def make_mask():
+                    mask_fits_file = C2GC.make_mask(imagename,name+'.crtf','BENCH_MASK',0,benchdir,True)
+                    os.remove(benchdir+mask_fits_file)
+                results['make_mask_'+name] = bench(make_mask,nbytes,1)
+                print(name,results['make_mask_'+name])
+
+            os.remove(benchdir+imagename)
+
+    # pybdsf log file
+    #
+    pybdsf_log = 'BENCH.pybdsf.log'
+    make_synthetic_pybdsflog(benchdir+pybdsf_log)
+    nbytes     = os.path.getsize(benchdir+pybdsf_log)
+    results['get_info_from_pybdsflog'] = bench(lambda: C2GC.get_info_from_pybdsflog(pybdsf_log,'',benchdir),nbytes,nrepeat)
+    print('pybdsf log',results['get_info_from_pybdsflog'])
+
+    # parameter and command building of a self-calibration round
+    #
+    iminput, errors = C2GC.load_input('IMAGING_2GC_DEFAULTS.json',os.path.dirname(os.path.abspath(__file__))+'/')
+    selfcal_para    = C2GC.get_selfcal_settings(iminput['SELFCAL_PARAMETER'])
+    def build_commands():
+        for n in range(1000):
+            default_para = C2GC.get_imaging_wsclean_para(iminput,8192,1,'I',16,'0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15')
+            templates    = C2GC.compile_wsclean_templates(default_para,iminput,['DATA',-0.5,1,0.1,1E-6],selfcal_para)
+            for sc in range(len(selfcal_para['selfcal_modes'])):
+                wsc_para = C2GC.get_selfcal_wsclean_para(templates,selfcal_para,sc,16)
+                C2GC.wsclean_argv('BENCH.ms','MKMASK'+str(sc),benchdir,wsc_para)
+    results['command_building_x1000'] = bench(build_commands,0,nrepeat)
+    print('command building',results['command_building_x1000'])
+
+    return results
+
+
+def compare_benchmarks(results,baseline,tolerance):
+    """
+    compare with the baseline, returns the regressions
+    """
+    regressions = []
+    for name in sorted(results.keys()):
+        if name not in baseline:
+            continue
+        ratio = results[name]['seconds'] / max(baseline[name]['seconds'],1E-9)
+        flag  = ''
+        if ratio > 1 + tolerance:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('{:45s} {:10.4f} s  baseline {:10.4f} s  ratio {:6.2f}{}'.format(name,results[name]['seconds'],baseline[name]['seconds'],ratio,flag))
+
+    return regressions
+
+
+def main():
+
+    # argument parsing
+    #
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--BENCH_DIR', dest='benchdir', default='', type=str,
+                      help='Directory for the synthetic data [default temporary directory]')
+
+    parser.add_option('--BASELINE_FILE', dest='baselinefile', default='BENCHMARK_2GC_LIB_BASELINE.json', type=str,
+                      help='Baseline file [default: BENCHMARK_2GC_LIB_BASELINE.json]')
+
+    parser.add_option('--SIZES', dest='sizes', default='512,2048,8192', type=str,
+                      help='image sizes in pixel [default 512,2048,8192] up to 16384')
+
+    parser.add_option('--NCHAN', dest='nchan', default=4, type=int,
+                      help='number of channels of the cube images [default 4]')
+
+    parser.add_option('--NREPEAT', dest='nrepeat', default=3, type=int,
+                      help='repeat each benchmark and take the best [default 3]')
+
+    parser.add_option('--TOLERANCE', dest='tolerance', default=0.2, type=float,
+                      help='allowed slow down before a regression is flagged [default 0.2]')
+
+    parser.add_option('--DOMASK', dest='domask', action='store_true', default=False,
+                      help='include the mask generation (needs CASA) [default no]')
+
+    parser.add_option('--SAVE', dest='dosave', action='store_true', default=False,
+                      help='save the results as new baseline [default no]')
+
+    parser.add_option('--COMPARE', dest='docompare', action='store_true', default=False,
+                      help='compare the results with the baseline [default no]')
+
+    # ----
+
+    (opts, args)         = parser.parse_args()
+
+    if len(opts.benchdir) > 0:
+        benchdir = opts.benchdir
+        os.makedirs(benchdir,exist_ok=True)
+    else:
+        benchdir = tempfile.mkdtemp(prefix='2GC_BENCH_')+'/'
+
+    sizes   = [int(s) for s in opts.sizes.split(',') if len(s) > 0]
+
+    results = run_benchmarks(benchdir,sizes,opts.nchan,opts.nrepeat,opts.domask)
+
+    if len(opts.benchdir) == 0:
+        shutil.rmtree(benchdir,ignore_errors=True)
+
+    regressions = []
+    if opts.docompare:
+        if os.path.exists(opts.baselinefile):
+            baseline    = C2GC.get_json(opts.baselinefile)['results']
+            regressions = compare_benchmarks(results,baseline,opts.tolerance)
+        else:
+            print('No baseline file ',opts.baselinefile)
+
+    if opts.dosave:
+        C2GC.save_to_json({'time':time.time(),'host':os.uname().nodename,'results':results},opts.baselinefile,'')
+
+    if len(regressions) > 0:
+        print('\nRegressions: ',regressions)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
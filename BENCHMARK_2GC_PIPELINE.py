@@ -0,0 +1,186 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# End-to-end benchmark of the pipeline orchestration
+#
+# - runs the full IMAGING_and_2GC self-calibration loop on a
+#   tiny synthetic MS with the stub backends (see BACKEND_lib),
+#   no CASA, wsclean or PyBDSF is needed
+#
+# - reports per stage the overhead of the pipeline itself (file
+#   handling, JSON I/O, statistics, ...) separately from the
+#   simulated tool time
+#
+# python3 BENCHMARK_2GC_PIPELINE.py --IMSIZE=512 --LATENCY=wsclean:0.5,casa:0.1
+#
+import os
+import sys
+import time
+import shutil
+import tempfile
+#
+import numpy as np
+import CAL2GC_lib as C2GC
+import MSINFO_lib as MSINFO
+import PROFILE_lib as PROF
+import BACKEND_lib as BACKEND
+#
+from optparse import OptionParser
+
+
+def make_stub_ms(MSFILE,homedir,nspw=4,nant=8,ms_size_mb=10):
+    """
+    generate a tiny synthetic MS (directory and cached meta data)
+    """
+    msfile = homedir + MSFILE
+    os.makedirs(msfile,exist_ok=True)
+    with open(msfile+'/table.f0','wb') as fout:
+        fout.write(bytes(int(ms_size_mb * 1024**2)))
+
+    msinfo = {}
+    msinfo['nrows']              = 1000
+    msinfo['integration_time_s'] = 8.
+    msinfo['source_names']       = ['STUB_SOURCE']
+    msinfo['field_dir_deg']      = [[0.,-30.]]
+    msinfo['spw']                = []
+    for s in range(nspw):
+        f0 = 0.856E9 + s * 0.856E9/nspw
+        msinfo['spw'].append({'nchan':256,'ref_freq_hz':f0,'min_freq_hz':f0,'max_freq_hz':f0+0.856E9/nspw,\
+                                  'chan_width_hz':0.856E9/nspw/256,'bandwidth_hz':0.856E9/nspw})
+    msinfo['antenna_names']      = ['m'+str(a).zfill(3) for a in range(nant)]
+    msinfo['max_baseline_m']     = 7700.
+    msinfo['telescope']          = ['MeerKAT']
+    msinfo['time_range_s']       = [0.,4*3600.]
+    msinfo['msfile']             = MSFILE
+    msinfo['ms_mtime']           = MSINFO.ms_modification_time(msfile)
+    msinfo['ms_size_bytes']      = MSINFO.ms_disk_size(msfile)
+    msinfo['msinfo_version']     = MSINFO.msinfo_version
+
+    C2GC.save_to_json(msinfo,MSINFO.msinfo_cachefile(MSFILE,''),homedir)
+
+    return msfile
+
+
+def busy_time(events):
+    """
+    time covered by the events (concurrent events counted once)
+    """
+    busy, end = 0., None
+    for e in sorted(events,key=lambda e: e['ts']):
+        if end == None or e['ts'] > end:
+            busy += e['dur']
+            end   = e['ts'] + e['dur']
+        elif e['ts'] + e['dur'] > end:
+            busy += e['ts'] + e['dur'] - end
+            end   = e['ts'] + e['dur']
+
+    return busy
+
+
+def stage_overhead(trace_events):
+    """
+    per stage wall time, simulated tool time and overhead
+    """
+    stubs    = [e for e in trace_events if e['cat'] == 'stub']
+    overhead = {}
+    for e in trace_events:
+        if e['cat'] == 'stub':
+            continue
+        simulated = busy_time([st for st in stubs if st['ts'] >= e['ts'] and st['ts'] + st['dur'] <= e['ts'] + e['dur']])
+
+        if e['name'] not in overhead:
+            overhead[e['name']] = {'calls':0,'wall_s':0.,'tool_s':0.,'overhead_s':0.}
+        overhead[e['name']]['calls']      += 1
+        overhead[e['name']]['wall_s']     += e['dur'] / 1E6
+        overhead[e['name']]['tool_s']     += simulated / 1E6
+        overhead[e['name']]['overhead_s'] += (e['dur'] - simulated) / 1E6
+
+    return overhead
+
+
+def main():
+
+    # argument parsing
+    #
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--BENCH_DIR', dest='benchdir', default='', type=str,
+                      help='Directory for the synthetic data [default temporary directory]')
+
+    parser.add_option('--IMSIZE', dest='imsize', default=512, type=int,
+                      help='imsize in pixel [default 512]')
+
+    parser.add_option('--NSPW', dest='nspw', default=4, type=int,
+                      help='number of spectral windows of the synthetic MS [default 4]')
+
+    parser.add_option('--MS_SIZE_MB', dest='ms_size_mb', default=10, type=float,
+                      help='size of the synthetic MS [default 10 MB]')
+
+    parser.add_option('--LATENCY', dest='latency', default='', type=str,
+                      help='latency of the stub tools e.g. wsclean:0.5,casa:0.1 [default no latency]')
+
+    parser.add_option('--OUTPUT', dest='output', default='', type=str,
+                      help='save the results in a JSON file [default no]')
+
+    # ----
+
+    (opts, args)         = parser.parse_args()
+
+    if len(opts.benchdir) > 0:
+        benchdir = opts.benchdir
+        os.makedirs(benchdir,exist_ok=True)
+    else:
+        benchdir = tempfile.mkdtemp(prefix='2GC_PIPE_BENCH_')+'/'
+
+    latency = {}
+    for lat in opts.latency.split(','):
+        if len(lat) > 0:
+            latency[lat.split(':')[0]] = float(lat.split(':')[1])
+
+    # prepare the working directory
+    #
+    MSFILE = 'STUB.ms'
+    make_stub_ms(MSFILE,benchdir,opts.nspw,ms_size_mb=opts.ms_size_mb)
+    os.makedirs(benchdir+'2GC',exist_ok=True)
+    shutil.copy(os.path.dirname(os.path.abspath(__file__))+'/IMAGING_2GC_DEFAULTS.json',benchdir+'2GC/')
+
+    # run the pipeline with the stub tools
+    #
+    BACKEND.set_backend('stub',latency)
+
+    import IMAGING_and_2GC
+
+    sys.argv = ['IMAGING_and_2GC.py','--MS_FILE='+MSFILE,'--WORK_DIR='+benchdir,'--DOSELFCAL',\
+                    '--IMAG_PARA_IMSIZE='+str(opts.imsize),'--IMAG_PARA_SPWDS='+','.join([str(s) for s in range(opts.nspw)])]
+
+    t_start = time.time()
+    IMAGING_and_2GC.main()
+    t_total = time.time() - t_start
+
+    # report
+    #
+    overhead = stage_overhead(PROF.trace_events)
+
+    print('\n{:30s} {:>6s} {:>10s} {:>10s} {:>12s}'.format('stage','calls','wall [s]','tool [s]','overhead [s]'))
+    for name in sorted(overhead,key=lambda n: -overhead[n]['overhead_s']):
+        st = overhead[name]
+        print('{:30s} {:6d} {:10.3f} {:10.3f} {:12.3f}'.format(name,st['calls'],st['wall_s'],st['tool_s'],st['overhead_s']))
+
+    tool_total = busy_time([e for e in PROF.trace_events if e['cat'] == 'stub']) / 1E6
+    print('\n Total ','{:.3f}'.format(t_total),' s  simulated tools ','{:.3f}'.format(tool_total),' s  pipeline overhead ','{:.3f}'.format(t_total-tool_total),' s\n')
+
+    if len(opts.output) > 0:
+        C2GC.save_to_json({'total_s':t_total,'tool_s':tool_total,'overhead_s':t_total-tool_total,'stages':overhead},opts.output,'')
+
+    if len(opts.benchdir) == 0:
+        shutil.rmtree(benchdir,ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Startup budget of the command line paths that do not need CASA
+#
+# - runs the --help of the scripts and the --PLAN of IMAGING_and_2GC
+#   (stub backend, synthetic MS) in fresh interpreters
+#
+# - reports the wall time (best of NREPEAT) and the heavy modules
+#   (CASA, astropy, PyBDSF, matplotlib) that have been imported
+#
+# - fails if a path exceeds the budget or imports a heavy module
+#
+# python3 BENCHMARK_STARTUP.py --BUDGET=1.0 --NREPEAT=5
+#
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+#
+import CAL2GC_lib as C2GC
+#
+from optparse import OptionParser
+
+
+#
+# LIBS
+#
+
+global heavy_modules
+
+# top level packages that the CLI paths must not import
+#
+heavy_modules = ['casatasks','casatools','casacore','astropy','bdsf','matplotlib']
+
+
+def run_path(script,argv,cwd,env,resultfile):
+    """
+    run a script in a fresh interpreter, returns the wall time [s]
+    and the imported heavy modules
+    """
+    code = 'import sys, json, runpy\n'+\
+           'sys.argv = '+repr([script]+argv)+'\n'+\
+           'try:\n'+\
+           '    runpy.run_path('+repr(script)+',run_name="__main__")\n'+\
+           'except SystemExit:\n'+\
+           '    pass\n'+\
+           'loaded = sorted(set([m.split(".")[0] for m in sys.modules]) & set('+repr(heavy_modules)+'))\n'+\
+           'json.dump(loaded,open('+repr(resultfile)+',"w"))\n'
+
+    if os.path.exists(resultfile):
+        os.remove(resultfile)
+
+    t_start = time.time()
+    subprocess.run([sys.executable,'-c',code],cwd=cwd,env=env,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+    t_wall  = time.time() - t_start
+
+    loaded  = C2GC.get_json(resultfile) if os.path.exists(resultfile) else ['no result']
+
+    return t_wall, loaded
+
+
+def main():
+
+    # argument parsing
+    #
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--BUDGET', dest='budget', default=1.0, type=float,
+                      help='startup budget per path in s [default 1.0]')
+
+    parser.add_option('--NREPEAT', dest='nrepeat', default=3, type=int,
+                      help='number of runs per path, the best is used [default 3]')
+
+    parser.add_option('--OUTPUT', dest='output', default='', type=str,
+                      help='save the results in a JSON file [default no]')
+
+    # ----
+
+    (opts, args)         = parser.parse_args()
+
+    codedir  = os.path.dirname(os.path.abspath(__file__))+'/'
+    benchdir = tempfile.mkdtemp(prefix='2GC_STARTUP_BENCH_')+'/'
+
+    # synthetic MS for the plan (see BENCHMARK_2GC_PIPELINE)
+    #
+    import BENCHMARK_2GC_PIPELINE
+    MSFILE = 'STUB.ms'
+    BENCHMARK_2GC_PIPELINE.make_stub_ms(MSFILE,benchdir,ms_size_mb=1)
+    os.makedirs(benchdir+'2GC',exist_ok=True)
+    shutil.copy(codedir+'IMAGING_2GC_DEFAULTS.json',benchdir+'2GC/')
+
+    env = dict(os.environ)
+    env['C2GC_BACKEND'] = 'stub'
+    env['PYTHONPATH']   = codedir + (':'+env['PYTHONPATH'] if 'PYTHONPATH' in env else '')
+
+    paths = []
+    paths.append(['IMAGING_and_2GC --help','IMAGING_and_2GC.py',['--help']])
+    paths.append(['IMAGING_and_2GC --PLAN','IMAGING_and_2GC.py',['--MS_FILE='+MSFILE,'--WORK_DIR='+benchdir,'--DOSELFCAL',\
+                      '--IMAG_PARA_SPWDS=0,1,2,3','--PLAN']])
+    paths.append(['APPLY_CALIB_SPLIT --help','APPLY_CALIB_SPLIT.py',['--help']])
+    paths.append(['CASA_IMAGING_MS (usage)','CASA_IMAGING_MS.py',[]])
+
+    results = {}
+    failed  = False
+    print('\n{:30s} {:>10s} {:>10s}  {:s}'.format('path','best [s]','budget [s]','heavy modules'))
+    for name,script,argv in paths:
+        walls = []
+        for r in range(opts.nrepeat):
+            t_wall, loaded = run_path(codedir+script,argv,benchdir,env,benchdir+'loaded.json')
+            walls.append(t_wall)
+
+        ok = min(walls) <= opts.budget and len(loaded) == 0
+        failed = failed or not ok
+        results[name] = {'best_s':min(walls),'median_s':sorted(walls)[len(walls)//2],'heavy_modules':loaded,'ok':ok}
+        print('{:30s} {:10.3f} {:10.3f}  {:s}{:s}'.format(name,min(walls),opts.budget,','.join(loaded),'' if ok else '  FAILED'))
+
+    print('\n')
+
+    if len(opts.output) > 0:
+        C2GC.save_to_json({'budget_s':opts.budget,'paths':results},opts.output,'')
+
+    shutil.rmtree(benchdir,ignore_errors=True)
+
+    if failed:
+        print('Startup budget exceeded or heavy modules imported')
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Calibration part of CAL2GC_lib
+#
+# - gain solutions (gaincal or GAINSOLVE_lib), apply (applycal or
+#   APPLYCAL_lib) and split
+#
+# - quality of the solutions (CALSTATS_lib) and the bad antenna
+#   handling (BADANT_lib)
+#
+import os
+import sys
+import glob
+import copy
+import time
+import shutil
+
+import PROFILE_lib as PROF
+import BACKEND_lib as BACKEND
+import CALSTATS_lib as CALSTATS
+import BADANT_lib as BADANT
+
+from CAL2GC_CONFIG_lib import record_step_timing
+
+
+#
+# LIBS
+#
+
+@PROF.traced()
+def delmodel(MSFILE,homedir):
+    """
+    use the casa task do delete the model data
+    """
+    msfile = homedir + MSFILE
+
+    t_start = time.time()
+    BACKEND.casa('delmod',vis=msfile,otf=True,scr=False)
+    record_step_timing('casa_delmod',time.time()-t_start,MSFILE,homedir)
+
+    return []
+
+
+def solve_gains(msfile,caltab,solint,calmode,refant,uvrange,addgaintable=[],addinterp=[],solver='casa',timerange=''):
+    """
+    produces the caltable
+    (the native solver always solves the entire observation)
+    """
+    if solver == 'native' and calmode == 'p' and BACKEND.backend_name == 'real':
+        import GAINSOLVE_lib as GAINSOLVE
+        datacolumn = 'CORRECTED_DATA' if len(addgaintable) > 0 else 'DATA'
+        flagged    = GAINSOLVE.gaincal_phase(msfile,caltab,solint,refant,uvrange,minsnr=3,datacolumn=datacolumn)
+        print('Native phase solutions ',caltab,' flagged fraction ',flagged)
+    else:
+        BACKEND.casa('gaincal',vis=msfile,uvrange=uvrange,caltable=caltab,gaintype='T',solnorm=False,solint=solint,refant=refant,\
+                              calmode=calmode,combine='',minsnr=3,gaintable=addgaintable,interp=addinterp,timerange=timerange)
+
+
+def flag_bad_antennas(msfile,caltab,solint,calmode,refant,uvrange,addgaintable=[],addinterp=[],solver='casa',nsigma=5.):
+    """
+    flags antennas or time ranges with outlier solutions in the MS
+    and re-solves the affected time ranges
+    returns the decisions
+    """
+    decisions = BADANT.find_bad_antennas(caltab,refant,nsigma,calmode)
+    BADANT.print_decisions(decisions,caltab)
+    BADANT.save_decisions(decisions,caltab.rstrip('/')+'_BADANT.json')
+
+    commands = BADANT.flag_commands(decisions)
+    if len(commands) == 0:
+        return decisions
+
+    # a single flagdata call for all decisions
+    #
+    BACKEND.casa('flagdata',vis=msfile,mode='list',inpfile=commands,flagbackup=False)
+
+    timerange = BADANT.resolve_timerange(decisions)
+    if len(timerange) == 0 or solver == 'native':
+        shutil.rmtree(caltab,ignore_errors=True)
+        solve_gains(msfile,caltab,solint,calmode,refant,uvrange,addgaintable,addinterp,solver)
+        print('Re-solved ',caltab,' entire observation')
+    else:
+        resolved_caltab = caltab.rstrip('/')+'_RESOLVED'
+        shutil.rmtree(resolved_caltab,ignore_errors=True)
+        solve_gains(msfile,resolved_caltab,solint,calmode,refant,uvrange,addgaintable,addinterp,solver,timerange)
+        removed, added = BADANT.merge_caltable(caltab,resolved_caltab,decisions)
+        shutil.rmtree(resolved_caltab,ignore_errors=True)
+        print('Re-solved ',caltab,' time ranges ',timerange,' replaced ',removed,' by ',added,' solutions')
+
+    return decisions
+
+
+@PROF.traced()
+def calib_data(MSFILE,CALTAB,homedir,solint,calmode,refant,uvrange,inter='nearest',addgaintable=[],addinterp=[],solver='casa',applycal='casa',max_flagged=1.,badant_nsigma=0):
+    """
+    calibrates the data and applies it
+
+    the caltable is rejected (not applied and not added to the
+    sequence) if more than max_flagged of the solutions are flagged
+
+    badant_nsigma > 0 flags antennas and time ranges with outlier
+    solutions and re-solves them before the apply
+
+    solver native uses the phase-only solver of GAINSOLVE_lib
+    for calmode p (the CORRECTED_DATA of the previous rounds
+    is used instead of applying the gaintables on the fly)
+
+    applycal native applies the tables with APPLYCAL_lib
+    """
+
+    msfile = homedir + MSFILE
+    caltab = homedir + CALTAB
+
+    t_start = time.time()
+
+    solve_gains(msfile,caltab,solint,calmode,refant,uvrange,addgaintable,addinterp,solver)
+
+    # optain the calibration sequence
+    #
+    n_addgaintable = copy.copy(addgaintable)
+    n_addinterp    = copy.copy(addinterp)
+
+    n_addgaintable.append(caltab)
+    n_addinterp.append(inter)
+    
+
+    # need to check if calib table is produced
+    checkiftabpresent = glob.glob(caltab)
+
+    if len(checkiftabpresent) == 0:
+        print('Seems that the calibration table has not been proceed',caltab)
+        sys.exit(-1)
+
+    # quality of the solutions
+    #
+    calstats = {}
+    if BACKEND.backend_name == 'real':
+        if badant_nsigma > 0:
+            decisions = flag_bad_antennas(msfile,caltab,solint,calmode,refant,uvrange,addgaintable,addinterp,solver,badant_nsigma)
+
+        calstats = CALSTATS.caltable_statistics(caltab)
+        if badant_nsigma > 0:
+            calstats['bad_antennas'] = decisions
+        CALSTATS.print_caltable_statistics(calstats)
+
+        if calstats['flagged_fraction'] > max_flagged:
+            print('Reject ',caltab,' flagged solutions ',calstats['flagged_fraction'],' exceed ',max_flagged)
+            calstats['rejected'] = True
+            record_step_timing('casa_calibration',time.time()-t_start,MSFILE,homedir)
+            return addgaintable,addinterp,calstats
+
+    if applycal == 'native' and BACKEND.backend_name == 'real':
+        import APPLYCAL_lib as APPLYCAL
+        APPLYCAL.apply_gaintables(msfile,n_addgaintable,n_addinterp)
+    else:
+        BACKEND.casa('applycal',vis=msfile,gaintable=n_addgaintable,interp=n_addinterp,parang=False, calwt=False, flagbackup=False)
+
+    record_step_timing('casa_calibration',time.time()-t_start,MSFILE,homedir)
+
+    return n_addgaintable,n_addinterp,calstats
+
+
+@PROF.traced()
+def apply_calibration(MSFILE,MSOUTPUT,homedir,fieldid,gaintable=[],interp=[],applycal='casa'):
+    """
+    Apply the calibration and split the data
+    """
+
+    msfile    = homedir + MSFILE
+    outmsfile = homedir + MSOUTPUT
+
+    # apply all the calibration
+    if applycal == 'native' and BACKEND.backend_name == 'real':
+        import APPLYCAL_lib as APPLYCAL
+        APPLYCAL.apply_gaintables(msfile,gaintable,interp)
+    else:
+        BACKEND.casa('applycal',vis=msfile,gaintable=gaintable,interp=interp,parang=False, calwt=False, flagbackup=False)
+
+    # generates a new dataset with corrected DATA column 
+    BACKEND.casa('split',vis=msfile,outputvis=outmsfile,keepmms=True,field=fieldid,spw="",scan="",antenna="",correlation="",timerange="",intent="",array="",uvrange="",observation="",feed="",datacolumn="corrected",keepflags=True,width=1,timebin="0s",combine="")
+
+
+@PROF.traced()
+def plot_calsolutions(caltab,homedir,caltype,figurename,calstats={}):
+    """
+    PNG summary of the solutions of a caltable
+    """
+    if BACKEND.backend_name != 'real':
+        return []
+
+    caltable = homedir+caltab
+    if len(calstats) == 0:
+        calstats = CALSTATS.caltable_statistics(caltable)
+
+    return [CALSTATS.plot_caltable(caltable,calstats,figurename,homedir,caltype)]
+
+
+@PROF.traced()
+def plot_check_cal(MSFILE,homedir,plotype,figurename):
+    """
+    """
+    t_start = time.time()
+
+    # plot mean of the corrected data and the model
+    shadeit = 'shadems --corr XX,YY --iter-corr -x ANTENNA1 -y ANTENNA2 --cmap coolwarm --aaxis CORRECTED_DATA-MODEL_DATA:'+plotype+' --ared mean --dir '+homedir+' --suffix '+figurename+' '+homedir+MSFILE
+    BACKEND.shadems(shadeit,homedir,figurename)
+    # plot the std 
+    shadeit = 'shadems --corr XX,YY --iter-corr -x ANTENNA1 -y ANTENNA2 --cmap coolwarm --aaxis CORRECTED_DATA-MODEL_DATA:'+plotype+' --ared std --dir '+homedir+' --suffix '+figurename+' '+homedir+MSFILE
+    BACKEND.shadems(shadeit,homedir,figurename)
+
+    record_step_timing('shadems',time.time()-t_start,MSFILE,homedir)
+
+    get_files = sorted(glob.glob(homedir+'*'+figurename+'*.png'),key=os.path.getmtime)
+
+    return get_files
@@ -0,0 +1,819 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Configuration part of CAL2GC_lib
+#
+# - JSON input and output, the imaging default file is loaded once,
+#   checked against a schema and the wsclean options are normalised
+#   ('-weight briggs': -0.5 becomes '-weight': 'briggs -0.5')
+#
+# - the wsclean parameter of the stages are compiled once into
+#   templates, the rounds only fill in their specific values
+#
+# - the self-calibration settings
+#
+# - the runtime records of the steps (step_timings)
+#
+# needs NumPy only, no CASA, astropy or PyBDSF
+#
+import os
+import sys
+import glob
+import json
+import copy
+import time
+
+import numpy as np
+
+import MSINFO_lib as MSINFO
+import BACKEND_lib as BACKEND
+import ARTIFACT_lib as ARTIFACT
+import PROGRESS_lib as PROGRESS
+
+
+#
+# LIBS
+#
+
+global python_def, step_timings
+
+python_def = 'python3'
+
+step_timings = []
+
+# self-calibration input that is provided per round
+#
+selfcal_perround_keys = ['selfcal_data','selfcal_interp','selfcal_niter','selfcal_gain','selfcal_mgain',\
+                             'selfcal_usemaskfile','selfcal_addwscleancommand','selfcal_imsize','selfcal_scale']
+
+# per round input that may be missing (0 uses the imaging input)
+#
+selfcal_perround_defaults = {'selfcal_imsize':[0],'selfcal_scale':[0]}
+
+# FWHM of the uv taper in pixel of the coarser self-calibration rounds
+#
+selfcal_taper_pixels = 4
+
+# adaptive channels-out and spectral polynomial (SPECTRAL_SETTING)
+#
+spectral_defaults = {'adaptive':False,'max_subband_fraction_p':0.15,'max_subband_fraction_ap':0.05,'min_channel_snr':30}
+
+# order of the spectral polynomial up to a fractional bandwidth
+#
+spectral_pol_limits = [[0.1,1],[0.3,2],[0.6,3]]
+
+# baseline-dependent averaging (BASELINE_AVERAGING), max_smearing is
+# the amplitude loss by time smearing at the image corners
+#
+baseline_averaging_defaults = {'selfcal':True,'final':True,'max_smearing':0.01}
+
+# schema of the imaging default file (IMAGING_2GC_DEFAULTS.json),
+# the sections and their inputs with the accepted types
+# (ARTIFACT_RETENTION is checked by ARTIFACT_lib)
+#
+required_sections = ['IMAGING_DEFAULT','ADD_WSCLEAN_COMMAND','SELFCAL_PARAMETER','ADD_SELFCAL_WSCLEAN_COMMAND']
+
+input_schema = {}
+input_schema['IMAGING_DEFAULT']             = {'wsclean_para':dict}
+input_schema['ADD_WSCLEAN_COMMAND']         = {'wsclean_para':dict}
+input_schema['ADD_SELFCAL_WSCLEAN_COMMAND'] = {'wsclean_para':dict}
+input_schema['SELFCAL_PARAMETER']           = {'selfcal_modes':list,'selfcal_solint':list,'ref_ant':str,'uvrange':str,\
+                                                   'selfcal_data':list,'selfcal_interp':list,'selfcal_usemaskfile':list,\
+                                                   'selfcal_addwscleancommand':list,'selfcal_niter':list,'selfcal_gain':list,\
+                                                   'selfcal_mgain':list,'selfcal_imsize':list,'selfcal_scale':list,\
+                                                   'selfcal_threshold':(int,float),'selfcal_auto-threshold':(int,float),\
+                                                   'selfcal_weighting':(int,float),'selfcal_flagstats':bool,'selfcal_solver':str,\
+                                                   'selfcal_applycal':str,'selfcal_resiflag':bool,'selfcal_resiflag_nsigma':(int,float),\
+                                                   'selfcal_flag_memory_mb':(int,float),\
+                                                   'selfcal_max_flagged_solutions':(int,float),'selfcal_badant_nsigma':(int,float)}
+input_schema['SPECTRAL_SETTING']            = {'adaptive':bool,'max_subband_fraction_p':(int,float),\
+                                                   'max_subband_fraction_ap':(int,float),'min_channel_snr':(int,float)}
+input_schema['BASELINE_AVERAGING']          = {'selfcal':bool,'final':bool,'max_smearing':(int,float)}
+input_schema['ARTIFACT_RETENTION']          = dict
+
+# wsclean options accepted in the wsclean_para sections
+#
+wsclean_options = ['-j','-parallel-gridding','-parallel-reordering','-parallel-deconvolution','-deconvolution-threads',\
+                       '-no-work-on-master','-mem','-abs-mem','-verbose','-quiet','-log-time','-temp-dir','-reorder','-no-reorder',\
+                       '-update-model-required','-no-update-model-required','-no-dirty','-save-first-residual','-save-weights',\
+                       '-save-uv','-reuse-psf','-reuse-dirty','-apply-primary-beam','-reuse-primary-beam','-primary-beam-limit',\
+                       '-save-psf-pb','-pb-undersampling','-beam-model','-beam-mode','-beam-normalisation-mode','-dry-run',\
+                       '-direct-allocation','-weight','-super-weight','-mf-weighting','-no-mf-weighting','-weighting-rank-filter',\
+                       '-weighting-rank-filter-size','-taper-gaussian','-taper-tukey','-taper-inner-tukey','-taper-edge',\
+                       '-taper-edge-tukey','-use-weights-as-taper','-store-imaging-weights','-name','-size','-padding','-scale',\
+                       '-predict','-continue','-subtract-model','-gridder','-channels-out','-shift','-gap-channel-division',\
+                       '-channel-division-frequencies','-nwlayers','-nwlayers-factor','-nwlayers-for-size','-no-small-inversion',\
+                       '-small-inversion','-grid-mode','-kernel-size','-oversampling','-make-psf','-make-psf-only',\
+                       '-visibility-weighting-mode','-no-normalize-for-weighting','-baseline-averaging','-simulate-noise',\
+                       '-idg-mode','-wgridder-accuracy','-aterm-config','-aterm-kernel-size','-save-aterms','-grid-with-beam',\
+                       '-beam-aterm-update','-facet-regions','-apply-facet-solutions','-apply-facet-beam','-facet-beam-update',\
+                       '-diagonal-solutions','-pol','-interval','-intervals-out','-even-timesteps','-odd-timesteps','-field',\
+                       '-spws','-data-column','-maxuvw-m','-minuvw-m','-maxuv-l','-minuv-l','-maxw','-niter','-nmiter',\
+                       '-threshold','-auto-threshold','-auto-mask','-force-mask-rounds','-local-rms','-local-rms-window',\
+                       '-local-rms-method','-gain','-mgain','-join-polarizations','-link-polarizations','-join-channels',\
+                       '-spectral-correction','-no-fast-subminor','-multiscale','-multiscale-scale-bias','-multiscale-max-scales',\
+                       '-multiscale-scales','-multiscale-shape','-multiscale-gain','-multiscale-convolution-padding','-iuwt',\
+                       '-iuwt-snr-test','-no-iuwt-snr-test','-save-source-list','-clean-border','-fits-mask','-casa-mask',\
+                       '-horizon-mask','-no-negative','-negative','-stop-negative','-fit-spectral-pol','-fit-spectral-log-pol',\
+                       '-force-spectrum','-deconvolution-channels','-squared-channel-joining','-parallel-deconvolution-max-size',\
+                       '-trim','-beam-size','-beam-shape','-fit-beam','-no-fit-beam','-beam-fitting-size','-circular-beam',\
+                       '-elliptical-beam','-theoretic-beam','-draw-model','-draw-frequencies','-draw-spectral-terms']
+
+# options with a file or directory as value (not split at spaces)
+#
+wsclean_path_options = ['-temp-dir','-fits-mask','-casa-mask','-facet-regions','-aterm-config','-apply-facet-solutions',\
+                            '-name','-beam-model']
+
+# options that are set by the pipeline and options that cannot be used together
+#
+wsclean_reserved  = ['-name','-predict','-continue','-dry-run']
+
+wsclean_conflicts = [['-reorder','-no-reorder'],['-mf-weighting','-no-mf-weighting'],\
+                         ['-update-model-required','-no-update-model-required'],['-fit-beam','-no-fit-beam'],\
+                         ['-small-inversion','-no-small-inversion'],['-multiscale','-iuwt'],['-fits-mask','-casa-mask'],\
+                         ['-negative','-no-negative'],['-make-psf','-make-psf-only'],['-fit-spectral-pol','-fit-spectral-log-pol']]
+
+
+# this class is for json dump
+# https://stackoverflow.com/questions/75475315/python-return-json-dumps-got-error-typeerror-object-of-type-int32-is-not-json
+# https://docs.python.org/3/library/json.html
+#
+class NumpyArrayEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        elif isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        else:
+            return super().default(obj)
+
+
+def save_to_json(data,dodatainfoutput,homedir):
+    """
+    safe information into a json file
+    """
+
+    with open(homedir + dodatainfoutput, 'w') as fout:
+        json_dumps_str = json.dumps(data,indent=4,sort_keys=False,separators=(',', ': '),cls=NumpyArrayEncoder)
+        print(json_dumps_str, file=fout)
+    return homedir + dodatainfoutput
+
+
+def get_json(filename,homedir=''):
+    """
+    get json info
+    """
+
+    with open(homedir+filename) as f:
+        jsondata = json.load(f)
+
+    return jsondata
+
+
+def get_list_index(list,value):
+    """
+    Still strange that there is not a good function to do that
+    """
+
+    indices = [i for i, x in enumerate(list) if x == value]
+
+    return indices
+
+
+def concat_dic(dic_a,dic_b):
+    """
+    """
+    c_dic = {}
+    
+    for w in dic_a.keys():
+        c_dic[w] = dic_a[w]
+
+    for w in dic_b.keys():
+        c_dic[w] = dic_b[w]
+    
+    return c_dic
+
+
+def get_selfcal_default_para(filename,homedir):
+    """
+    """
+    full_input_information = get_json(filename,homedir)['SELFCAL_PARAMETER']
+    selfcal_para = full_input_information
+
+    return selfcal_para
+
+
+def normalize_wsclean_option(option,value):
+    """
+    option name and value string of a wsclean input
+    ('-weight briggs': -0.5 becomes '-weight', 'briggs -0.5',
+    true and empty values are switches, false returns None,
+    lists are comma separated e.g. -multiscale-scales)
+    """
+    words = str(option).split()
+    if len(words) == 0 or value is False or value is None:
+        return (words[0] if len(words) > 0 else ''), None
+
+    if value is True:
+        value = ''
+    elif isinstance(value,(list,tuple)):
+        value = ','.join([str(v) for v in value])
+    else:
+        value = str(value).strip()
+
+    return words[0], ' '.join(words[1:] + ([value] if len(value) > 0 else []))
+
+
+def normalize_wsclean_para(wsc_para):
+    """
+    wsclean parameter with normalised option names and values
+    returns the parameter and the errors (the same option given twice)
+    """
+    norm_para, errors, given = {}, [], {}
+
+    for k in wsc_para.keys():
+        option, value = normalize_wsclean_option(k,wsc_para[k])
+        if option in given:
+            errors.append('wsclean option '+option+' is given twice as '+repr(given[option])+' and '+repr(k))
+        given[option] = k
+        if value != None:
+            norm_para[option] = value
+
+    return norm_para, errors
+
+
+def check_wsclean_para(wsc_para,name='',user_input=True):
+    """
+    check normalised wsclean parameter
+    unknown, reserved (user_input) and conflicting options
+    returns the errors
+    """
+    errors = []
+
+    for option in wsc_para.keys():
+        if not option.startswith('-') or option not in wsclean_options:
+            errors.append(name+' unknown wsclean option '+repr(option))
+        elif user_input and option in wsclean_reserved:
+            errors.append(name+' wsclean option '+option+' is set by the pipeline')
+
+    for a,b in wsclean_conflicts:
+        if a in wsc_para and b in wsc_para:
+            errors.append(name+' wsclean options '+a+' and '+b+' cannot be used together')
+
+    return errors
+
+
+def validate_input(iminput):
+    """
+    check the imaging default input against the schema and
+    normalise the wsclean options
+    returns the normalised input and the errors
+    """
+    iminput, errors = copy.deepcopy(iminput), []
+
+    for section in required_sections:
+        if section not in iminput:
+            errors.append('Imaging default file misses section '+section)
+
+    for section in iminput.keys():
+        if section not in input_schema:
+            errors.append('Imaging default file unknown section '+section+' use '+str(list(input_schema.keys())))
+            continue
+
+        schema = input_schema[section]
+        if not isinstance(iminput[section],dict):
+            errors.append(section+' needs to be a dictionary')
+            continue
+        if not isinstance(schema,dict):
+            continue
+
+        for k in iminput[section].keys():
+            if k not in schema:
+                errors.append(section+' unknown input '+k)
+            elif not isinstance(iminput[section][k],schema[k]) or (schema[k] != bool and isinstance(iminput[section][k],bool)):
+                errors.append(section+' '+k+' wrong type '+type(iminput[section][k]).__name__+' '+str(iminput[section][k]))
+
+        if 'wsclean_para' in schema and isinstance(iminput[section].get('wsclean_para',{}),dict):
+            iminput[section]['wsclean_para'], norm_errors = normalize_wsclean_para(iminput[section].get('wsclean_para',{}))
+            errors += [section+' '+e for e in norm_errors]
+            errors += check_wsclean_para(iminput[section]['wsclean_para'],section,section != 'IMAGING_DEFAULT')
+
+    if len(errors) > 0:
+        return iminput, errors
+
+    # the user input on top of the defaults
+    #
+    for section in ['ADD_WSCLEAN_COMMAND','ADD_SELFCAL_WSCLEAN_COMMAND']:
+        errors += check_wsclean_para(concat_dic(iminput['IMAGING_DEFAULT']['wsclean_para'],iminput[section]['wsclean_para']),\
+                                         'IMAGING_DEFAULT and '+section,False)
+
+    if 'ARTIFACT_RETENTION' in iminput:
+        errors += ARTIFACT.validate_retention_rules(iminput['ARTIFACT_RETENTION'])
+
+    if not 0 < iminput.get('BASELINE_AVERAGING',{}).get('max_smearing',0.01) < 1:
+        errors.append('BASELINE_AVERAGING max_smearing needs to be within 0 and 1')
+
+    for k in iminput.get('SPECTRAL_SETTING',{}):
+        if k != 'adaptive' and not iminput['SPECTRAL_SETTING'][k] > 0:
+            errors.append('SPECTRAL_SETTING '+k+' needs to be positive')
+
+    return iminput, errors
+
+
+def load_input(filename,homedir=''):
+    """
+    load and check the imaging default file (once per run)
+    returns the normalised input and the errors
+    """
+    try:
+        iminput = get_json(filename,homedir)
+    except (OSError,ValueError) as exc:
+        return {}, ['Imaging default file '+homedir+filename+' cannot be read '+str(exc)]
+
+    return validate_input(iminput)
+
+
+def make_wsclean_template(base_para,stage_para,user_para):
+    """
+    template of a stage, the user input is fixed and not
+    replaced by the values of the rounds
+    """
+    template = {}
+    template['para']  = concat_dic(concat_dic(base_para,stage_para),user_para)
+    template['fixed'] = list(user_para.keys()) + [k for k in ['-taper-gaussian','-fit-spectral-pol'] if k in base_para]
+
+    return template
+
+
+def fill_wsclean_template(template,round_para):
+    """
+    wsclean parameter of a round
+    """
+    return concat_dic(template['para'],{k:round_para[k] for k in round_para.keys() if k not in template['fixed']})
+
+
+def compile_wsclean_templates(full_default_wsclean_para,iminput,final_para,selfcal_para={}):
+    """
+    templates of the self-calibration (selfcal_mask, selfcal_model)
+    and the final imaging stage
+
+    final_para are the final imaging input
+    [datacol,weighting,imniter,imagegain,imthreshold]
+    """
+    templates = {'base':full_default_wsclean_para}
+
+    datacol, weighting, imniter, imagegain, imthreshold = final_para
+
+    if len(selfcal_para) > 0:
+        user_para  = iminput['ADD_SELFCAL_WSCLEAN_COMMAND']['wsclean_para']
+        stage_para = {'-weight':'briggs '+str(selfcal_para['selfcal_weighting']),'-threshold':str(selfcal_para['selfcal_threshold'])}
+        templates['selfcal_mask']  = make_wsclean_template(full_default_wsclean_para,concat_dic(stage_para,{'-no-update-model-required':''}),user_para)
+        templates['selfcal_model'] = make_wsclean_template(full_default_wsclean_para,concat_dic(stage_para,{'-save-source-list':''}),user_para)
+        datacol    = selfcal_para['selfcal_data'][-1]
+
+    stage_para = {}
+    stage_para['-data-column']              = datacol
+    stage_para['-weight']                   = 'briggs '+str(weighting)
+    stage_para['-niter']                    = str(imniter)
+    stage_para['-gain']                     = str(imagegain)
+    stage_para['-threshold']                = str(imthreshold)
+    stage_para['-no-update-model-required'] = ''
+    templates['final'] = make_wsclean_template(full_default_wsclean_para,stage_para,iminput['ADD_WSCLEAN_COMMAND']['wsclean_para'])
+
+    return templates
+
+
+def check_wsclean_templates(templates):
+    """
+    check the options of the compiled templates
+    returns the errors
+    """
+    errors = []
+    for stage in templates.keys():
+        if stage != 'base':
+            errors += check_wsclean_para(templates[stage]['para'],'wsclean '+stage,False)
+
+    return errors
+
+
+def get_wsclean_value(wsc_para,option,default=None):
+    """
+    return the value of a wsclean option
+    (also of not normalised keys e.g. '-size ')
+    """
+    for k in wsc_para.keys():
+        name, value = normalize_wsclean_option(k,wsc_para[k])
+        if name == option:
+            return value
+
+    return default
+
+
+def get_wsclean_imsize(wsc_para):
+    """
+    return the image size in pixel
+    """
+    size = get_wsclean_value(wsc_para,'-size','0 0').split()
+
+    return max([int(s) for s in size])
+
+
+def get_wsclean_chan_out(wsc_para):
+    """
+    return the number of output channels
+    """
+    return int(get_wsclean_value(wsc_para,'-channels-out','1'))
+
+
+def get_wsclean_spw_fraction(MSFILE,homedir,wsc_para):
+    """
+    return the fraction of the spectral windows used for imaging
+    """
+    spws = get_wsclean_value(wsc_para,'-spws')
+    if spws == None:
+        return 1.
+
+    n_spws = len([s for s in spws.split(',') if len(s.strip()) > 0])
+
+    return min(1.,n_spws/max(1,len(MSINFO.get_ms_metadata(MSFILE,homedir)['spw'])))
+
+
+def get_wsclean_scale(wsc_para):
+    """
+    return the pixel scale in arcsec
+    """
+    scale = get_wsclean_value(wsc_para,'-scale','1asec')
+    units = {'asec':1.,'amin':60.,'deg':3600.}
+    for u in units:
+        if scale.endswith(u):
+            return float(scale.replace(u,'')) * units[u]
+
+    return float(scale) * 3600.
+
+
+def record_step_timing(kind,seconds,MSFILE,homedir,imsize=0,chan_out=1,spw_fraction=1.):
+    """
+    keep the processing time of a step
+    used to estimate the runtime of later runs
+    (and the ETA of the progress of this run)
+    """
+    try:
+        ms_bytes = MSINFO.get_ms_metadata(MSFILE,homedir)['ms_size_bytes']
+    except Exception:
+        ms_bytes = 0
+
+    step_timings.append({'kind':kind,'seconds':seconds,'imsize':imsize,'chan_out':chan_out,\
+                             'spw_fraction':spw_fraction,'ms_bytes':ms_bytes,'time':time.time()})
+
+    PROGRESS.step_done(kind,seconds)
+
+
+def save_step_timings(homedir,history_file='2GC_RUNTIME_HISTORY.json'):
+    """
+    add the timings of this run to the runtime history
+    """
+    if os.path.exists(homedir+history_file):
+        history = get_json(history_file,homedir)
+    else:
+        history = []
+
+    history += step_timings
+
+    return save_to_json(history,history_file,homedir)
+
+
+def get_imaging_wsclean_para(iminput,imsize,bin_size,imstokes,chan_out,spwds,tuned_para={}):
+    """
+    default wsclean parameter of the MS used for all images
+
+    tuned_para (e.g. from the autotuner) replace the defaults
+    but not the additional inputs of the user 
+    """
+
+    # Get the default imaging parameter 
+    #
+    default_imaging_para = concat_dic(iminput['IMAGING_DEFAULT']['wsclean_para'],tuned_para)
+    #
+    # set some specific parameter from the input
+    # 
+    additional_wsclean_para = {}
+    additional_wsclean_para['-size']                  = str(imsize)+' '+str(imsize)
+    additional_wsclean_para['-scale']                 = str(bin_size)+'asec'
+    additional_wsclean_para['-pol']                   = imstokes
+    additional_wsclean_para['-channels-out']          = str(chan_out) 
+    additional_wsclean_para['-spws']                  = str(spwds)
+    #
+    # combine the defaults 
+    #
+    default_wsclean_para = concat_dic(default_imaging_para,additional_wsclean_para)
+
+    # add additional inputs from user
+    #
+    additional_imaging_para = iminput['ADD_WSCLEAN_COMMAND']['wsclean_para']
+    #
+    if len(additional_imaging_para) > 0:
+        full_default_wsclean_para = concat_dic(default_wsclean_para,additional_imaging_para)
+    else:
+        full_default_wsclean_para = default_wsclean_para
+
+    return full_default_wsclean_para
+
+
+def get_selfcal_geometry(full_default_wsclean_para,selfcal_para,sc):
+    """
+    image size and pixel scale [arcsec] of the self-calibration step sc
+    (with only a coarser scale the field of view is kept)
+    """
+    imsize = get_wsclean_imsize(full_default_wsclean_para)
+    scale  = get_wsclean_scale(full_default_wsclean_para)
+
+    sc_imsize = int(selfcal_para.get('selfcal_imsize',[0]*(sc+1))[sc])
+    sc_scale  = float(selfcal_para.get('selfcal_scale',[0]*(sc+1))[sc])
+
+    if sc_scale > 0 and sc_imsize == 0:
+        sc_imsize = 2 * int(np.ceil(imsize * scale / sc_scale / 2.))
+
+    return sc_imsize if sc_imsize > 0 else imsize, sc_scale if sc_scale > 0 else scale
+
+
+def spectral_polynomial(frac_bw):
+    """
+    order of the spectral polynomial (-fit-spectral-pol) of a fractional bandwidth
+    """
+    for limit,npol in spectral_pol_limits:
+        if frac_bw < limit:
+            return npol
+
+    return 4
+
+
+def get_spectral_setting(MSFILE,homedir,spwds,max_chan_out,calmode=None,snr=0,spectral_para={}):
+    """
+    channels-out and spectral polynomial of a self-calibration
+    round (calmode) or of the final image (calmode None)
+
+    the rounds use sub-bands of max_subband_fraction_p (ap) of the
+    frequency, limited by a channel snr of min_channel_snr, the
+    final image uses all spectral windows
+    """
+    para     = concat_dic(spectral_defaults,spectral_para)
+    chan_out = max_chan_out
+    frac_bw  = MSINFO.get_fractional_bandwidth(MSINFO.get_ms_metadata(MSFILE,homedir),spwds)
+
+    if para['adaptive'] and calmode != None:
+        subband  = para['max_subband_fraction_ap'] if 'a' in calmode else para['max_subband_fraction_p']
+        chan_out = int(np.ceil(frac_bw / subband))
+        if snr > 0:
+            chan_out = min(chan_out,int((snr / para['min_channel_snr'])**2))
+        chan_out = int(np.clip(chan_out,1,max_chan_out))
+
+    fit_spectral_pol = 0
+    if para['adaptive'] and chan_out > 1:
+        fit_spectral_pol = min(spectral_polynomial(frac_bw),chan_out)
+
+    return {'chan_out':chan_out,'fit_spectral_pol':fit_spectral_pol,'frac_bw':float(frac_bw),'snr':float(snr)}
+
+
+def get_baseline_averaging(MSFILE,homedir,wsc_para,max_smearing=0.01):
+    """
+    wsclean -baseline-averaging [wavelengths] of the image geometry
+
+    averaging over a phase range dphi reduces the amplitude by
+    dphi**2/24, at the image corner (radius theta) the uv track of
+    length L [wavelengths] causes dphi = 2 pi L theta, wsclean
+    averages each baseline up to a track length of nwavelengths
+    """
+    msinfo       = MSINFO.get_ms_metadata(MSFILE,homedir)
+
+    theta        = np.deg2rad(get_wsclean_imsize(wsc_para) * get_wsclean_scale(wsc_para) / 3600. / np.sqrt(2))
+    nwavelengths = np.sqrt(24. * max_smearing) / (2. * np.pi * max(theta,1E-12))
+
+    # track length of an integration on the longest baseline
+    # at the highest frequency
+    #
+    max_freq     = max([s['max_freq_hz'] for s in msinfo['spw']])
+    b_lambda     = msinfo['max_baseline_m'] * max_freq / 299792458.
+    track        = b_lambda * 2. * np.pi * max(msinfo['integration_time_s'],1E-3) / 86400.
+
+    bda = {}
+    bda['nwavelengths']            = float(nwavelengths)
+    bda['max_smearing']            = max_smearing
+    bda['factor_longest_baseline'] = float(max(1.,nwavelengths / max(track,1E-12)))
+    # baselines shorter than this average at least 2 integrations
+    bda['average_below_m']         = float(msinfo['max_baseline_m'] * nwavelengths / max(2. * track,1E-12))
+
+    return bda
+
+
+def set_baseline_averaging(MSFILE,homedir,wsc_para,bda_para={},stage='selfcal'):
+    """
+    add -baseline-averaging to the wsclean parameter of a stage
+    (selfcal or final), unless set by the user or not supported
+    returns the wsclean parameter and the setting
+    """
+    para = concat_dic(baseline_averaging_defaults,bda_para)
+
+    if not para[stage] or get_wsclean_value(wsc_para,'-baseline-averaging') != None or get_wsclean_value(wsc_para,'-gridder') == 'idg':
+        return wsc_para, {}
+
+    bda      = get_baseline_averaging(MSFILE,homedir,wsc_para,para['max_smearing'])
+    wsc_para = concat_dic(wsc_para,{'-baseline-averaging':'{:.3f}'.format(bda['nwavelengths'])})
+
+    return wsc_para, bda
+
+
+def get_round_snr(pybdsf_info):
+    """
+    snr of a round from the source finding (total flux density
+    over the residual noise), 0 if not available
+    """
+    try:
+        return float(pybdsf_info[0]) / float(pybdsf_info[1])
+    except (TypeError,ValueError,IndexError,ZeroDivisionError):
+        return 0.
+
+
+def get_selfcal_wsclean_para(templates,selfcal_para,sc,chan_out,mask_file=None,homedir='',fit_spectral_pol=0):
+    """
+    wsclean parameter of the self-calibration step sc
+    (fills the round specific values into the templates)
+
+    without a mask_file the parameter for the mask image (MKMASK)
+    otherwise for the model image (MODIM) are provided
+    """
+    base_para = templates['base']
+
+    round_para = {}
+
+    # image geometry of the round, coarser pixels with a matching taper
+    #
+    sc_imsize, sc_scale = get_selfcal_geometry(base_para,selfcal_para,sc)
+    round_para['-size']                     = str(sc_imsize)+' '+str(sc_imsize)
+    round_para['-scale']                    = str(sc_scale)+'asec'
+    if sc_scale > get_wsclean_scale(base_para):
+        round_para['-taper-gaussian']       = str(selfcal_taper_pixels * sc_scale)+'asec'
+
+    # spectral setting of the round
+    #
+    round_para['-channels-out']             = str(chan_out)
+    if fit_spectral_pol > 1:
+        round_para['-fit-spectral-pol']     = str(fit_spectral_pol)
+
+    round_para['-data-column']              = selfcal_para['selfcal_data'][sc]
+    round_para['-niter']                    = str(selfcal_para['selfcal_niter'][sc])
+    if mask_file == None:
+        round_para['-gain']                 = str(selfcal_para['selfcal_gain'][sc])
+    round_para['-mgain']                    = str(selfcal_para['selfcal_mgain'][sc])
+    if mask_file != None:
+        round_para['-fits-mask']            = homedir+mask_file
+    #
+    if chan_out > 1:
+        round_para['-join-channels']        = ''
+        round_para['-no-mf-weighting']      = ''
+
+    if mask_file == None:
+        return fill_wsclean_template(templates['selfcal_mask'],round_para)
+    else:
+        return fill_wsclean_template(templates['selfcal_model'],round_para)
+
+
+def get_final_wsclean_para(templates,chan_out,fit_spectral_pol=0):
+    """
+    wsclean parameter of the final image
+    """
+    round_para = {}
+    if fit_spectral_pol > 1:
+        round_para['-fit-spectral-pol']     = str(fit_spectral_pol)
+    if chan_out > 1:
+        round_para['-join-channels']        = ''
+        round_para['-no-mf-weighting']      = ''
+
+    return fill_wsclean_template(templates['final'],round_para)
+
+
+def uncalibrated_data_column(wsc_para,calibrated):
+    """
+    image DATA instead of CORRECTED_DATA as long as no caltable has
+    been applied (e.g. the first round was rejected)
+    returns the wsclean parameter and True if the column was replaced
+    """
+    if calibrated or get_wsclean_value(wsc_para,'-data-column') != 'CORRECTED_DATA':
+        return wsc_para, False
+
+    wsc_para = {k:v for k,v in wsc_para.items() if normalize_wsclean_option(k,v)[0] != '-data-column'}
+    wsc_para['-data-column'] = 'DATA'
+
+    return wsc_para, True
+
+
+def get_channel_frequencies(MSFILE,homedir,spwds,chan_out):
+    """
+    centre frequencies [Hz] of the wsclean output channels
+    the selected spectral windows are evenly split into chan_out
+    """
+    spw_freqs = MSINFO.get_spw_frequencies(MSINFO.get_ms_metadata(MSFILE,homedir),spwds)
+
+    return [float(np.mean(f)) for f in np.array_split(np.array(spw_freqs),chan_out) if len(f) > 0]
+
+
+def get_some_info(MSFILE,homedir):
+    """
+    return the source information of the MS (keys are the source names)
+    uses the cached MS meta data (see MSINFO_lib)
+    """
+    msinfo = MSINFO.get_ms_metadata(MSFILE,homedir)
+
+    msource_info = {}
+    for fid, source in enumerate(msinfo['source_names']):
+        msource_info[source] = {'field_id':fid,'field_dir_deg':msinfo['field_dir_deg'][fid]}
+
+    return msource_info
+
+
+def find_CASA_logfile(checkdir='HOME',homedir=''):
+    """
+    """
+
+    import os
+    import datetime
+
+    if BACKEND.backend_name != 'real':
+        return ''
+
+    user_home_dir  = os.environ[checkdir]
+    casa_log_files = sorted(glob.glob(user_home_dir+'/casa*log'), key=os.path.getmtime)
+    if len(casa_log_files) > 0:
+        latest_logfile = casa_log_files[-1]
+    else:
+        latest_logfile = ''
+
+    return latest_logfile
+
+
+def enlarge_selcal_input(selfcal_modes,scal_input_info,name=''):
+    """
+    enlarge the input with the latest entry of the data 
+    """
+    if len(selfcal_modes) != len(scal_input_info):
+        if len(scal_input_info) > len(selfcal_modes):
+            print('Caution self-calibration input ',name,' is longer than selfcal_modes and is truncated ',scal_input_info)
+        else:
+            print('Self-calibration input ',name,' is enlarged with its last entry ',scal_input_info)
+        scal_new_info = []
+        for i in range(len(selfcal_modes)):
+            if i >= len(scal_input_info)-1:
+                scal_new_info.append(scal_input_info[-1])
+            else:
+                scal_new_info.append(scal_input_info[i])
+    else:
+      scal_new_info = copy.copy(scal_input_info)
+
+    return scal_new_info
+
+
+def make_self_calinput_check(selfcal_modes,selfcal_solint,selfcal_interp,selfcal_niter,selfcal_mgain,selfcal_data,selfcal_usemaskfile,selfcal_addcommand):
+    """
+    check the input of the selfcalibration 
+    an error would result in a lot of waisted 
+    processing time
+    """
+    
+    sc_length    = len(selfcal_modes)
+
+    sc_settings  = [selfcal_solint,selfcal_interp,selfcal_niter,selfcal_mgain,selfcal_data,selfcal_usemaskfile,selfcal_addcommand]
+
+    bad_settings = []
+    for scm in sc_settings:
+        if len(scm) != sc_length:
+            bad_settings.append(scm)
+
+    
+    if len(bad_settings) > 0:
+        print('Something in the Self-Calibration setting is not correct, please check: ')
+        print(bad_settings)
+        sys.exit(-1)
+
+
+def get_selfcal_settings(default_selfcal_para):
+    """
+    resolve the self-calibration input, the per round
+    settings are enlarged to the number of rounds
+    """
+    selfcal_para  = copy.deepcopy(default_selfcal_para)
+    selfcal_modes = selfcal_para['selfcal_modes']
+
+    for k in selfcal_perround_keys:
+        selfcal_para[k] = enlarge_selcal_input(selfcal_modes,default_selfcal_para.get(k,selfcal_perround_defaults.get(k)),k)
+
+    make_self_calinput_check(selfcal_modes,selfcal_para['selfcal_solint'],selfcal_para['selfcal_interp'],selfcal_para['selfcal_niter'],\
+                                 selfcal_para['selfcal_mgain'],selfcal_para['selfcal_data'],selfcal_para['selfcal_usemaskfile'],\
+                                 selfcal_para['selfcal_addwscleancommand'])
+
+    return selfcal_para
@@ -0,0 +1,69 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Imaging part of CAL2GC_lib (wsclean)
+#
+import os
+import glob
+import time
+import shlex
+
+import PROFILE_lib as PROF
+import BACKEND_lib as BACKEND
+
+from CAL2GC_CONFIG_lib import record_step_timing, get_wsclean_imsize, get_wsclean_chan_out, get_wsclean_spw_fraction
+from CAL2GC_CONFIG_lib import normalize_wsclean_option, wsclean_path_options
+
+
+#
+# LIBS
+#
+
+def wsclean_argv(MSFILE,outname,homedir,wsc_para):
+    """
+    combines the wsclean parameter into the argument list
+    (each option and value is a separate argument, no shell)
+    """
+    argv = ['wsclean']
+
+    for k in wsc_para.keys():
+        option, value = normalize_wsclean_option(k,wsc_para[k])
+        if value == None:
+            continue
+        argv.append(option)
+        if option in wsclean_path_options:
+            argv += [value] if len(value) > 0 else []
+        else:
+            argv += value.split()
+
+    argv += ['-name',homedir+outname,homedir+MSFILE]
+
+    return argv
+
+
+def wsclean_command(MSFILE,outname,homedir,wsc_para):
+    """
+    the wsclean command line (e.g. for the plan)
+    """
+    return ' '.join([shlex.quote(a) for a in wsclean_argv(MSFILE,outname,homedir,wsc_para)])
+
+
+@PROF.traced()
+def make_image(MSFILE,outname,homedir,wsc_para):
+    """
+    combines the wsclean parameter and start the imaging
+    """
+
+    t_start = time.time()
+
+    BACKEND.wsclean(MSFILE,outname,homedir,wsc_para,wsclean_argv(MSFILE,outname,homedir,wsc_para))
+
+    record_step_timing('wsclean',time.time()-t_start,MSFILE,homedir,imsize=get_wsclean_imsize(wsc_para),\
+                           chan_out=get_wsclean_chan_out(wsc_para),spw_fraction=get_wsclean_spw_fraction(MSFILE,homedir,wsc_para))
+
+    return sorted(glob.glob(homedir+outname+'*fits'),key=os.path.getmtime)
@@ -0,0 +1,210 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Masking part of CAL2GC_lib
+#
+# - FITS masks of the self-calibration rounds (wsclean image, PyBDSF
+#   region file and the CASA makemask)
+#
+# - regrid of user masks onto the geometry of a round (astropy)
+#
+import os
+import time
+import shutil
+
+import numpy as np
+
+import PROFILE_lib as PROF
+import BACKEND_lib as BACKEND
+import ARTIFACT_lib as ARTIFACT
+
+from CAL2GC_CONFIG_lib import record_step_timing
+from CAL2GC_IMAGING_lib import make_image
+from CAL2GC_SOURCEFINDING_lib import make_region_file
+from CAL2GC_STATS_lib import get_fits_imsize
+
+
+#
+# LIBS
+#
+
+@PROF.traced()
+def make_mask(image_fits_file,regionfile,fitsoutput_mask,sc_marker=0,homedir='',delete_ms_images=False):
+    """
+    generates a mask from an image file
+    requires need a region file
+    """
+    
+    casa_image_file     = homedir + image_fits_file.replace('.fits','').replace('.FITS','') +'_ORG.IM'
+
+    image_fits_file     = homedir + image_fits_file
+
+    regionfile          = homedir + regionfile
+    
+    fitsoutput_filename =  fitsoutput_mask + '_' + str(sc_marker)+'.fits'
+
+    fitsoutput_mask     = homedir + fitsoutput_mask + '_' + str(sc_marker)
+
+    t_start             = time.time()
+
+    # import a fits image
+    BACKEND.casa('importfits',fitsimage=image_fits_file,imagename=casa_image_file,whichrep=0,whichhdu=-1,zeroblanks=True,overwrite=False,defaultaxes=False,defaultaxesvalues=[],beam=[])
+    
+    # generate a mask with the imagea nd a region file
+    BACKEND.casa('makemask',mode='copy',inpimage=casa_image_file,inpmask=regionfile,output=fitsoutput_mask,overwrite=False,inpfreqs=[],outfreqs=[])
+
+    # export the mask file
+    BACKEND.casa('exportfits',imagename=fitsoutput_mask,fitsimage=homedir+fitsoutput_filename,velocity=False,optical=False,bitpix=-32,minpix=0,maxpix=-1,overwrite=False,dropstokes=False,stokeslast=True,history=True,dropdeg=False)
+
+    record_step_timing('casa_makemask',time.time()-t_start,'','',imsize=get_fits_imsize(image_fits_file))
+
+    # delete all produced files except the outfile
+    #
+    if delete_ms_images == True:
+        files_to_remove = [casa_image_file,fitsoutput_mask]
+        for delfiles in files_to_remove:
+            ARTIFACT.delete(delfiles)
+
+    return fitsoutput_filename
+
+
+@PROF.traced()
+def masking(MSFILE,outname,homedir,wsclean_para_ma,sc_marker=0,dodelmaskimages=False):
+    """
+    generates a fits image mask
+    """
+
+    # Generate an image via (wsclean)
+    #
+    image_files         = make_image(MSFILE,outname,homedir,wsclean_para_ma)
+    
+    if len(image_files) > 5:
+        for f in image_files:
+            if f == homedir+outname+'-MFS-image.fits':
+                # indicate image to be used for source finiding
+                MFS_image      = image_files[image_files.index(homedir+outname+'-MFS-image.fits')].replace(homedir,'')
+    else:
+        MFS_image      = image_files[image_files.index(homedir+outname+'-image.fits')].replace(homedir,'')
+
+    # source finding useing Jonah's software and setting (pybdsf)
+    pybdsf_dir,region_file,tot_flux_model,std_resi  = make_region_file(MFS_image,homedir)
+
+    # copy region file 
+    #
+    shutil.copy(homedir+pybdsf_dir+'/'+region_file,homedir)
+
+
+    # generate FITS image mask
+    #
+    delete_ms_images = True
+    fitsoutput_mask  = 'SC'+str(sc_marker)+'_MASK'
+    mask_fits_file   = make_mask(MFS_image,region_file,fitsoutput_mask,sc_marker,homedir,delete_ms_images)
+
+
+    # clean up all the files (retention rules of the mask images)
+    #
+    scdir = 'SC_'+str(sc_marker)+'_MK'+'/'
+    if dodelmaskimages == True:
+        ARTIFACT.store_products(outname,scdir,'mask_images',sc_marker,homedir)
+    else:
+        ARTIFACT.store_products(outname,scdir,'mask_images',sc_marker,homedir,rules=['keep_all'])
+
+
+    return mask_fits_file,tot_flux_model,std_resi
+
+
+def map_mask_pixels(x,y,wcs_from,wcs_to,ratio=None):
+    """
+    nearest pixels of the grid wcs_to of the pixels x,y of the grid
+    wcs_from, with the same reference position and projection the
+    pixels map linearly (ratio of the pixel sizes)
+    """
+    if ratio != None:
+        crpix_from, crpix_to = wcs_from.wcs.crpix - 1, wcs_to.wcs.crpix - 1
+        tx = (x - crpix_from[0]) * ratio + crpix_to[0]
+        ty = (y - crpix_from[1]) * ratio + crpix_to[1]
+    else:
+        tx,ty = wcs_to.wcs_world2pix(*wcs_from.wcs_pix2world(x,y,0),0)
+
+    return np.round(tx).astype(int), np.round(ty).astype(int)
+
+
+@PROF.traced()
+def regrid_mask(mask_file,imsize,scale,homedir='',block_pixels=2**20):
+    """
+    regrid a FITS mask onto the image geometry (imsize, scale in arcsec)
+    of a self-calibration round, same phase centre
+
+    the grids are mapped in blocks of rows (about block_pixels)
+    returns the (new) mask file (a single plane)
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+
+    if not os.path.exists(homedir+mask_file):
+        return mask_file
+
+    with fits.open(homedir+mask_file) as hdul:
+        header = hdul[0].header
+        mask   = hdul[0].data
+
+    if header['NAXIS1'] == imsize and header['NAXIS2'] == imsize and abs(abs(header['CDELT2']) * 3600. - scale) < 1E-6 * scale:
+        return mask_file
+
+    t_start  = time.time()
+
+    wcs_in   = WCS(header).celestial
+    header_out = header.copy()
+    header_out['NAXIS1'], header_out['NAXIS2'] = imsize, imsize
+    header_out['CRPIX1'], header_out['CRPIX2'] = imsize // 2 + 1, imsize // 2 + 1
+    header_out['CDELT1'] = np.sign(header['CDELT1']) * scale / 3600.
+    header_out['CDELT2'] = np.sign(header['CDELT2']) * scale / 3600.
+    wcs_out  = WCS(header_out).celestial
+
+    # same reference position and projection, same pixel size
+    # ratio on both axes: linear mapping of the pixels
+    #
+    ratio    = wcs_in.wcs.cdelt[0] / wcs_out.wcs.cdelt[0]
+    if not (list(wcs_in.wcs.ctype) == list(wcs_out.wcs.ctype) and np.allclose(wcs_in.wcs.crval,wcs_out.wcs.crval) and \
+                np.isclose(ratio,wcs_in.wcs.cdelt[1] / wcs_out.wcs.cdelt[1])):
+        ratio = None
+
+    mask_in  = mask.reshape((-1,)+mask.shape[-2:]).max(axis=0) > 0
+    mask_out = np.zeros((imsize,imsize),dtype=bool)
+
+    # masked input pixel into the output grid (coarser output)
+    #
+    block = max(1,block_pixels // mask_in.shape[1])
+    for r in range(0,mask_in.shape[0],block):
+        y, x  = np.nonzero(mask_in[r:r+block])
+        ox,oy = map_mask_pixels(x,y+r,wcs_in,wcs_out,ratio)
+        valid = (ox >= 0) & (ox < imsize) & (oy >= 0) & (oy < imsize)
+        mask_out[oy[valid],ox[valid]] = True
+
+    # output pixel centres from the input grid (finer output)
+    #
+    block = max(1,block_pixels // imsize)
+    ox    = np.tile(np.arange(imsize),block)
+    for r in range(0,imsize,block):
+        nrow  = min(block,imsize - r)
+        oy    = np.repeat(np.arange(r,r+nrow),imsize)
+        ix,iy = map_mask_pixels(ox[:nrow*imsize],oy,wcs_out,wcs_in,None if ratio == None else 1. / ratio)
+        valid = (ix >= 0) & (ix < mask_in.shape[1]) & (iy >= 0) & (iy < mask_in.shape[0])
+        mask_out[r:r+nrow].ravel()[np.flatnonzero(valid)] |= mask_in[iy[valid],ix[valid]]
+
+    # a single plane (NAXIS3/4 = 1)
+    #
+    regrid_file = mask_file.replace('.fits','').replace('.FITS','')+'_'+str(imsize)+'_'+str(scale)+'asec.fits'
+    data_out    = mask_out.astype(mask.dtype).reshape((1,)*(mask.ndim-2)+(imsize,imsize))
+    fits.writeto(homedir+regrid_file,data_out,header_out,overwrite=True)
+
+    record_step_timing('mask_regrid',time.time()-t_start,'','',imsize=imsize)
+
+    print('Regridded mask ',mask_file,' to ',imsize,' pixel ',scale,' arcsec ',regrid_file)
+
+    return regrid_file
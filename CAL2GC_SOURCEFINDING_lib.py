@@ -0,0 +1,150 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Source finding part of CAL2GC_lib (PyBDSF via Jonah's sourcefinding.py)
+#
+import os
+import time
+
+import PROFILE_lib as PROF
+import BACKEND_lib as BACKEND
+
+from CAL2GC_CONFIG_lib import python_def, get_list_index, record_step_timing
+from CAL2GC_STATS_lib import get_fits_imsize
+
+
+#
+# LIBS
+#
+
+@PROF.traced()
+def make_region_file(imagename,homedir=''):
+    """
+    uses pybdsf and Jonah's source finding with mask setup
+    """
+
+    # set settings
+    #
+    filename       = homedir + imagename
+    sfinding_dir   = homedir + imagename.replace('.fits','').replace('.FITS','')
+    pybdsf_dir     = imagename.replace('.fits','').replace('.FITS','')+'_pybdsf'
+    source_finding = python_def + ' ' + homedir + 'Image-processing/sourcefinding.py mask ' + filename + ' -o fits:srl kvis --plot'
+
+    # start the source finding stuff from Jonah
+    # using the mask setting
+    #
+    t_start = time.time()
+    BACKEND.sourcefinding('mask',filename,homedir,source_finding)
+    record_step_timing('pybdsf',time.time()-t_start,'','',imsize=get_fits_imsize(filename))
+
+    # optain information of the total flux density of the model
+    #
+    info    = os.popen('grep "Total flux density in model" '+homedir+pybdsf_dir+'/'+imagename+'.pybdsf.log')
+    getinfo = info.read().split()
+    info.close()
+    #idx_jy         = getinfo.index('Jy')
+    idx_jy         = get_list_index(getinfo,'Jy')
+    tot_flux_model = getinfo[idx_jy[-1]-1]
+
+    # optain information of the total flux density of the model
+    #
+    stdinfo = os.popen('grep "std. dev:" '+homedir+pybdsf_dir+'/'+imagename+'.pybdsf.log')
+    stdgetinfo = stdinfo.read().split()
+    stdinfo.close()
+    #idx_std  = stdgetinfo.index('(Jy/beam)')
+    idx_std        = get_list_index(stdgetinfo,'(Jy/beam)')
+    std_resi       = stdgetinfo[idx_std[-1]-1]
+
+    return pybdsf_dir, imagename.replace('.fits','').replace('.FITS','')+'_mask.crtf', eval(tot_flux_model), eval(std_resi)
+
+
+@PROF.traced()
+def cataloging_fits(imagename,homedir=''):
+    """
+    uses pybdsf and Jonah's source finding to generate a catalouge
+    """
+
+    # set settings
+    #
+    filename       = homedir + imagename
+    pybdsf_dir     = imagename.replace('.fits','').replace('.FITS','')+'_pybdsf'
+    source_finding = python_def + ' ' + homedir + 'Image-processing/sourcefinding.py cataloging ' + filename + ' -o fits:srl kvis --plot'
+
+    # start the source finding stuff from Jonah
+    # using the mask setting
+    #
+    t_start = time.time()
+    BACKEND.sourcefinding('cataloging',filename,homedir,source_finding)
+    record_step_timing('pybdsf',time.time()-t_start,'','',imsize=get_fits_imsize(filename))
+
+    # pybdsf log file
+    #
+    pybdsf_log = imagename+'.pybdsf.log'
+
+    return homedir,pybdsf_dir,pybdsf_log
+
+
+@PROF.traced()
+def get_info_from_pybdsflog(pybdsf_log,pybdsf_dir='',homedir=''):
+    """
+    extract information out of the pybdsf log files
+    and return a dic with relevant information
+    """
+    pybdsf_info = {}
+
+    # optain information of the number of sources
+    #
+    info    = os.popen('grep "Number of sources formed from Gaussians" '+homedir+pybdsf_dir+pybdsf_log)
+    ngausgetinfo = info.read().split()
+    info.close()
+    #
+    idx_ng          = get_list_index(ngausgetinfo,'Gaussians')
+    tot_num_sources = ngausgetinfo[idx_ng[-1]+2]     # take the last entry
+    
+    pybdsf_info['nsource'] = eval(tot_num_sources)
+
+    # optain information of the total flux density of the model
+    #
+    info    = os.popen('grep "Total flux density in model" '+homedir+pybdsf_dir+pybdsf_log)
+    jygetinfo = info.read().split()
+    info.close()
+    #
+    idx_jy         = get_list_index(jygetinfo,'Jy')
+    tot_flux_model = jygetinfo[idx_jy[-1]-1]     # take the last entry
+
+    pybdsf_info['nsource_flux_jy'] = eval(tot_flux_model)
+
+    # optain information of the final std in the image
+    #
+    stdinfo = os.popen('grep "std. dev:" '+homedir+pybdsf_dir+pybdsf_log)
+    stdgetinfo = stdinfo.read().split()
+    stdinfo.close()
+    #
+    idx_std   = get_list_index(stdgetinfo,'(Jy/beam)')
+    std_resi  = stdgetinfo[idx_std[-1]-1]     # take the last entry
+
+    pybdsf_info['residual_image_noise_jy'] = eval(std_resi)
+
+
+    # optain information of the beam shape 
+    #
+    beaminfo = os.popen('grep "Beam shape (major, minor, pos angle)" '+homedir+pybdsf_dir+pybdsf_log)
+    beamgetinfo = beaminfo.read().split()
+    beaminfo.close()
+    #
+    idx_beam   = get_list_index(beamgetinfo,'degrees')
+    bmaj       = eval(str(beamgetinfo[idx_beam[-1]-3]).replace('(','').replace(')','').replace(',',''))
+    bmin       = eval(beamgetinfo[idx_beam[-1]-2].replace('(','').replace(')','').replace(',',''))
+    PA         = eval(beamgetinfo[idx_beam[-1]-1].replace(')',''))
+    #
+    pybdsf_info['bmaj_deg'] = bmaj
+    pybdsf_info['bmin_deg'] = bmin
+    pybdsf_info['PA_deg']   = PA
+    
+
+    return pybdsf_info
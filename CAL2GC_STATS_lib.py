@@ -0,0 +1,224 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Statistics part of CAL2GC_lib
+#
+# - flag statistics and the residual flagging of the MS
+#
+# - image statistics and the flux density of the model (astropy,
+#   wsclean component lists)
+#
+import os
+
+import numpy as np
+
+import PROFILE_lib as PROF
+import BACKEND_lib as BACKEND
+import FLAGSTATS_lib as FLAGSTATS
+import RESIFLAG_lib as RESIFLAG
+
+
+#
+# LIBS
+#
+
+@PROF.traced()
+def flag_statistics(MSFILE,homedir,outname,nproc=4,memory_mb=None):
+    """
+    flagged fractions of the MS (saved as outname .json and .npz)
+    """
+    if BACKEND.backend_name != 'real':
+        return {}
+
+    stats     = FLAGSTATS.get_flag_statistics(MSFILE,homedir,nproc,memory_mb)
+    fractions = FLAGSTATS.save_flag_statistics(stats,outname,homedir)
+    FLAGSTATS.print_flag_fractions(fractions)
+
+    return {'total':fractions['total'],'spw':fractions['spw'],'antenna':fractions['antenna']}
+
+
+@PROF.traced()
+def residual_flagging(MSFILE,homedir,nsigma=5.,nproc=4,memory_mb=None):
+    """
+    flag outliers of CORRECTED_DATA - MODEL_DATA
+    returns the newly flagged fractions
+    """
+    if BACKEND.backend_name != 'real':
+        return {}
+
+    fractions = RESIFLAG.residual_flagging(MSFILE,homedir,nsigma,nproc,memory_mb)
+    print('\n Residual flagging ',nsigma,' sigma new flags ','{:.4f}'.format(fractions['total']),\
+              ' per spw ',' '.join([s+':'+'{:.4f}'.format(f) for s,f in fractions['spw'].items()]),'\n')
+
+    return fractions
+
+
+def get_fits_imsize(imageandpath):
+    """
+    return the image size in pixel of a fits image
+    (reads the header only)
+    """
+    from astropy.io import fits
+
+    if not os.path.exists(imageandpath):
+        return 0
+
+    im_data_header = fits.getheader(imageandpath)
+
+    return max(im_data_header.get('NAXIS1',0),im_data_header.get('NAXIS2',0))
+
+
+@PROF.traced()
+def get_imagestats(imagename,homedir):
+    """
+    provide stats information of the image 
+    """
+    from astropy.io import fits
+    
+    imageandpath = homedir+imagename
+    
+    # open the fits file
+    #
+    hdu_list       = fits.open(imageandpath) 
+    im_data        = hdu_list[0].data
+    im_data_header = hdu_list[0].header
+
+    return im_data.mean(),im_data.std(),im_data.min(),im_data.max(),im_data_header['BUNIT']
+
+
+def sum_imageflux(imagename,homedir,threshold=0,tile_rows=512):
+    """
+    return the integrated flux above the threshold 
+
+    the image is memory-mapped and summed in tiles of
+    image rows, so the full image is never loaded
+    """
+    from astropy.io import fits
+    
+    imageandpath = homedir+imagename
+    
+    # open the fits file
+    #
+    hdu_list       = fits.open(imageandpath,memmap=True) 
+    im_data        = hdu_list[0].data
+    im_data_header = hdu_list[0].header
+
+    n_rows  = im_data.shape[-2]
+    flux    = 0.
+    for r in range(0,n_rows,tile_rows):
+        tile  = np.asarray(im_data[...,r:r+tile_rows,:])
+        flux += np.sum(tile[tile > threshold],dtype=np.float64)
+
+    hdu_list.close()
+
+    return float(flux),im_data_header['BUNIT']
+
+
+def read_wsclean_sourcelist(sourcelist):
+    """
+    read the component list of wsclean (-save-source-list)
+    returns a list of dic per component
+    """
+    import re
+
+    # fields are separated by commas, 
+    # the spectral terms are within brackets
+    #
+    split_line = re.compile(r',(?![^\[]*\])')
+
+    components = []
+    with open(sourcelist) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#') or line.lower().startswith('format'):
+                continue
+
+            entries = split_line.split(line)
+            if len(entries) < 8:
+                continue
+
+            comp = {}
+            comp['name']     = entries[0]
+            comp['type']     = entries[1]
+            comp['flux_jy']  = float(entries[4])
+            spix             = entries[5].strip().strip('[]')
+            comp['spix']     = [float(c) for c in spix.split(',') if len(c.strip()) > 0]
+            comp['log_spix'] = entries[6].strip().lower() == 'true'
+            comp['ref_freq'] = float(entries[7])
+            components.append(comp)
+
+    return components
+
+
+def sourcelist_flux(components,freqs):
+    """
+    return the flux of each component at the frequencies [Hz]
+    array of shape (n_components,n_freqs)
+    """
+    freqs = np.atleast_1d(np.array(freqs,dtype=np.float64))
+    flux  = np.zeros((len(components),len(freqs)))
+
+    for i, comp in enumerate(components):
+        nu = freqs / comp['ref_freq']
+        if comp['log_spix']:
+            exponent = np.zeros(len(freqs))
+            for k, c in enumerate(comp['spix']):
+                exponent += c * np.log10(nu)**k
+            flux[i] = comp['flux_jy'] * nu**exponent
+        else:
+            flux[i] = comp['flux_jy']
+            for k, c in enumerate(comp['spix']):
+                flux[i] += c * (nu - 1)**(k+1)
+
+    return flux
+
+
+@PROF.traced()
+def get_model_flux(outname,homedir,chan_freqs=[],threshold=0):
+    """
+    provide the flux density statistics of the model
+
+    uses the component list of wsclean (outname-sources.txt)
+    falls back on the sum of the MFS model image
+
+    as for the model image only the components above the threshold
+    are summed (total_flux_jy), signed_flux_jy is the sum of all
+    components
+    """
+    sourcelist  = homedir+outname+'-sources.txt'
+
+    model_info = {}
+    if os.path.exists(sourcelist):
+        components = read_wsclean_sourcelist(sourcelist)
+        comp_flux  = np.array([c['flux_jy'] for c in components])
+        above      = comp_flux > threshold
+
+        model_info['source']             = 'sourcelist'
+        model_info['total_flux_jy']      = float(comp_flux[above].sum())
+        model_info['signed_flux_jy']     = float(comp_flux.sum())
+        model_info['n_components']       = len(components)
+        model_info['n_gaussian']         = len([c for c in components if c['type'].upper() == 'GAUSSIAN'])
+        if len(components) > 0:
+            model_info['max_component_jy']    = float(comp_flux.max())
+            model_info['median_component_jy'] = float(np.median(comp_flux))
+            model_info['n_negative']          = int(np.sum(comp_flux < 0))
+        if len(chan_freqs) > 0 and np.sum(above) > 0:
+            model_info['chan_freq_hz']        = chan_freqs
+            model_info['chan_flux_jy']        = sourcelist_flux([c for c,a in zip(components,above) if a],chan_freqs).sum(axis=0).tolist()
+        model_info['unit']               = 'Jy'
+
+    else:
+        if os.path.exists(homedir+outname+'-MFS-model.fits'):
+            model_image = outname+'-MFS-model.fits'
+        else:
+            model_image = outname+'-model.fits'
+
+        model_info['source']             = 'model_image'
+        model_info['total_flux_jy'], model_info['unit'] = sum_imageflux(model_image,homedir,threshold)
+
+    return model_info
@@ -0,0 +1,178 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Quality of the calibration solutions of the self-calibration
+# (SC{n}_CALTAB_{mode} tables)
+#
+# - reads the caltables directly (python-casacore) as NumPy arrays
+#
+# - per antenna phase RMS, amplitude scatter, flagged fraction of the
+#   solutions and the phase jumps between consecutive solutions
+#
+# - compact PNG summary of the solutions (matplotlib)
+#
+import os
+
+import numpy as np
+
+
+#
+# LIBS
+#
+
+global phase_jump_deg
+
+# phase difference of consecutive solutions counted as a jump
+#
+phase_jump_deg = 30.
+
+
+def read_caltable(caltable):
+    """
+    solutions and antenna names of a caltable
+    """
+    from casacore.tables import table
+
+    sol = {}
+    with table(caltable,ack=False) as cal:
+        sol['time']     = cal.getcol('TIME')
+        sol['interval'] = cal.getcol('INTERVAL')
+        sol['ant']      = cal.getcol('ANTENNA1')
+        sol['spw']      = cal.getcol('SPECTRAL_WINDOW_ID')
+        sol['gain']     = cal.getcol('CPARAM')
+        sol['flag']     = cal.getcol('FLAG')
+
+    with table(caltable+'/ANTENNA',ack=False) as ant:
+        sol['antenna_names'] = list(ant.getcol('NAME'))
+
+    return sol
+
+
+def caltable_statistics(caltable):
+    """
+    per antenna statistics of the solutions of a caltable
+    """
+    sol   = read_caltable(caltable)
+    names = sol['antenna_names']
+    nant  = len(names)
+
+    gain  = np.where(sol['flag'],np.nan,sol['gain'])
+    valid = ~sol['flag']
+    ant   = sol['ant']
+
+    # mean phasor per antenna and spw, the phase RMS around it
+    #
+    key    = ant * (np.max(sol['spw']) + 1) + sol['spw']
+    nkey   = int(np.max(key)) + 1 if len(key) > 0 else 0
+    phasor = np.where(valid,gain / np.where(valid,np.abs(gain),1),0)
+    mean   = np.zeros((nkey,)+gain.shape[1:],dtype=complex)
+    np.add.at(mean,key,phasor)
+    dphase = np.angle(np.where(valid,phasor * np.conj(mean[key]),1),deg=True)
+
+    amp     = np.abs(gain)
+    amp_sum = np.zeros((nkey,)+gain.shape[1:])
+    np.add.at(amp_sum,key,np.where(valid,amp,0))
+    nvalid  = np.zeros((nkey,)+gain.shape[1:])
+    np.add.at(nvalid,key,valid)
+    damp    = np.where(valid,amp / np.maximum(amp_sum / np.maximum(nvalid,1),1E-12)[key] - 1,0)
+
+    # phase differences of consecutive solutions per antenna and spw
+    #
+    order  = np.lexsort((sol['time'],key))
+    same   = key[order][1:] == key[order][:-1]
+    both   = valid[order][1:] & valid[order][:-1]
+    jump   = np.abs(np.angle(phasor[order][1:] * np.conj(phasor[order][:-1]),deg=True))
+    jump   = np.where(same[:,None,None] & both,jump,0).max(axis=(1,2))
+    jump_ant = ant[order][1:]
+
+    nsol    = np.bincount(ant,minlength=nant) * np.prod(gain.shape[1:])
+    nflag   = np.bincount(ant,weights=sol['flag'].sum(axis=(1,2)),minlength=nant)
+    ngood   = nsol - nflag
+    ph_rms  = np.sqrt(np.bincount(ant,weights=np.sum(dphase**2 * valid,axis=(1,2)),minlength=nant) / np.maximum(ngood,1))
+    amp_std = np.sqrt(np.bincount(ant,weights=np.sum(damp**2,axis=(1,2)),minlength=nant) / np.maximum(ngood,1))
+    max_jump = np.zeros(nant)
+    np.maximum.at(max_jump,jump_ant,jump)
+    njumps  = np.bincount(jump_ant,weights=jump > phase_jump_deg,minlength=nant)
+
+    stats = {'caltable':os.path.basename(caltable.rstrip('/')),'nsolutions':int(nsol.sum()),\
+                 'flagged_fraction':float(nflag.sum() / max(nsol.sum(),1)),'antenna':{}}
+
+    for a in np.flatnonzero(nsol):
+        stats['antenna'][names[a]] = {'phase_rms_deg':float(ph_rms[a]),'amp_scatter':float(amp_std[a]),\
+                                          'flagged_fraction':float(nflag[a] / nsol[a]),'max_phase_jump_deg':float(max_jump[a]),\
+                                          'phase_jumps':int(njumps[a])}
+
+    good = [a for a in np.flatnonzero(nsol) if ngood[a] > 0]
+    stats['median_phase_rms_deg'] = float(np.median(ph_rms[good])) if len(good) > 0 else 0.
+    stats['median_amp_scatter']   = float(np.median(amp_std[good])) if len(good) > 0 else 0.
+    stats['phase_jumps']          = int(njumps.sum())
+
+    return stats
+
+
+def plot_caltable(caltable,stats,figurename,homedir='',caltype='p'):
+    """
+    PNG summary of the solutions: phase (and amplitude) versus time
+    and the per antenna statistics
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    sol   = read_caltable(caltable)
+    names = sol['antenna_names']
+    gain  = np.where(sol['flag'],np.nan,sol['gain'])
+    hours = (sol['time'] - np.min(sol['time'])) / 3600.
+
+    npanel = 3 if caltype == 'ap' else 2
+    fig, axs = plt.subplots(npanel,1,figsize=(8,2.5*npanel),constrained_layout=True)
+
+    cmap = plt.get_cmap('viridis',max(len(names),2))
+    for a in np.unique(sol['ant']):
+        sel = sol['ant'] == a
+        for p in range(gain.shape[2]):
+            axs[0].plot(hours[sel],np.angle(gain[sel,0,p],deg=True),'.',ms=2,color=cmap(a))
+            if caltype == 'ap':
+                axs[1].plot(hours[sel],np.abs(gain[sel,0,p]),'.',ms=2,color=cmap(a))
+    axs[0].set_ylabel('phase [deg]')
+    axs[0].set_xlabel('time [h]')
+    axs[0].set_title(stats['caltable']+'  flagged '+'{:.3f}'.format(stats['flagged_fraction']),fontsize=9)
+    if caltype == 'ap':
+        axs[1].set_ylabel('amplitude')
+        axs[1].set_xlabel('time [h]')
+
+    ants = list(stats['antenna'])
+    x    = np.arange(len(ants))
+    axs[-1].bar(x,[stats['antenna'][a]['phase_rms_deg'] for a in ants],color='tab:blue',label='phase rms [deg]')
+    axs[-1].set_xticks(x)
+    axs[-1].set_xticklabels(ants,rotation=90,fontsize=6)
+    axs[-1].set_ylabel('phase rms [deg]')
+    twin = axs[-1].twinx()
+    twin.plot(x,[stats['antenna'][a]['flagged_fraction'] for a in ants],'o',color='tab:red',ms=3)
+    twin.set_ylabel('flagged fraction',color='tab:red')
+    twin.set_ylim(0,1)
+
+    plotfigfile = homedir+figurename+'.png'
+    fig.savefig(plotfigfile,dpi=100)
+    plt.close(fig)
+
+    return plotfigfile
+
+
+def print_caltable_statistics(stats):
+    """
+    print the statistics of a caltable
+    """
+    print('\n Solutions ',stats['caltable'],' flagged ','{:.3f}'.format(stats['flagged_fraction']),\
+              ' median phase rms ','{:.2f}'.format(stats['median_phase_rms_deg']),' deg',\
+              ' median amp scatter ','{:.3f}'.format(stats['median_amp_scatter']),' phase jumps ',stats['phase_jumps'])
+    for a in stats['antenna']:
+        s = stats['antenna'][a]
+        print('   ',a,' phase rms ','{:.2f}'.format(s['phase_rms_deg']),' amp scatter ','{:.3f}'.format(s['amp_scatter']),\
+                  ' flagged ','{:.3f}'.format(s['flagged_fraction']),' max jump ','{:.1f}'.format(s['max_phase_jump_deg']))
+    print('\n')
@@ -19,7 +19,6 @@ import glob
 import json
 from optparse import OptionParser
 
-import casatasks
 import numpy as np
 from CAL2GC_lib import *
 
@@ -86,6 +85,7 @@ def main():
     #
     docasatclean = True
     if docasatclean:
+        import casatasks
 
         msfile     = homedir + MSFN
         outputfile = homedir + outputfilename
@@ -0,0 +1,257 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Check of the native phase-only gain solver (GAINSOLVE_lib)
+#
+# - copies a MS and replaces MODEL_DATA by a 1 Jy point source and
+#   DATA by the model corrupted with known phase gains and noise
+#
+# - solves the gains natively and compares them with the injected
+#   gains and (if CASA is available) with gaincal
+#
+# - applies the gains natively (APPLYCAL_lib) and compares the
+#   corrected data with the model and (if CASA is available) with
+#   applycal
+#
+# python3 CHECK_GAINSOLVE.py --MS_FILE=TEMPLATE.ms --SOLINT=60s
+#
+import os
+import sys
+import time
+import shutil
+import tempfile
+#
+import numpy as np
+import GAINSOLVE_lib as GAINSOLVE
+import APPLYCAL_lib as APPLYCAL
+#
+from optparse import OptionParser
+
+
+def inject_gains(msfile,noise=0.1,phase_drift_deg=10.,seed=1):
+    """
+    write a point source model and the corrupted data into the MS
+    returns the injected gains [ntime,nant,nspw] and their times
+    """
+    from casacore.tables import table, maketabdesc, makecoldesc
+
+    rng = np.random.default_rng(seed)
+
+    with table(msfile,readonly=False,ack=False) as t:
+        for col in ['MODEL_DATA','CORRECTED_DATA']:
+            if col not in t.colnames():
+                desc = t.getcoldesc('DATA')
+                t.addcols(maketabdesc(makecoldesc(col,desc)))
+
+        times = np.unique(t.getcol('TIME'))
+        with table(msfile+'/ANTENNA',ack=False) as ant:
+            nant = ant.nrows()
+        with table(msfile+'/SPECTRAL_WINDOW',ack=False) as spwtab:
+            nspw = spwtab.nrows()
+        with table(msfile+'/DATA_DESCRIPTION',ack=False) as dd:
+            ddid_spw = dd.getcol('SPECTRAL_WINDOW_ID')
+
+        # slowly varying phases (random walk) per antenna and spw
+        #
+        steps  = rng.normal(0,phase_drift_deg/np.sqrt(len(times)),(len(times),nant,nspw))
+        phases = np.deg2rad(np.cumsum(steps,axis=0) + rng.uniform(-180,180,(1,nant,nspw)))
+        gains  = np.exp(1j * phases)
+
+        tidx = np.searchsorted(times,t.getcol('TIME'))
+        a1   = t.getcol('ANTENNA1')
+        a2   = t.getcol('ANTENNA2')
+        spw  = ddid_spw[t.getcol('DATA_DESC_ID')]
+
+        for r in range(t.nrows()):
+            shape = t.getcell('DATA',r).shape
+            model = np.ones(shape,dtype=np.complex64)
+            g     = gains[tidx[r],a1[r],spw[r]] * np.conj(gains[tidx[r],a2[r],spw[r]])
+            data  = g * model + noise * (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)) / np.sqrt(2)
+            t.putcell('MODEL_DATA',r,model)
+            t.putcell('DATA',r,data.astype(np.complex64))
+            t.putcell('FLAG',r,np.zeros(shape,dtype=bool))
+            t.putcell('WEIGHT',r,np.ones(shape[1],dtype=np.float32))
+
+    return gains, times
+
+
+def read_caltable(caltable):
+    """
+    solutions of a T Jones caltable
+    """
+    from casacore.tables import table
+
+    with table(caltable,ack=False) as cal:
+        sol = {}
+        for col in ['TIME','INTERVAL','ANTENNA1','ANTENNA2','SPECTRAL_WINDOW_ID']:
+            sol[col] = cal.getcol(col)
+        sol['CPARAM'] = cal.getcol('CPARAM')[:,0,0]
+        sol['FLAG']   = cal.getcol('FLAG')[:,0,0]
+
+    return sol
+
+
+def compare_injected(sol,gains,times):
+    """
+    phase difference [deg] of the solutions and the injected gains
+    (averaged over the solution interval, same reference antenna)
+    """
+    diffs = []
+    for i in np.flatnonzero(~sol['FLAG']):
+        in_bin = np.abs(times - sol['TIME'][i]) <= sol['INTERVAL'][i] / 2 + 1E-3
+        ant, ref, spw = sol['ANTENNA1'][i], sol['ANTENNA2'][i], sol['SPECTRAL_WINDOW_ID'][i]
+        injected = np.mean(gains[in_bin,ant,spw] * np.conj(gains[in_bin,ref,spw]))
+        diffs.append(np.angle(sol['CPARAM'][i] * np.conj(injected),deg=True))
+
+    return np.array(diffs)
+
+
+def compare_caltables(sol_a,sol_b):
+    """
+    phase difference [deg] of two caltables (matched by time, antenna and spw)
+    """
+    diffs = []
+    for i in np.flatnonzero(~sol_a['FLAG']):
+        match = np.flatnonzero((np.abs(sol_b['TIME'] - sol_a['TIME'][i]) < 1.) & (sol_b['ANTENNA1'] == sol_a['ANTENNA1'][i]) & \
+                                   (sol_b['SPECTRAL_WINDOW_ID'] == sol_a['SPECTRAL_WINDOW_ID'][i]) & ~sol_b['FLAG'])
+        if len(match) > 0:
+            diffs.append(np.angle(sol_a['CPARAM'][i] * np.conj(sol_b['CPARAM'][match[0]]),deg=True))
+
+    return np.array(diffs)
+
+
+def corrected_difference(msfile,column_a,column_b):
+    """
+    rms difference of two data columns (unflagged data)
+    """
+    from casacore.tables import table
+
+    diff2, n = 0., 0
+    with table(msfile,ack=False) as t:
+        for r in range(t.nrows()):
+            flag   = t.getcell('FLAG',r)
+            diff   = t.getcell(column_a,r) - t.getcell(column_b,r)
+            diff2 += np.sum(np.abs(diff[~flag])**2)
+            n     += np.sum(~flag)
+
+    return np.sqrt(diff2 / max(n,1))
+
+
+def main():
+
+    # argument parsing
+    #
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--MS_FILE', dest='msfile', type=str,
+                      help='MS - file used as template (is copied)')
+
+    parser.add_option('--WORK_DIR', dest='cwd', default='',type=str,
+                      help='Directory of the check [default temporary directory]')
+
+    parser.add_option('--SOLINT', dest='solint', default='60s', type=str,
+                      help='solution interval [default 60s]')
+
+    parser.add_option('--REFANT', dest='refant', default='', type=str,
+                      help='reference antenna [default first antenna]')
+
+    parser.add_option('--UVRANGE', dest='uvrange', default='', type=str,
+                      help='uvrange [default all]')
+
+    parser.add_option('--NOISE', dest='noise', default=0.1, type=float,
+                      help='noise per visibility in Jy [default 0.1]')
+
+    parser.add_option('--PHASE_DRIFT', dest='phase_drift', default=10., type=float,
+                      help='phase drift of the injected gains over the observation in deg [default 10]')
+
+    parser.add_option('--TOLERANCE', dest='tolerance', default=2., type=float,
+                      help='allowed rms phase difference in deg [default 2]')
+
+    # ----
+
+    (opts, args)         = parser.parse_args()
+
+    if opts.msfile == None:
+        parser.print_help()
+        sys.exit()
+
+    workdir = opts.cwd if len(opts.cwd) > 0 else tempfile.mkdtemp(prefix='2GC_GAINSOLVE_')+'/'
+    msfile  = workdir + 'CHECK_GAINSOLVE.ms'
+    shutil.rmtree(msfile,ignore_errors=True)
+    shutil.copytree(opts.msfile,msfile)
+
+    gains, times = inject_gains(msfile,opts.noise,opts.phase_drift)
+
+    from casacore.tables import table
+    refant  = opts.refant if len(opts.refant) > 0 else table(msfile+'/ANTENNA',ack=False).getcol('NAME')[0]
+
+    t_start = time.time()
+    GAINSOLVE.gaincal_phase(msfile,workdir+'NATIVE.G',opts.solint,refant,opts.uvrange,minsnr=3)
+    t_native = time.time() - t_start
+
+    native = read_caltable(workdir+'NATIVE.G')
+    diffs  = compare_injected(native,gains,times)
+    rms    = np.sqrt(np.mean(diffs**2)) if len(diffs) > 0 else np.inf
+    print('Native solver ',round(t_native,2),' s  solutions ',len(diffs),' rms phase difference to the injected gains ',round(rms,3),' deg')
+
+    failed = rms > opts.tolerance
+
+    # apply the solutions, the residuals should be the noise
+    #
+    t_start = time.time()
+    APPLYCAL.apply_gaintables(msfile,[workdir+'NATIVE.G'],['linear'])
+    t_apply = time.time() - t_start
+    rms_res = corrected_difference(msfile,'CORRECTED_DATA','MODEL_DATA')
+    print('Native apply ',round(t_apply,2),' s  rms corrected - model ',round(rms_res,4),' Jy  (noise ',opts.noise,' Jy)')
+
+    failed = failed or rms_res > 2 * opts.noise
+
+    # compare with gaincal
+    #
+    try:
+        import casatasks
+    except ImportError:
+        casatasks = None
+        print('No CASA, no comparison with gaincal')
+
+    if casatasks != None:
+        t_start = time.time()
+        casatasks.gaincal(vis=msfile,caltable=workdir+'CASA.G',gaintype='T',calmode='p',solint=opts.solint,refant=refant,\
+                              uvrange=opts.uvrange,minsnr=3,solnorm=False,combine='')
+        t_casa = time.time() - t_start
+
+        diffs_casa = compare_caltables(native,read_caltable(workdir+'CASA.G'))
+        rms_casa   = np.sqrt(np.mean(diffs_casa**2)) if len(diffs_casa) > 0 else np.inf
+        print('gaincal ',round(t_casa,2),' s  solutions ',len(diffs_casa),' rms phase difference native - gaincal ',round(rms_casa,3),' deg')
+
+        failed = failed or rms_casa > opts.tolerance
+
+        # native and CASA apply of the same table
+        #
+        from casacore.tables import table
+        with table(msfile,readonly=False,ack=False) as t:
+            t.putcol('MODEL_DATA',t.getcol('CORRECTED_DATA'))
+        t_start = time.time()
+        casatasks.applycal(vis=msfile,gaintable=[workdir+'NATIVE.G'],interp=['linear'],calwt=False,parang=False,flagbackup=False)
+        t_casa_apply = time.time() - t_start
+        rms_apply    = corrected_difference(msfile,'CORRECTED_DATA','MODEL_DATA')
+        print('applycal ',round(t_casa_apply,2),' s  rms native - applycal ',rms_apply,' Jy')
+
+        failed = failed or rms_apply > 1E-3 * opts.noise
+
+    if len(opts.cwd) == 0:
+        shutil.rmtree(workdir,ignore_errors=True)
+
+    if failed:
+        print('Check failed, tolerance ',opts.tolerance,' deg')
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Check of the live progress files (PROGRESS_lib)
+#
+# - runs the self-calibration twice on a synthetic MS with the stub
+#   backends (see BENCHMARK_2GC_PIPELINE), the first run provides
+#   the timings for the ETA of the second run
+#
+# - samples the JSON status during the second run and checks the
+#   stages, rounds, tools, wsclean major cycles and peak flux, the
+#   ETA against the actual runtime and the Prometheus text format
+#
+# python3 CHECK_PROGRESS.py --LATENCY=wsclean:0.2,casa:0.05
+#
+import os
+import re
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import threading
+#
+import BACKEND_lib as BACKEND
+import BENCHMARK_2GC_PIPELINE
+#
+from optparse import OptionParser
+
+
+#
+# LIBS
+#
+
+global prom_line
+
+prom_line = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? (NaN|[-+]?[\d.]+([eE][-+]?\d+)?)$')
+
+
+def check_prometheus(promfile):
+    """
+    errors of the Prometheus text format
+    """
+    errors = []
+    names  = set()
+    typed  = set()
+    with open(promfile) as fin:
+        for line in fin.read().splitlines():
+            if line.startswith('# TYPE '):
+                typed.add(line.split()[2])
+            elif line.startswith('#'):
+                continue
+            elif prom_line.match(line) == None:
+                errors.append('invalid line: '+line)
+            else:
+                names.add(re.split(r'[{ ]',line)[0])
+
+    for n in names - typed:
+        errors.append('metric without TYPE: '+n)
+
+    return errors
+
+
+def sample_status(statusfile,samples,stop,interval=0.02):
+    """
+    read the JSON status until stop is set
+    """
+    while not stop.is_set():
+        try:
+            with open(statusfile) as fin:
+                samples.append(json.load(fin))
+        except (OSError,ValueError):
+            pass
+        time.sleep(interval)
+
+
+def glob_one(directory,pattern):
+    """
+    the single file matching the pattern
+    """
+    files = glob.glob(directory+pattern)
+    if len(files) != 1:
+        print('Expected one ',pattern,' in ',directory,' found ',files)
+        sys.exit(-1)
+
+    return files[0]
+
+
+def run_pipeline(MSFILE,benchdir,imsize,nspw):
+    """
+    run the stub self-calibration, returns the wall time [s]
+    """
+    import IMAGING_and_2GC
+
+    sys.argv = ['IMAGING_and_2GC.py','--MS_FILE='+MSFILE,'--WORK_DIR='+benchdir,'--DOSELFCAL',\
+                    '--IMAG_PARA_IMSIZE='+str(imsize),'--IMAG_PARA_SPWDS='+','.join([str(s) for s in range(nspw)])]
+
+    t_start = time.time()
+    IMAGING_and_2GC.main()
+
+    return time.time() - t_start
+
+
+def main():
+
+    # argument parsing
+    #
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--IMSIZE', dest='imsize', default=128, type=int,
+                      help='imsize in pixel [default 128]')
+
+    parser.add_option('--LATENCY', dest='latency', default='wsclean:0.2,casa:0.05,sourcefinding:0.05', type=str,
+                      help='latency of the stub tools [default wsclean:0.2,casa:0.05,sourcefinding:0.05]')
+
+    parser.add_option('--ETA_TOLERANCE', dest='eta_tol', default=0.5, type=float,
+                      help='accepted relative error of the ETA at the start [default 0.5]')
+
+    # ----
+
+    (opts, args)         = parser.parse_args()
+
+    latency = {}
+    for lat in opts.latency.split(','):
+        if len(lat) > 0:
+            latency[lat.split(':')[0]] = float(lat.split(':')[1])
+
+    benchdir = tempfile.mkdtemp(prefix='2GC_PROGRESS_CHECK_')+'/'
+    MSFILE   = 'STUB.ms'
+    nspw     = 4
+    BENCHMARK_2GC_PIPELINE.make_stub_ms(MSFILE,benchdir,nspw,ms_size_mb=1)
+    os.makedirs(benchdir+'2GC',exist_ok=True)
+    shutil.copy(os.path.dirname(os.path.abspath(__file__))+'/IMAGING_2GC_DEFAULTS.json',benchdir+'2GC/')
+
+    BACKEND.set_backend('stub',latency)
+
+    # first run (timings), second run sampled
+    #
+    run_pipeline(MSFILE,benchdir,opts.imsize,nspw)
+
+    statusfile = glob_one(benchdir,'2GC_PROGRESS_*.json')
+    promfile   = glob_one(benchdir,'2GC_PROGRESS_*.prom')
+
+    samples, stop = [], threading.Event()
+    sampler = threading.Thread(target=sample_status,args=(statusfile,samples,stop))
+    sampler.start()
+    t_run = run_pipeline(MSFILE,benchdir,opts.imsize,nspw)
+    stop.set()
+    sampler.join()
+
+    with open(statusfile) as fin:
+        final = json.load(fin)
+
+    # checks
+    #
+    errors  = []
+    running = [s for s in samples if s['state'] == 'running' and s['start_time'] >= final['start_time']]
+
+    if final['state'] != 'finished' or final['steps_done'] != final['steps_total'] or final['eta_s'] != 0:
+        errors.append('final status not finished: '+str([final['state'],final['steps_done'],final['steps_total'],final['eta_s']]))
+
+    stages = set([s['stage'] for s in running])
+    for st in ['SC0','SC1','FINAL_IMAGING']:
+        if st not in stages:
+            errors.append('stage '+st+' not reported')
+    if max([s['round'] for s in running] + [-1]) < 1:
+        errors.append('self-calibration rounds not reported')
+
+    tasks = set([s['task'] for s in running])
+    for t in ['wsclean','pybdsf','gaincal']:
+        if t not in tasks:
+            errors.append('task '+t+' not reported')
+
+    wsc = [s['wsclean'] for s in running if s['task'] == 'wsclean' and s['wsclean'].get('major_cycle',0) > 0]
+    if len(wsc) == 0:
+        errors.append('wsclean major cycles not reported')
+    if len([w for w in wsc if w['peak_jy'] != None]) == 0:
+        errors.append('wsclean peak flux not reported')
+    if any([w['peak_jy'] != None and (w['threshold_jy'] == None or w['peak_jy'] < w['threshold_jy']) for w in wsc]):
+        errors.append('wsclean peak flux below the threshold or threshold missing')
+
+    done = [s['steps_done'] for s in running]
+    if done != sorted(done):
+        errors.append('number of finished steps decreases')
+
+    if len(running) == 0 or running[0]['eta_s'] == None:
+        errors.append('no ETA at the start of the run')
+    else:
+        eta_error = abs(running[0]['eta_s'] - t_run) / t_run
+        print('\n ETA at the start ','{:.2f}'.format(running[0]['eta_s']),' s  actual runtime ','{:.2f}'.format(t_run),\
+                  ' s  relative error ','{:.2f}'.format(eta_error))
+        if eta_error > opts.eta_tol:
+            errors.append('ETA error '+str(eta_error)+' exceeds '+str(opts.eta_tol))
+
+    errors += check_prometheus(promfile)
+
+    print('\n Samples ',len(running),' stages ',sorted(stages),' tasks ',sorted(tasks),'\n')
+
+    shutil.rmtree(benchdir,ignore_errors=True)
+
+    if len(errors) > 0:
+        for e in errors:
+            print('Error: ',e)
+        sys.exit(-1)
+
+    print('Progress check passed\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Flag statistics of a MS
+#
+# - reads the FLAG (and FLAG_ROW) column in row chunks per data
+#   description in a process pool (python-casacore), the rows per
+#   chunk follow from the channels and correlations and chunk_mb
+#   (memory of each worker)
+#
+# - flagged fractions per antenna, baseline, spw, channel, scan
+#   and correlation via bincount reductions
+#
+# - saved as JSON (fractions) and as a NumPy archive (counts
+#   incl. the channel and baseline arrays)
+#
+import os
+import json
+import multiprocessing
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+#
+# LIBS
+#
+
+global chunk_mb
+
+chunk_mb = 256
+
+
+def read_ms_layout(msfile):
+    """
+    antennas, spws, correlations and the rows per data description
+    """
+    from casacore.tables import table
+
+    layout = {}
+    with table(msfile+'/ANTENNA',ack=False) as ant:
+        layout['antenna_names'] = list(ant.getcol('NAME'))
+
+    with table(msfile+'/DATA_DESCRIPTION',ack=False) as dd:
+        layout['ddid_spw'] = list(dd.getcol('SPECTRAL_WINDOW_ID'))
+        layout['ddid_pol'] = list(dd.getcol('POLARIZATION_ID'))
+
+    with table(msfile+'/SPECTRAL_WINDOW',ack=False) as spw:
+        layout['spw_nchan'] = list(spw.getcol('NUM_CHAN'))
+
+    with table(msfile+'/POLARIZATION',ack=False) as pol:
+        layout['pol_ncorr'] = list(pol.getcol('NUM_CORR'))
+
+    with table(msfile,ack=False) as t:
+        ddids = t.getcol('DATA_DESC_ID')
+        scans = t.getcol('SCAN_NUMBER')
+
+    layout['scans']    = [int(s) for s in np.unique(scans)]
+    layout['ddid_rows'] = {int(d):np.flatnonzero(ddids == d) for d in np.unique(ddids)}
+
+    return layout
+
+
+def rows_per_chunk(nchan,ncorr,vis_bytes,memory_mb):
+    """
+    number of rows of nchan x ncorr visibilities with vis_bytes
+    memory per visibility within memory_mb
+    """
+    return int(max(1,memory_mb * 1024**2 // (nchan * ncorr * vis_bytes)))
+
+
+def flag_counts_chunk(para):
+    """
+    flag counts of a chunk of rows of one data description
+    (runs in its own process)
+    """
+    from casacore.tables import table
+
+    msfile, rownrs, nant, nscan, scan_index = para
+
+    with table(msfile,ack=False) as t:
+        sel      = t.selectrows(rownrs)
+        flag     = sel.getcol('FLAG')
+        flag_row = sel.getcol('FLAG_ROW')
+        ant1     = sel.getcol('ANTENNA1')
+        ant2     = sel.getcol('ANTENNA2')
+        scan     = sel.getcol('SCAN_NUMBER')
+
+    flag    |= flag_row[:,None,None]
+    nvis     = flag.shape[1] * flag.shape[2]
+
+    row_flag = flag.sum(axis=(1,2))
+    bsl      = ant1 * nant + ant2
+    scan_idx = np.searchsorted(scan_index,scan)
+
+    counts = {}
+    counts['antenna_flagged']  = np.bincount(ant1,weights=row_flag,minlength=nant) + np.bincount(ant2,weights=row_flag,minlength=nant)
+    counts['antenna_total']    = (np.bincount(ant1,minlength=nant) + np.bincount(ant2,minlength=nant)) * nvis
+    counts['baseline_flagged'] = np.bincount(bsl,weights=row_flag,minlength=nant*nant)
+    counts['baseline_total']   = np.bincount(bsl,minlength=nant*nant) * nvis
+    counts['scan_flagged']     = np.bincount(scan_idx,weights=row_flag,minlength=nscan)
+    counts['scan_total']       = np.bincount(scan_idx,minlength=nscan) * nvis
+    counts['channel_flagged']  = flag.sum(axis=(0,2))
+    counts['corr_flagged']     = flag.sum(axis=(0,1))
+    counts['nrows']            = len(rownrs)
+
+    return counts
+
+
+def get_flag_statistics(MSFILE,homedir='',nproc=4,memory_mb=None):
+    """
+    flag statistics of the MS
+    (memory_mb per worker, default chunk_mb)
+    """
+    memory_mb = memory_mb if memory_mb != None else chunk_mb
+
+    msfile = homedir + MSFILE
+    layout = read_ms_layout(msfile)
+
+    nant       = len(layout['antenna_names'])
+    scan_index = np.array(layout['scans'])
+    nscan      = len(scan_index)
+
+    jobs, job_ddid = [], []
+    for ddid in layout['ddid_rows']:
+        rows  = layout['ddid_rows'][ddid]
+        spw   = int(layout['ddid_spw'][ddid])
+        nrows = rows_per_chunk(int(layout['spw_nchan'][spw]),int(layout['pol_ncorr'][layout['ddid_pol'][ddid]]),1,memory_mb)
+        for start in range(0,len(rows),nrows):
+            jobs.append([msfile,rows[start:start+nrows],nant,nscan,scan_index])
+            job_ddid.append(ddid)
+
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(nproc,len(jobs)),mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(flag_counts_chunk,jobs))
+    else:
+        results = [flag_counts_chunk(j) for j in jobs]
+
+    # sum the chunks
+    #
+    stats = {}
+    for k in ['antenna','baseline','scan']:
+        stats[k+'_flagged'] = np.zeros(nant*nant if k == 'baseline' else (nant if k == 'antenna' else nscan))
+        stats[k+'_total']   = np.zeros_like(stats[k+'_flagged'])
+    stats['spw_flagged'], stats['spw_total'], stats['spw_channel_flagged'], stats['spw_channel_total'] = {}, {}, {}, {}
+    stats['corr_flagged'], stats['corr_total'] = {}, {}
+
+    for ddid,counts in zip(job_ddid,results):
+        spw   = int(layout['ddid_spw'][ddid])
+        ncorr = int(layout['pol_ncorr'][layout['ddid_pol'][ddid]])
+        nchan = int(layout['spw_nchan'][spw])
+        for k in ['antenna','baseline','scan']:
+            stats[k+'_flagged'] += counts[k+'_flagged']
+            stats[k+'_total']   += counts[k+'_total']
+
+        if spw not in stats['spw_channel_flagged']:
+            stats['spw_channel_flagged'][spw] = np.zeros(nchan)
+            stats['spw_channel_total'][spw]   = np.zeros(nchan)
+            stats['spw_flagged'][spw], stats['spw_total'][spw] = 0., 0.
+        stats['spw_channel_flagged'][spw] += counts['channel_flagged']
+        stats['spw_channel_total'][spw]   += counts['nrows'] * ncorr
+        stats['spw_flagged'][spw]         += counts['channel_flagged'].sum()
+        stats['spw_total'][spw]           += counts['nrows'] * ncorr * nchan
+
+        if ncorr not in stats['corr_flagged']:
+            stats['corr_flagged'][ncorr] = np.zeros(ncorr)
+            stats['corr_total'][ncorr]   = 0.
+        stats['corr_flagged'][ncorr] += counts['corr_flagged']
+        stats['corr_total'][ncorr]   += counts['nrows'] * nchan
+
+    stats['antenna_names'] = layout['antenna_names']
+    stats['scans']         = layout['scans']
+
+    return stats
+
+
+def fraction(flagged,total):
+    """
+    flagged fraction (0 if there is no data)
+    """
+    return np.where(np.asarray(total) > 0,np.asarray(flagged) / np.maximum(np.asarray(total),1),0.)
+
+
+def flag_fractions(stats):
+    """
+    flagged fractions of the statistics (JSON serialisable)
+    """
+    names = stats['antenna_names']
+    nant  = len(names)
+
+    fractions = {}
+    fractions['total']    = float(sum(stats['spw_flagged'].values()) / max(sum(stats['spw_total'].values()),1))
+    fractions['antenna']  = {names[a]:float(f) for a,f in enumerate(fraction(stats['antenna_flagged'],stats['antenna_total'])) if stats['antenna_total'][a] > 0}
+    fractions['spw']      = {str(s):float(fraction(stats['spw_flagged'][s],stats['spw_total'][s])) for s in sorted(stats['spw_flagged'])}
+    fractions['scan']     = {str(s):float(f) for s,f in zip(stats['scans'],fraction(stats['scan_flagged'],stats['scan_total']))}
+
+    bsl_frac = fraction(stats['baseline_flagged'],stats['baseline_total'])
+    fractions['baseline'] = {names[b // nant]+'-'+names[b % nant]:float(bsl_frac[b]) for b in np.flatnonzero(stats['baseline_total'])}
+
+    fractions['correlation'] = {}
+    for ncorr in stats['corr_flagged']:
+        fractions['correlation'][str(ncorr)] = [float(f) for f in fraction(stats['corr_flagged'][ncorr],stats['corr_total'][ncorr])]
+
+    return fractions
+
+
+def save_flag_statistics(stats,outname,homedir=''):
+    """
+    save the fractions as JSON and the counts as NumPy archive
+    """
+    fractions = flag_fractions(stats)
+
+    with open(homedir+outname+'.json','w') as fout:
+        json.dump(fractions,fout,indent=1)
+
+    arrays = {}
+    for k in ['antenna_flagged','antenna_total','baseline_flagged','baseline_total','scan_flagged','scan_total']:
+        arrays[k] = stats[k]
+    for s in stats['spw_channel_flagged']:
+        arrays['spw'+str(s)+'_channel_flagged'] = stats['spw_channel_flagged'][s]
+        arrays['spw'+str(s)+'_channel_total']   = stats['spw_channel_total'][s]
+    arrays['antenna_names'] = np.array(stats['antenna_names'])
+    arrays['scans']         = np.array(stats['scans'])
+
+    np.savez_compressed(homedir+outname+'.npz',**arrays)
+
+    return fractions
+
+
+def print_flag_fractions(fractions):
+    """
+    print the flagged fractions
+    """
+    print('\n Flagged fraction total ','{:.3f}'.format(fractions['total']))
+    print(' per spw     ',' '.join([s+':'+'{:.3f}'.format(f) for s,f in fractions['spw'].items()]))
+    print(' per antenna ',' '.join([a+':'+'{:.3f}'.format(f) for a,f in fractions['antenna'].items()]))
+    for ncorr in fractions['correlation']:
+        print(' per correlation ',' '.join(['{:.3f}'.format(f) for f in fractions['correlation'][ncorr]]))
+    print('\n')
@@ -0,0 +1,404 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Native phase-only gain solver (alternative to gaincal gaintype='T'
+# calmode='p')
+#
+# - streams the data (DATA or CORRECTED_DATA) and MODEL_DATA in row
+#   chunks per spw and accumulates per solution interval and
+#   baseline the visibility/model products (python-casacore)
+#
+# - solves all antennas and solution intervals at once with a
+#   vectorized StEFCal iteration (Salvini & Wijnholds 2014),
+#   applies the uvrange cut and minsnr
+#
+# - writes a CASA caltable (T Jones), via the casatools calibrater
+#   if available otherwise with python-casacore
+#
+import os
+import re
+import shutil
+
+import numpy as np
+
+
+#
+# LIBS
+#
+
+global chunk_rows
+
+chunk_rows   = 100000
+
+speed_of_light = 299792458.
+
+# parallel hand correlations (XX,YY,RR,LL)
+#
+parallel_hands = [5,8,9,12]
+
+
+def solint_seconds(solint):
+    """
+    solution interval in seconds ('int' is 0 and 'inf' is -1)
+    """
+    solint = str(solint).strip()
+    if solint == 'int':
+        return 0.
+    if solint == 'inf':
+        return -1.
+
+    match = re.match(r'^(\d+(\.\d+)?)(s|min|h)$',solint)
+    if match == None:
+        raise ValueError('solint wrong format '+solint)
+
+    return float(match.group(1)) * {'s':1.,'min':60.,'h':3600.}[match.group(3)]
+
+
+def uvrange_mask(uvdist_m,freqs,uvrange):
+    """
+    selection of the uvrange (e.g. '>100m', '<20klambda', '0.1~10km')
+    returns a mask of shape (nrow,nchan)
+    """
+    mask = np.ones((len(uvdist_m),len(freqs)),dtype=bool)
+    uvrange = str(uvrange).replace(' ','')
+    if len(uvrange) == 0:
+        return mask
+
+    for sel in uvrange.split(','):
+        match = re.match(r'^([<>]?)(\d+(\.\d+)?)(~(\d+(\.\d+)?))?(m|km|lambda|klambda)$',sel)
+        if match == None:
+            raise ValueError('uvrange wrong format '+sel)
+
+        unit  = match.group(7)
+        scale = {'m':1.,'km':1E3,'lambda':1.,'klambda':1E3}[unit]
+        if 'lambda' in unit:
+            uvdist = uvdist_m[:,None] * freqs[None,:] / speed_of_light
+        else:
+            uvdist = np.repeat(uvdist_m[:,None],len(freqs),axis=1)
+
+        low = float(match.group(2)) * scale
+        if match.group(1) == '>':
+            mask &= uvdist > low
+        elif match.group(1) == '<':
+            mask &= uvdist < low
+        else:
+            high  = float(match.group(5)) * scale if match.group(5) != None else low
+            mask &= (uvdist >= low) & (uvdist <= high)
+
+    return mask
+
+
+def read_ms_layout(msfile):
+    """
+    antennas, spws, correlations, times and scans of the MS
+    """
+    from casacore.tables import table
+
+    layout = {}
+    with table(msfile+'/ANTENNA',ack=False) as ant:
+        layout['antenna_names'] = list(ant.getcol('NAME'))
+
+    with table(msfile+'/DATA_DESCRIPTION',ack=False) as dd:
+        layout['ddid_spw'] = dd.getcol('SPECTRAL_WINDOW_ID')
+        layout['ddid_pol'] = dd.getcol('POLARIZATION_ID')
+
+    with table(msfile+'/SPECTRAL_WINDOW',ack=False) as spw:
+        layout['chan_freq'] = [spw.getcell('CHAN_FREQ',s) for s in range(spw.nrows())]
+
+    with table(msfile+'/POLARIZATION',ack=False) as pol:
+        layout['corr_type'] = [pol.getcell('CORR_TYPE',p) for p in range(pol.nrows())]
+
+    with table(msfile,ack=False) as t:
+        layout['time']  = t.getcol('TIME')
+        layout['scan']  = t.getcol('SCAN_NUMBER')
+        layout['field'] = t.getcol('FIELD_ID')
+        layout['ddid']  = t.getcol('DATA_DESC_ID')
+        layout['ant1']  = t.getcol('ANTENNA1')
+        layout['ant2']  = t.getcol('ANTENNA2')
+        layout['obs']   = t.getcol('OBSERVATION_ID')
+
+    return layout
+
+
+def solution_intervals(layout,solint):
+    """
+    solution interval index of each row, the intervals do not
+    cross scans and fields (combine='')
+    """
+    dt    = solint_seconds(solint)
+    time  = layout['time']
+    scan  = layout['scan']
+
+    # start time of each scan
+    #
+    scans, scan_idx = np.unique(scan,return_inverse=True)
+    scan_start      = np.full(len(scans),np.inf)
+    np.minimum.at(scan_start,scan_idx,time)
+
+    if dt == 0:
+        bins = np.unique(time,return_inverse=True)[1]
+    elif dt < 0:
+        bins = np.zeros(len(time),dtype=int)
+    else:
+        bins = np.floor((time - scan_start[scan_idx]) / dt + 1E-6).astype(int)
+
+    keys = np.stack([layout['field'],scan,bins],axis=1)
+    sol_keys, sol_index = np.unique(keys,axis=0,return_inverse=True)
+
+    return sol_keys, sol_index.ravel()
+
+
+def accumulate(msfile,layout,rows,sol_index,nsol,datacolumn,uvrange):
+    """
+    sum per solution interval and baseline the products of one spw
+    R = sum w V M^*, W = sum w |M|^2, S = sum w |V|^2, N = number of visibilities
+    """
+    from casacore.tables import table
+
+    nant  = len(layout['antenna_names'])
+    ddid  = layout['ddid'][rows[0]]
+    freqs = layout['chan_freq'][layout['ddid_spw'][ddid]]
+    corrs = [i for i,c in enumerate(layout['corr_type'][layout['ddid_pol'][ddid]]) if c in parallel_hands]
+    if len(corrs) == 0:
+        corrs = [0]
+
+    nbl   = nant * nant
+    acc   = {'R':np.zeros(nsol*nbl,dtype=complex),'W':np.zeros(nsol*nbl),'S':np.zeros(nsol*nbl),'N':np.zeros(nsol*nbl)}
+
+    with table(msfile,ack=False) as t:
+        has_weight_spectrum = 'WEIGHT_SPECTRUM' in t.colnames()
+        for start in range(0,len(rows),chunk_rows):
+            chunk = rows[start:start+chunk_rows]
+            sel   = t.selectrows(chunk)
+
+            data  = sel.getcol(datacolumn)[:,:,corrs]
+            model = sel.getcol('MODEL_DATA')[:,:,corrs]
+            flag  = sel.getcol('FLAG')[:,:,corrs] | sel.getcol('FLAG_ROW')[:,None,None]
+            if has_weight_spectrum:
+                try:
+                    weight = sel.getcol('WEIGHT_SPECTRUM')[:,:,corrs]
+                except RuntimeError:
+                    weight = np.repeat(sel.getcol('WEIGHT')[:,None,corrs],data.shape[1],axis=1)
+            else:
+                weight = np.repeat(sel.getcol('WEIGHT')[:,None,corrs],data.shape[1],axis=1)
+
+            uvw    = sel.getcol('UVW')
+            a1, a2 = layout['ant1'][chunk], layout['ant2'][chunk]
+
+            w  = weight * ~flag * uvrange_mask(np.hypot(uvw[:,0],uvw[:,1]),freqs,uvrange)[:,:,None]
+            w[a1 == a2] = 0
+
+            key = sol_index[chunk] * nbl + a1 * nant + a2
+            vm  = (w * data * np.conj(model)).sum(axis=(1,2))
+            acc['R'] += np.bincount(key,weights=vm.real,minlength=nsol*nbl) + 1j * np.bincount(key,weights=vm.imag,minlength=nsol*nbl)
+            acc['W'] += np.bincount(key,weights=(w * np.abs(model)**2).sum(axis=(1,2)),minlength=nsol*nbl)
+            acc['S'] += np.bincount(key,weights=(w * np.abs(data)**2).sum(axis=(1,2)),minlength=nsol*nbl)
+            acc['N'] += np.bincount(key,weights=(w > 0).sum(axis=(1,2)),minlength=nsol*nbl)
+
+    for k in acc:
+        acc[k] = acc[k].reshape(nsol,nant,nant)
+        # hermitian matrices of all baselines
+        if k == 'R':
+            acc[k] = acc[k] + np.conj(np.transpose(acc[k],(0,2,1)))
+        else:
+            acc[k] = acc[k] + np.transpose(acc[k],(0,2,1))
+
+    return acc
+
+
+def stefcal_phase(R,maxiter=100,tol=1E-8):
+    """
+    phase-only StEFCal of all solution intervals at once
+    R [nsol,nant,nant] with R_ij = sum w V_ij M_ij^*
+    """
+    nsol, nant = R.shape[0], R.shape[1]
+    g = np.ones((nsol,nant),dtype=complex)
+
+    for it in range(maxiter):
+        num   = np.einsum('sij,sj->si',R,g)
+        amp   = np.abs(num)
+        g_new = np.where(amp > 0,num / np.maximum(amp,1E-30),g)
+
+        # average every second step for stable convergence
+        if it % 2 == 1:
+            g_new = g_new + g
+            g_new = g_new / np.maximum(np.abs(g_new),1E-30)
+
+        if np.max(np.abs(g_new - g)) < tol:
+            g = g_new
+            break
+        g = g_new
+
+    return g
+
+
+def solve_phase_gains(msfile,refant,solint,uvrange='',minsnr=3.,datacolumn='DATA'):
+    """
+    solve the phase-only gains of all spws
+    returns the solutions (one entry per spw)
+    """
+    layout              = read_ms_layout(msfile)
+    names               = layout['antenna_names']
+    nant                = len(names)
+    sol_keys, sol_index = solution_intervals(layout,solint)
+    nsol                = len(sol_keys)
+
+    refants = [names.index(r) for r in str(refant).split(',') if r in names]
+
+    solutions = []
+    for ddid in np.unique(layout['ddid']):
+        rows = np.flatnonzero(layout['ddid'] == ddid)
+        acc  = accumulate(msfile,layout,rows,sol_index,nsol,datacolumn,uvrange)
+
+        g = stefcal_phase(acc['R'])
+
+        # SNR from the residuals (|g| = 1)
+        #
+        G     = g[:,:,None] * np.conj(g[:,None,:])
+        chi2  = (acc['S'] - 2 * np.real(np.conj(G) * acc['R']) + acc['W']).sum(axis=(1,2)) / 2
+        nvis  = acc['N'].sum(axis=(1,2)) / 2
+        sigma2 = np.where(nvis > nant,chi2 / np.maximum(nvis - nant,1),np.inf)
+        wsum  = acc['W'].sum(axis=2)
+        snr   = np.sqrt(wsum / sigma2[:,None])
+
+        flag  = (wsum == 0) | (snr < minsnr)
+
+        # reference antenna (the next one if flagged)
+        #
+        ref = np.zeros(nsol,dtype=int)
+        for s in range(nsol):
+            valid  = [r for r in refants if not flag[s,r]] + list(np.flatnonzero(~flag[s]))
+            ref[s] = valid[0] if len(valid) > 0 else 0
+        g = g * np.conj(g[np.arange(nsol),ref])[:,None]
+        g[flag] = 1.
+
+        # time and interval of the solutions
+        #
+        t      = layout['time'][rows]
+        sidx   = sol_index[rows]
+        counts = np.bincount(sidx,minlength=nsol)
+        tmean  = np.bincount(sidx,weights=t,minlength=nsol) / np.maximum(counts,1)
+        tmin   = np.full(nsol,np.inf)
+        tmax   = np.full(nsol,-np.inf)
+        np.minimum.at(tmin,sidx,t)
+        np.maximum.at(tmax,sidx,t)
+
+        obs    = np.zeros(nsol,dtype=int)
+        obs[sidx] = layout['obs'][rows]
+
+        present = counts > 0
+        spw     = int(layout['ddid_spw'][ddid])
+        solutions.append({'spw':spw,'freq':float(np.mean(layout['chan_freq'][spw])),'bandwidth':float(np.ptp(layout['chan_freq'][spw])),\
+                              'time':tmean[present],'interval':(tmax-tmin)[present],'field':sol_keys[present,0],'scan':sol_keys[present,1],\
+                              'obs':obs[present],'refant':ref[present],'gains':g[present],'snr':snr[present],'flag':flag[present]})
+
+    return solutions
+
+
+def create_caltable(msfile,caltable):
+    """
+    create an empty T Jones caltable of the MS
+    """
+    from casacore.tables import table, maketabdesc, makescacoldesc, makearrcoldesc
+
+    if os.path.exists(caltable):
+        shutil.rmtree(caltable)
+
+    try:
+        import casatools
+        cb = casatools.calibrater()
+        cb.open(msfile,addcorr=False,addmodel=False)
+        cb.createcaltable(caltable,'Complex','T Jones',True)
+        cb.close()
+        return caltable
+    except ImportError:
+        pass
+
+    desc = maketabdesc([makescacoldesc('TIME',0.,keywords={'QuantumUnits':['s'],'MEASINFO':{'type':'epoch','Ref':'UTC'}}),
+                        makescacoldesc('FIELD_ID',0),makescacoldesc('SPECTRAL_WINDOW_ID',0),
+                        makescacoldesc('ANTENNA1',0),makescacoldesc('ANTENNA2',0),
+                        makescacoldesc('INTERVAL',0.,keywords={'QuantumUnits':['s']}),
+                        makescacoldesc('SCAN_NUMBER',0),makescacoldesc('OBSERVATION_ID',0),
+                        makearrcoldesc('CPARAM',0j,ndim=2),makearrcoldesc('PARAMERR',0.,ndim=2,valuetype='float'),
+                        makearrcoldesc('FLAG',False,ndim=2),makearrcoldesc('SNR',0.,ndim=2,valuetype='float'),
+                        makearrcoldesc('WEIGHT',0.,ndim=2,valuetype='float')])
+
+    with table(caltable,desc,ack=False) as cal:
+        cal.putinfo({'type':'Calibration','subType':'T Jones','readme':''})
+        cal.putkeyword('ParType','Complex')
+        cal.putkeyword('MSName',os.path.basename(msfile.rstrip('/')))
+        cal.putkeyword('VisCal','T Jones')
+        cal.putkeyword('PolBasis','unknown')
+
+        for sub in ['ANTENNA','FIELD','SPECTRAL_WINDOW','OBSERVATION','HISTORY']:
+            if os.path.exists(msfile+'/'+sub):
+                with table(msfile+'/'+sub,ack=False) as subtab:
+                    subtab.copy(caltable+'/'+sub,deep=True)
+                cal.putkeyword(sub,'Table: '+os.path.abspath(caltable+'/'+sub))
+
+    # one channel per spw
+    #
+    with table(caltable+'/SPECTRAL_WINDOW',readonly=False,ack=False) as spw:
+        for s in range(spw.nrows()):
+            freqs = spw.getcell('CHAN_FREQ',s)
+            bw    = float(np.sum(spw.getcell('CHAN_WIDTH',s)))
+            spw.putcell('NUM_CHAN',s,1)
+            spw.putcell('CHAN_FREQ',s,np.array([np.mean(freqs)]))
+            for col in ['CHAN_WIDTH','EFFECTIVE_BW','RESOLUTION']:
+                if col in spw.colnames():
+                    spw.putcell(col,s,np.array([bw]))
+
+    return caltable
+
+
+def write_caltable(msfile,caltable,solutions):
+    """
+    write the solutions into a T Jones caltable
+    """
+    from casacore.tables import table
+
+    create_caltable(msfile,caltable)
+
+    with table(caltable,readonly=False,ack=False) as cal:
+        for sol in solutions:
+            nsol, nant = sol['gains'].shape
+            nrow       = nsol * nant
+            start      = cal.nrows()
+            cal.addrows(nrow)
+
+            snr = sol['snr'].astype(np.float32)
+            cal.putcol('TIME',np.repeat(sol['time'],nant),startrow=start,nrow=nrow)
+            cal.putcol('INTERVAL',np.repeat(sol['interval'],nant),startrow=start,nrow=nrow)
+            cal.putcol('FIELD_ID',np.repeat(sol['field'],nant).astype(np.int32),startrow=start,nrow=nrow)
+            cal.putcol('SCAN_NUMBER',np.repeat(sol['scan'],nant).astype(np.int32),startrow=start,nrow=nrow)
+            cal.putcol('OBSERVATION_ID',np.repeat(sol['obs'],nant).astype(np.int32),startrow=start,nrow=nrow)
+            cal.putcol('SPECTRAL_WINDOW_ID',np.full(nrow,sol['spw'],dtype=np.int32),startrow=start,nrow=nrow)
+            cal.putcol('ANTENNA1',np.tile(np.arange(nant,dtype=np.int32),nsol),startrow=start,nrow=nrow)
+            cal.putcol('ANTENNA2',np.repeat(sol['refant'],nant).astype(np.int32),startrow=start,nrow=nrow)
+            cal.putcol('CPARAM',sol['gains'].reshape(nrow,1,1).astype(np.complex64),startrow=start,nrow=nrow)
+            cal.putcol('PARAMERR',(1. / np.maximum(snr,1E-6)).reshape(nrow,1,1),startrow=start,nrow=nrow)
+            cal.putcol('SNR',snr.reshape(nrow,1,1),startrow=start,nrow=nrow)
+            cal.putcol('FLAG',sol['flag'].reshape(nrow,1,1),startrow=start,nrow=nrow)
+            if 'WEIGHT' in cal.colnames():
+                cal.putcol('WEIGHT',np.ones((nrow,1,1),dtype=np.float32),startrow=start,nrow=nrow)
+
+    return caltable
+
+
+def gaincal_phase(msfile,caltable,solint,refant,uvrange='',minsnr=3.,datacolumn='DATA'):
+    """
+    native replacement of gaincal(gaintype='T',calmode='p')
+    returns the fraction of flagged solutions
+    """
+    solutions = solve_phase_gains(msfile,refant,solint,uvrange,minsnr,datacolumn)
+    write_caltable(msfile,caltable,solutions)
+
+    nflag  = sum([s['flag'].sum() for s in solutions])
+    ntotal = sum([s['flag'].size for s in solutions])
+
+    return nflag / max(ntotal,1)
@@ -28,7 +28,6 @@
 # 1. Prepare the working directory
 #
 #    git clone https://github.com/JonahDW/Image-processing.git
-#    git clone https://github.com/hrkloeck/DASKMSWERKZEUGKASTEN.git
 #    git clone https://github.com/hrkloeck/2GC.git
 # 
 # Start the singularity (important with bind)
@@ -53,10 +52,21 @@ import shutil
 import glob
 import json
 import copy
+import time
+import socket
 #
-import casatasks
 import numpy as np
 import CAL2GC_lib as C2GC
+import MSINFO_lib as MSINFO
+import PLAN_lib as PLAN
+import AUTOTUNE_lib as AUTOTUNE
+import PROFILE_lib as PROF
+import ARTIFACT_lib as ARTIFACT
+import SCRATCH_lib as SCRATCH
+import RUNDB_lib as RUNDB
+import PROGRESS_lib as PROGRESS
+import TASKGRAPH_lib as TASKGRAPH
+import BACKEND_lib as BACKEND
 #
 from optparse import OptionParser
 
@@ -114,6 +124,30 @@ def main():
     parser.add_option('--DODELMAKSIMAGES', dest='dodelmaskimages', action='store_false', default=True,
                       help='delete mask images for LSM modeling. [default delete them]')
 
+    parser.add_option('--PLAN', dest='do_plan', action='store_true', default=False,
+                      help='only show and check the processing steps (dry-run). [default process the data]')
+
+    parser.add_option('--NOPLANCHECK', dest='do_plancheck', action='store_false', default=True,
+                      help='start even if the check of the processing steps fails. [default check]')
+
+    parser.add_option('--AUTOTUNE', dest='do_autotune', action='store_true', default=False,
+                      help='select the wsclean parallelism and memory settings for this host. [default use the imaging default file]')
+
+    parser.add_option('--AUTOTUNE_TRIALS', dest='do_autotune_trials', action='store_true', default=False,
+                      help='run short wsclean trials on a subset of the MS to autotune. [default no trials]')
+
+    parser.add_option('--SCRATCH_DIR', dest='scratchdir', default='', type=str,
+                      help='run on a node-local scratch disk (e.g. /dev/shm/), only caltables and final products are synchronised back. [default use the working directory]')
+
+    parser.add_option('--SCRATCH_KEEP', dest='scratch_keep', action='store_true', default=False,
+                      help='keep the scratch working directory. [default delete it after synchronisation]')
+
+    parser.add_option('--RUNDB', dest='rundb', default='', type=str,
+                      help='run history database e.g. shared by all fields [default C2GC_RUNDB or 2GC_RUNDB.sqlite in the working directory]')
+
+    parser.add_option('--PROGRESS_DIR', dest='progressdir', default='', type=str,
+                      help='directory of the live progress files 2GC_PROGRESS_SOURCE.prom/.json e.g. of the node exporter [default the working directory]')
+
     # ----
 
     (opts, args)         = parser.parse_args()
@@ -147,6 +181,14 @@ def main():
     do_selfcal      = opts.do_selfcal
     do_imaging      = opts.do_imaging
     dodelmaskimages = opts.dodelmaskimages    
+    do_plan         = opts.do_plan
+    do_plancheck    = opts.do_plancheck
+    do_autotune     = opts.do_autotune or opts.do_autotune_trials
+    do_autotune_tr  = opts.do_autotune_trials
+    scratchdir      = opts.scratchdir
+    scratch_keep    = opts.scratch_keep
+    rundb           = opts.rundb
+    progressdir     = opts.progressdir
 
 
 
@@ -167,6 +209,36 @@ def main():
 
     print('\n Use home dir: ',homedir)
     print('\n Use MS file: ',MSFILE,'\n')
+
+    # load and check the imaging default file (once per run)
+    #
+    iminput, input_errors = C2GC.load_input(iminputjson,homedir+'2GC/')
+    if len(input_errors) > 0:
+        PLAN.print_plan([],input_errors,[])
+        print('Imaging default file ',homedir+'2GC/'+iminputjson,' is not accepted')
+        sys.exit(-1)
+
+    # the MS is read from here on (MS information, scratch, autotune)
+    #
+    if not os.path.isdir(homedir+MSFILE):
+        PLAN.print_plan([],['MS file does not exist '+homedir+MSFILE],[])
+        sys.exit(-1)
+
+    # the run history database stays in the working directory
+    #
+    RUNDB.set_rundb_file(rundb if len(rundb) > 0 else os.path.abspath(RUNDB.get_rundb_file(homedir)))
+
+    # the MS is staged onto the scratch disk after the
+    # plan check (see below)
+    #
+    workdir         = homedir
+    if len(scratchdir) > 0:
+        ms_size_bytes = MSINFO.get_ms_metadata(MSFILE,homedir)['ms_size_bytes']
+        if do_plan:
+            scratch_error = SCRATCH.check_scratch_space(scratchdir,ms_size_bytes,3*ARTIFACT.wsclean_output_bytes(imsize,len(eval(spwds))),\
+                                                            SCRATCH.staged_copy_valid(MSFILE,homedir,scratchdir))
+            if len(scratch_error) > 0:
+                print(scratch_error)
     #
     #
     # ===========================
@@ -196,41 +268,113 @@ def main():
 
     selfcal_information  = {}
 
+    PROF.begin_stage('PREPARATION')
+
     # Get the source_name
     source_name          = list(C2GC.get_some_info(MSFILE,homedir))[0]
 
     # === define the default imaging parameter
     #
-    # Get the default imaging parameter 
-    #
-    default_imaging_para = C2GC.get_json(iminputjson,homedir+'2GC/')['IMAGING_DEFAULT']['wsclean_para']
-    #
     # set some specific parameter from the input
     # 
     chan_out             = len(eval(spwds))
     #
-    additional_wsclean_para = {}
-    additional_wsclean_para['-size ']                 = str(imsize)+' '+str(imsize)
-    additional_wsclean_para['-scale']                 = str(bin_size)+'asec'
-    additional_wsclean_para['-pol']                   = imstokes
-    additional_wsclean_para['-channels-out']          = str(chan_out) 
-    additional_wsclean_para['-spws']                  = str(spwds)
+    # the run (stored with the results in the run history database)
     #
-    # combine the defaults 
+    selfcal_information['RUN'] = {'source':source_name,'msfile':MSFILE,'workdir':os.path.abspath(workdir)+'/',\
+                                      'hostname':socket.gethostname(),'backend':BACKEND.backend_name,'start_time':time.time()}
+    selfcal_information['RUN']['parameters'] = {'imsize':imsize,'scale_asec':bin_size,'robust':weighting,'niter':imniter,\
+                                                    'gain':imagegain,'threshold':imthreshold,'spwds':spwds,'chan_out':chan_out,\
+                                                    'stokes':imstokes,'datacolumn':datacol,'selfcal':do_selfcal,'imaging':do_imaging,\
+                                                    'autotune':do_autotune}
     #
-    default_wsclean_para = C2GC.concat_dic(default_imaging_para,additional_wsclean_para)
+    # retention of the image products and disk quota
     #
-
-    # add additional inputs from user
+    ARTIFACT.set_retention_rules(iminput.get('ARTIFACT_RETENTION',{}))
+    #
+    # host depending settings of wsclean (the trials
+    # run after the plan check, see below)
     #
-    additional_imaging_para = C2GC.get_json(iminputjson,homedir+'2GC/')['ADD_WSCLEAN_COMMAND']['wsclean_para']
+    tuned_wsclean_para   = {}
+    if do_autotune:
+        tuned_wsclean_para = AUTOTUNE.get_autotuned_wsclean_para(MSFILE,homedir,\
+                                                                     C2GC.get_imaging_wsclean_para(iminput,imsize,bin_size,imstokes,chan_out,spwds),\
+                                                                     imsize,chan_out,do_trials=False,savecache=not (do_plan or do_autotune_tr))
+        selfcal_information['AUTOTUNE'] = tuned_wsclean_para
+        print('\n Use autotuned wsclean settings: ',tuned_wsclean_para)
     #
-    if len(additional_imaging_para) > 0:
-        full_default_wsclean_para = C2GC.concat_dic(default_wsclean_para,additional_imaging_para)
-    else:
-        full_default_wsclean_para = default_wsclean_para
+    full_default_wsclean_para = C2GC.get_imaging_wsclean_para(iminput,imsize,bin_size,imstokes,chan_out,spwds,tuned_wsclean_para)
+    if len(scratchdir) > 0:
+        full_default_wsclean_para['-temp-dir'] = SCRATCH.scratch_workdir(MSFILE,scratchdir)
+    selfcal_information['RUN']['parameters']['parallel_gridding'] = int(C2GC.get_wsclean_value(full_default_wsclean_para,'-parallel-gridding','1'))
+    selfcal_information['RUN']['parameters']['wsclean_para']      = full_default_wsclean_para
     # ===
 
+
+    # ============================================================================================================
+    # =========  P L A N  check all the processing steps before starting
+    # ============================================================================================================
+    #
+    msinfo             = MSINFO.get_ms_metadata(MSFILE,homedir)
+    #
+    errors, warnings   = PLAN.validate_run(MSFILE,homedir,iminput,spwds,do_selfcal,msinfo)
+    plan               = []
+    #
+    # the self-calibration settings and the wsclean templates of the
+    # stages (also if processing should start despite of the errors)
+    #
+    if len(errors) == 0 or not (do_plan or do_plancheck):
+        default_selfcal_para = C2GC.get_selfcal_settings(iminput['SELFCAL_PARAMETER']) if do_selfcal else {}
+        wsclean_templates    = C2GC.compile_wsclean_templates(full_default_wsclean_para,iminput,[datacol,weighting,imniter,imagegain,imthreshold],\
+                                                                  default_selfcal_para)
+        errors              += C2GC.check_wsclean_templates(wsclean_templates)
+        selfcal_information['RUN']['parameters']['selfcal_para'] = default_selfcal_para
+    if len(errors) == 0:
+        plan           = PLAN.compile_plan(MSFILE,homedir,iminput,wsclean_templates,chan_out,do_selfcal,do_imaging,\
+                                               default_selfcal_para,source_name,msinfo)
+        errors        += PLAN.check_plan(plan)
+
+    if do_plan:
+        PLAN.print_plan(plan,errors,warnings)
+        C2GC.save_to_json(plan,'PLAN_'+source_name+'_2GC.json',homedir)
+        sys.exit()
+
+    if len(errors) > 0:
+        PLAN.print_plan([],errors,warnings)
+        if do_plancheck:
+            print('Check of the processing steps failed, use --PLAN for details or --NOPLANCHECK to ignore')
+            sys.exit(-1)
+
+    # stage the MS onto the scratch disk and
+    # run everything there
+    #
+    if len(scratchdir) > 0:
+        homedir   = SCRATCH.stage_in(MSFILE,workdir,scratchdir,ms_size_bytes,3*ARTIFACT.wsclean_output_bytes(imsize,len(eval(spwds))))
+
+    # trials of the wsclean parallelism (not above the planned
+    # -parallel-gridding, the memory check of the plan holds)
+    #
+    if do_autotune and do_autotune_tr:
+        tuned_wsclean_para = AUTOTUNE.get_autotuned_wsclean_para(MSFILE,homedir,\
+                                                                     C2GC.get_imaging_wsclean_para(iminput,imsize,bin_size,imstokes,chan_out,spwds),\
+                                                                     imsize,chan_out,do_trials=True)
+        selfcal_information['AUTOTUNE'] = tuned_wsclean_para
+        print('\n Use autotuned wsclean settings after the trials: ',tuned_wsclean_para)
+        #
+        full_default_wsclean_para = C2GC.get_imaging_wsclean_para(iminput,imsize,bin_size,imstokes,chan_out,spwds,tuned_wsclean_para)
+        if len(scratchdir) > 0:
+            full_default_wsclean_para['-temp-dir'] = SCRATCH.scratch_workdir(MSFILE,scratchdir)
+        selfcal_information['RUN']['parameters']['parallel_gridding'] = int(C2GC.get_wsclean_value(full_default_wsclean_para,'-parallel-gridding','1'))
+        selfcal_information['RUN']['parameters']['wsclean_para']      = full_default_wsclean_para
+        wsclean_templates    = C2GC.compile_wsclean_templates(full_default_wsclean_para,iminput,[datacol,weighting,imniter,imagegain,imthreshold],\
+                                                                  default_selfcal_para)
+
+    # live progress and ETA of the planned steps
+    #
+    PROGRESS.start_progress(plan,progressdir if len(progressdir) > 0 else workdir,source_name,MSFILE)
+
+    PROF.end_stage()
+
     
 
     # ============================================================================================================
@@ -240,37 +384,46 @@ def main():
     #
     if do_selfcal: 
 
+        PROF.begin_stage('SELFCAL')
+        PROGRESS.set_stage('SELFCAL')
+
         #
-        # Get the default selcal parameter from json file 
-        #
-        default_selfcal_para = C2GC.get_json(iminputjson,homedir+'2GC/')['SELFCAL_PARAMETER'] 
+        # the selfcal parameter of the imaging default file (see above)
         #
         selfcal_modes        = default_selfcal_para['selfcal_modes']
         selfcal_solint       = default_selfcal_para['selfcal_solint']
-        selfcal_threshold    = default_selfcal_para['selfcal_threshold']
-        selfcal_weighting    = default_selfcal_para['selfcal_weighting']
 
         selfcal_uvrange      = default_selfcal_para['uvrange']
         selfcal_refant       = default_selfcal_para['ref_ant']
 
-        # Enlarge some of the self-calibration input 
+        # the per round self-calibration input 
+        # (enlarged to the number of rounds)
         #
-        selfcal_data         = C2GC.enlarge_selcal_input(selfcal_modes,default_selfcal_para['selfcal_data'])
-        selfcal_interp       = C2GC.enlarge_selcal_input(selfcal_modes,default_selfcal_para['selfcal_interp'])
-        selfcal_niter        = C2GC.enlarge_selcal_input(selfcal_modes,default_selfcal_para['selfcal_niter'])
-        selfcal_gain         = C2GC.enlarge_selcal_input(selfcal_modes,default_selfcal_para['selfcal_gain'])
-        selfcal_mgain        = C2GC.enlarge_selcal_input(selfcal_modes,default_selfcal_para['selfcal_mgain'])
-        selfcal_usemaskfile  = C2GC.enlarge_selcal_input(selfcal_modes,default_selfcal_para['selfcal_usemaskfile'])
+        selfcal_data         = default_selfcal_para['selfcal_data']
+        selfcal_interp       = default_selfcal_para['selfcal_interp']
+        selfcal_niter        = default_selfcal_para['selfcal_niter']
+        selfcal_mgain        = default_selfcal_para['selfcal_mgain']
+        selfcal_usemaskfile  = default_selfcal_para['selfcal_usemaskfile']
 
         # being conservative delete the model in the MS dataset
         #
         C2GC.delmodel(MSFILE,homedir)
 
+        # flag statistics before the self-calibration
+        #
+        do_flagstats         = default_selfcal_para.get('selfcal_flagstats',True)
+        flag_memory_mb       = default_selfcal_para.get('selfcal_flag_memory_mb',None)
+        if do_flagstats:
+            selfcal_information['FLAGSTATS_START'] = C2GC.flag_statistics(MSFILE,homedir,'SC_START_FLAGSTATS',memory_mb=flag_memory_mb)
         
         # Do 2GC self-calibration using CASA and PYBDSF as source finder 
         #
         addgaintable, addinterp = [],[]
 
+        # CORRECTED_DATA is only written once a caltable is accepted
+        #
+        calibrated              = False
+
         for sc in range(len(selfcal_modes)):
 
             # bookeeping
@@ -280,38 +433,45 @@ def main():
             selfcal_information['SC'+str(sc)] = {}
             sc_marker = sc
 
-            # set imaging parameter for masking 
-            #
-            additional_wsclean_para_ma = {}
-            additional_wsclean_para_ma['-weight briggs']            = str(selfcal_weighting)
-            additional_wsclean_para_ma['-threshold']                = str(selfcal_threshold)
-            additional_wsclean_para_ma['-data-column']              = selfcal_data[sc]
-            additional_wsclean_para_ma['-niter']                    = str(selfcal_niter[sc])
-            additional_wsclean_para_ma['-gain']                     = str(selfcal_gain[sc])
-            additional_wsclean_para_ma['-mgain']                    = str(selfcal_mgain[sc])
-            additional_wsclean_para_ma['-no-update-model-required'] = ''
-            #
-            if chan_out > 1:
-                additional_wsclean_para_ma['-join-channels']        = ''
-                additional_wsclean_para_ma['-no-mf-weighting']      = ''
-
-            # === 
+            PROF.begin_stage('SC'+str(sc),mode=selfcal_modes[sc])
+            PROGRESS.set_stage('SC'+str(sc),sc)
 
+            # image geometry of this round
+            #
+            sc_imsize, sc_scale = C2GC.get_selfcal_geometry(full_default_wsclean_para,default_selfcal_para,sc)
+            selfcal_information['SC'+str(sc)]['imsize'] = [sc_imsize,sc_scale]
 
-            # add additional inputs from user
+            # spectral setting of this round (snr of the previous round)
             #
-            additional_sc_imaging_para = C2GC.get_json(iminputjson,homedir+'2GC/')['ADD_SELFCAL_WSCLEAN_COMMAND']['wsclean_para']
+            snr = 0
+            if sc > 0:
+                snr = C2GC.get_round_snr(selfcal_information['SC'+str(sc-1)]['pybdsf_info_b4_masking'])
+            spectral             = C2GC.get_spectral_setting(MSFILE,homedir,spwds,chan_out,selfcal_modes[sc],snr,iminput.get('SPECTRAL_SETTING',{}))
+            sc_chan_out          = spectral['chan_out']
+            selfcal_information['SC'+str(sc)]['spectral'] = spectral
+
+            # frequencies of the output channels for the model flux density
             #
-            if len(additional_sc_imaging_para) > 0:
-                f_additional_wsclean_para_ma = C2GC.concat_dic(additional_wsclean_para_ma,additional_sc_imaging_para)
-            else:
-                f_additional_wsclean_para_ma = additional_wsclean_para_ma
-            # ===
+            chan_freqs           = C2GC.get_channel_frequencies(MSFILE,homedir,spwds,sc_chan_out)
 
-            
-            # get the full set of imaging parameter
+            # make room for the images of this round
+            #
+            if not ARTIFACT.enforce_disk_quota(homedir,2*ARTIFACT.wsclean_output_bytes(sc_imsize,sc_chan_out)):
+                selfcal_information['ARTIFACTS'] = ARTIFACT.get_artifact_summary()
+                C2GC.save_to_json(selfcal_information,'FINAL_IMAGE_'+source_name+'_SELFCALINFO'+fim_imagedir_ext+'.json',workdir)
+                print('Stop, not enough disk space for the images of SC-step ',sc)
+                sys.exit(-1)
+
+            # set imaging parameter for masking 
             #
-            full_set_of_wsclean_para_ma = C2GC.concat_dic(full_default_wsclean_para,f_additional_wsclean_para_ma)
+            full_set_of_wsclean_para_ma = C2GC.get_selfcal_wsclean_para(wsclean_templates,default_selfcal_para,sc,sc_chan_out,\
+                                                                        fit_spectral_pol=spectral['fit_spectral_pol'])
+            full_set_of_wsclean_para_ma, bda = C2GC.set_baseline_averaging(MSFILE,homedir,full_set_of_wsclean_para_ma,iminput.get('BASELINE_AVERAGING',{}),'selfcal')
+            selfcal_information['SC'+str(sc)]['baseline_averaging'] = bda
+            full_set_of_wsclean_para_ma, data_fallback = C2GC.uncalibrated_data_column(full_set_of_wsclean_para_ma,calibrated)
+            if data_fallback:
+                print('No caltable accepted so far, image the DATA column')
+                selfcal_information['SC'+str(sc)]['data_column_fallback'] = 'DATA'
 
 
             # Generates a mask files
@@ -326,39 +486,19 @@ def main():
             # If needed add a mask to be used instead
             #
             if len(selfcal_usemaskfile[sc]) > 0:
-                mask_file = selfcal_usemaskfile[sc]
+                mask_file = C2GC.regrid_mask(selfcal_usemaskfile[sc],sc_imsize,sc_scale,homedir)
 
             selfcal_information['SC'+str(sc)]['MASK'] = mask_file
 
 
             # set imaging parameter for model generation
             #
-            additional_wsclean_para_sc = {} 
-            additional_wsclean_para_sc['-weight briggs']            = str(selfcal_weighting)
-            additional_wsclean_para_sc['-threshold']                = str(selfcal_threshold)
-            additional_wsclean_para_sc['-data-column']              = selfcal_data[sc]
-            additional_wsclean_para_sc['-niter']                    = str(selfcal_niter[sc])
-            additional_wsclean_para_sc['-mgain']                    = str(selfcal_mgain[sc])
-            additional_wsclean_para_sc['-fits-mask']                = homedir+mask_file
-
-            if chan_out > 1:
-                additional_wsclean_para_sc['-join-channels']        = ''
-                additional_wsclean_para_sc['-no-mf-weighting']      = ''
-
-
-            # add additional inputs from user
-            #
-            additional_sc_imaging_para = C2GC.get_json(iminputjson,homedir+'2GC/')['ADD_SELFCAL_WSCLEAN_COMMAND']['wsclean_para']
-            #
-            if len(additional_sc_imaging_para) > 0:
-                f_additional_wsclean_para_sc = C2GC.concat_dic(additional_wsclean_para_sc,additional_sc_imaging_para)
-            else:
-                f_additional_wsclean_para_sc = additional_wsclean_para_sc
-            
-            # get the full set of imaging parameter
-            #
-            full_set_of_wsclean_para_sc = C2GC.concat_dic(full_default_wsclean_para,f_additional_wsclean_para_sc)
-
+            full_set_of_wsclean_para_sc = C2GC.get_selfcal_wsclean_para(wsclean_templates,default_selfcal_para,sc,sc_chan_out,mask_file,homedir,\
+                                                                        spectral['fit_spectral_pol'])
+            full_set_of_wsclean_para_sc, bda = C2GC.set_baseline_averaging(MSFILE,homedir,full_set_of_wsclean_para_sc,iminput.get('BASELINE_AVERAGING',{}),'selfcal')
+            full_set_of_wsclean_para_sc, data_fallback = C2GC.uncalibrated_data_column(full_set_of_wsclean_para_sc,calibrated)
+            if data_fallback:
+                selfcal_information['SC'+str(sc)]['data_column_fallback'] = 'DATA'
             # ===
 
 
@@ -367,31 +507,33 @@ def main():
             outname        = 'MODIM'+str(sc_marker)
             images         = C2GC.make_image(MSFILE,outname,homedir,full_set_of_wsclean_para_sc)
 
-            # determine the stats of the model subtracted image
+            # post-processing of the model images: the stats of the model
+            # subtracted image and the entire flux density of the model
+            # (from the wsclean component list) run concurrently, the
+            # images are moved when both are done
             #
-            if chan_out > 1:
+            if sc_chan_out > 1:
                 stats_image    = outname+'-MFS-residual.fits'
             else:
                 stats_image    = outname+'-residual.fits'
+            scdir          = 'SC_'+str(sc_marker)+'_MODEL'+'/'
 
-            selfcal_information['SC'+str(sc)]['Stats'] = C2GC.get_imagestats(stats_image,homedir)
+            postproc       = TASKGRAPH.new_graph('SC'+str(sc_marker)+'_POSTPROCESSING')
+            TASKGRAPH.add_task(postproc,'stats',C2GC.get_imagestats,stats_image,homedir)
+            TASKGRAPH.add_task(postproc,'model_flux',C2GC.get_model_flux,outname,homedir,chan_freqs,threshold=0)
+            TASKGRAPH.add_task(postproc,'store_products',ARTIFACT.store_products,outname,scdir,'model_images',sc_marker,homedir,\
+                                   deps=['stats','model_flux'])
+            postproc_results = TASKGRAPH.run_graph(postproc)
 
-            # provide the entire flux density of the model
+            model_info     = postproc_results['model_flux']
             #
-            if chan_out > 1:
-                stats_image    = outname+'-MFS-model.fits'
-            else:
-                stats_image    = outname+'-model.fits'
-
-            selfcal_information['SC'+str(sc)]['Model'] = [C2GC.sum_imageflux(stats_image,homedir,threshold=0)]
-
-            # need to clean up the images
-            #
-            scdir = 'SC_'+str(sc_marker)+'_MODEL'+'/'
-            os.mkdir(homedir+scdir)
-            get_files = sorted(glob.glob(homedir+outname+'*'),key=os.path.getmtime)
-            for im in get_files:
-                shutil.move(im,homedir+scdir)
+            selfcal_information['SC'+str(sc)]['Stats']       = postproc_results['stats']
+            selfcal_information['SC'+str(sc)]['Model']       = [[model_info['total_flux_jy'],model_info['unit']]]
+            selfcal_information['SC'+str(sc)]['Model_info']  = model_info
+            if sc > 0:
+                selfcal_information['SC'+str(sc)]['Model_growth_jy'] = model_info['total_flux_jy'] - \
+                                                   selfcal_information['SC'+str(sc-1)]['Model_info']['total_flux_jy']
+            selfcal_information['SC'+str(sc)]['TASKGRAPH']   = TASKGRAPH.get_graph_summary(postproc)
 
 
             # Generates a calibration table
@@ -400,7 +542,19 @@ def main():
             
             CALTAB  = 'SC'+str(sc_marker)+'_CALTAB_'+selfcal_modes[sc]
 
-            addgaintable, addinterp = C2GC.calib_data(MSFILE,CALTAB,homedir,selfcal_solint[sc],selfcal_modes[sc],selfcal_refant,selfcal_uvrange,selfcal_interp[sc],addgaintable,addinterp)
+            addgaintable, addinterp, calstats = C2GC.calib_data(MSFILE,CALTAB,homedir,selfcal_solint[sc],selfcal_modes[sc],selfcal_refant,selfcal_uvrange,selfcal_interp[sc],addgaintable,addinterp,\
+                                                          default_selfcal_para.get('selfcal_solver','casa'),default_selfcal_para.get('selfcal_applycal','casa'),\
+                                                          default_selfcal_para.get('selfcal_max_flagged_solutions',1.),default_selfcal_para.get('selfcal_badant_nsigma',0))
+
+            selfcal_information['SC'+str(sc)]['CALSTATS'] = calstats
+            round_rejected = calstats.get('rejected',False)
+            calibrated     = len(addgaintable) > 0
+
+            # summary plot of the solutions
+            #
+            if len(calstats) > 0 and not round_rejected:
+                pltfiles = C2GC.plot_calsolutions(CALTAB,homedir,selfcal_modes[sc],'SC'+str(sc_marker)+'_CALSOL_'+selfcal_modes[sc],calstats)
+                ARTIFACT.move_files(pltfiles,homedir+scdir)
 
             # store calibrations to account for
             # the individual calibration steps 
@@ -409,6 +563,17 @@ def main():
             selfcal_information['SC'+str(sc)]['calip_setting'] = [selfcal_niter[sc],selfcal_data[sc],selfcal_mgain[sc],selfcal_solint[sc],selfcal_modes[sc]]
             selfcal_information['SC'+str(sc)]['calip_inter']   = [copy.copy(addgaintable),copy.copy(addinterp)]
 
+            # flag the outliers of the residual visibilities
+            #
+            if default_selfcal_para.get('selfcal_resiflag',False) and not round_rejected:
+                selfcal_information['SC'+str(sc)]['RESIFLAG'] = C2GC.residual_flagging(MSFILE,homedir,default_selfcal_para.get('selfcal_resiflag_nsigma',5.),\
+                                                                                                     memory_mb=flag_memory_mb)
+
+            # flag statistics after the calibration
+            #
+            if do_flagstats:
+                selfcal_information['SC'+str(sc)]['FLAGSTATS'] = C2GC.flag_statistics(MSFILE,homedir,'SC'+str(sc_marker)+'_FLAGSTATS',memory_mb=flag_memory_mb)
+
 
             # produce bsl shadems images
             #    
@@ -418,8 +583,7 @@ def main():
                 pltfiles = C2GC.plot_check_cal(MSFILE,homedir,plotype,figurename)
                 #
                 # move the images
-                for im in pltfiles:
-                    shutil.move(im,homedir+scdir)
+                ARTIFACT.move_files(pltfiles,homedir+scdir)
 
             if selfcal_modes[sc] == 'ap':
                 figurename = 'SC'+str(sc_marker)+'_CALCHECK_'+selfcal_modes[sc]
@@ -430,19 +594,22 @@ def main():
                 plotype = 'amp'
                 pltfiles = C2GC.plot_check_cal(MSFILE,homedir,plotype,figurename)
                 # move the images
-                for im in pltfiles:
-                    shutil.move(im,homedir+scdir)
+                ARTIFACT.move_files(pltfiles,homedir+scdir)
 
 
             # being conservative delete the model in the MS dataset
             #
             C2GC.delmodel(MSFILE,homedir)
 
+            PROF.end_stage()
+
         # store casa log file to current directory 
         #
         current_casa_log = C2GC.find_CASA_logfile(checkdir='HOME',homedir='')
         if len(current_casa_log) > 0:
-            shutil.move(current_casa_log,homedir)    
+            ARTIFACT.move_files([current_casa_log],homedir)    
+
+        PROF.end_stage()
 
 
 
@@ -453,42 +620,34 @@ def main():
     #
     if do_imaging: 
 
+        PROF.begin_stage('FINAL_IMAGING')
+        PROGRESS.set_stage('FINAL_IMAGING')
+
+        if not ARTIFACT.enforce_disk_quota(homedir,ARTIFACT.wsclean_output_bytes(imsize,chan_out)):
+            selfcal_information['ARTIFACTS'] = ARTIFACT.get_artifact_summary()
+            C2GC.save_to_json(selfcal_information,'FINAL_IMAGE_'+source_name+'_SELFCALINFO'+fim_imagedir_ext+'.json',workdir)
+            print('Stop, not enough disk space for the final images')
+            sys.exit(-1)
+
         # that for the time being ok, but need source name here
         #
         outname       = 'FINAL_SC_IMAGE_'+source_name
 
 
-        # Set the imaging parameters
+        # Set the imaging parameters (the data column is the
+        # one of the last self-calibration round, see the templates)
         #
-        additional_wsclean_para = {} 
+        final_spectral            = C2GC.get_spectral_setting(MSFILE,homedir,spwds,chan_out,None,0,iminput.get('SPECTRAL_SETTING',{}))
+        selfcal_information['FINAL_SPECTRAL'] = final_spectral
         #
+        final_set_of_wsclean_para = C2GC.get_final_wsclean_para(wsclean_templates,chan_out,final_spectral['fit_spectral_pol'])
+        final_set_of_wsclean_para, bda = C2GC.set_baseline_averaging(MSFILE,homedir,final_set_of_wsclean_para,iminput.get('BASELINE_AVERAGING',{}),'final')
+        selfcal_information['FINAL_BASELINE_AVERAGING'] = bda
         if do_selfcal:
-            additional_wsclean_para['-data-column']              = selfcal_data[-1]
-        else:
-            additional_wsclean_para['-data-column']              = datacol
-
-        additional_wsclean_para['-weight briggs']            = str(weighting)
-        additional_wsclean_para['-niter']                    = str(imniter)
-        additional_wsclean_para['-gain']                     = str(imagegain)
-        additional_wsclean_para['-threshold']                = str(imthreshold)
-        additional_wsclean_para['-no-update-model-required'] = ''
-        if chan_out > 1:
-            additional_wsclean_para['-join-channels']        = ''
-            additional_wsclean_para['-no-mf-weighting']      = ''
-        
-
-        # add additional inputs from user
-        #
-        additional_imaging_para = C2GC.get_json(iminputjson,homedir+'2GC/')['ADD_WSCLEAN_COMMAND']['wsclean_para']
-        #
-        if len(additional_imaging_para) > 0:
-                f_additional_wsclean_para = C2GC.concat_dic(additional_wsclean_para,additional_imaging_para)
-        else:
-                f_additional_wsclean_para = additional_wsclean_para
-            
-        # get the full set of imaging parameter
-        #
-        final_set_of_wsclean_para = C2GC.concat_dic(full_default_wsclean_para,f_additional_wsclean_para)
+            final_set_of_wsclean_para, data_fallback = C2GC.uncalibrated_data_column(final_set_of_wsclean_para,calibrated)
+            if data_fallback:
+                print('No caltable has been accepted, image the DATA column')
+                selfcal_information['FINAL_DATA_COLUMN_FALLBACK'] = 'DATA'
         # ===
 
 
@@ -496,45 +655,90 @@ def main():
         #
         images = C2GC.make_image(MSFILE,outname,homedir,final_set_of_wsclean_para)
 
-        # get stats 
+        # post-processing of the final images: the stats of the residual
+        # images (every channel) and the cataloger and source finding run
+        # concurrently, the images are moved after the stats and the
+        # parsing of the pybdsf log
         #
         get_residual_files = sorted(glob.glob(homedir+outname+'*'+'residual.fits'),key=os.path.getmtime)
-        selfcal_information['FINALIMAGES'] = {}
         #
+        if chan_out > 1:
+            final_image    = outname+'-MFS-image.fits'
+        else:
+            final_image    = outname+'-image.fits'
+        scdir              = 'FINAL_'+source_name+'_IMAGES'+fim_imagedir_ext+'/'
+
+        postproc           = TASKGRAPH.new_graph('FINAL_POSTPROCESSING')
+        stats_keys         = []
         for rsidat in get_residual_files:
             resi_file_name = rsidat.replace(homedir,'')
             file_key       = 'Stats_'+rsidat.replace(homedir,'').replace(outname,'').replace('residual.fits','').replace('-','')
-            selfcal_information['FINALIMAGES'][file_key] = C2GC.get_imagestats(resi_file_name,homedir)
-
-        # run cataloger and source finding
+            TASKGRAPH.add_task(postproc,file_key,C2GC.get_imagestats,resi_file_name,homedir)
+            stats_keys.append(file_key)
         #
-        if chan_out > 1:
-            final_image    = outname+'-MFS-image.fits'
-        homedir,pybdsf_dir,pybdsf_log = C2GC.cataloging_fits(final_image,homedir)
-        pybdsf_info = C2GC.get_info_from_pybdsflog(pybdsf_log,pybdsf_dir+'/',homedir+'/')
+        TASKGRAPH.add_task(postproc,'cataloging',C2GC.cataloging_fits,final_image,homedir)
+        TASKGRAPH.add_task(postproc,'pybdsf_info',lambda catalog: C2GC.get_info_from_pybdsflog(catalog[2],catalog[1]+'/',catalog[0]+'/'),\
+                               TASKGRAPH.result_of('cataloging'))
+        TASKGRAPH.add_task(postproc,'store_products',ARTIFACT.store_products,outname,scdir,'final_images',0,homedir,\
+                               deps=stats_keys+['pybdsf_info'])
+        postproc_results   = TASKGRAPH.run_graph(postproc)
 
         # collect information on the model, the noise etc.
         #
-        selfcal_information['FINALIMAGES']['pybdsf_info'] = pybdsf_info
+        selfcal_information['FINALIMAGES'] = {}
+        for file_key in stats_keys:
+            selfcal_information['FINALIMAGES'][file_key] = postproc_results[file_key]
+        selfcal_information['FINALIMAGES']['pybdsf_info'] = postproc_results['pybdsf_info']
+        selfcal_information['FINAL_TASKGRAPH']            = TASKGRAPH.get_graph_summary(postproc)
+        TASKGRAPH.print_graph_summary(selfcal_information['FINAL_TASKGRAPH'],postproc['name'])
 
-        # need to clean up the images
-        #
-        scdir = 'FINAL_'+source_name+'_IMAGES'+fim_imagedir_ext+'/'
-        os.mkdir(homedir+scdir)
-        get_files = sorted(glob.glob(homedir+outname+'*'),key=os.path.getmtime)
-        for im in get_files:
-            shutil.move(im,homedir+scdir)
+        PROF.end_stage()
 
 
     # ============================================================================================================
     # =========  S A V E  I N F O R M A T I O N 
     # ============================================================================================================
     #
+    # finish the background deletions
+    #
+    ARTIFACT.wait_for_deletions()
+    selfcal_information['ARTIFACTS'] = ARTIFACT.get_artifact_summary()
+    #
+    # timeline and summary of the stages
+    #
+    selfcal_information['PROFILE'] = PROF.get_stage_summary()
+    PROF.print_stage_summary(selfcal_information['PROFILE'])
+    PROF.save_chrome_trace('FINAL_IMAGE_'+source_name+'_TRACE'+fim_imagedir_ext+'.json',homedir)
+    #
+    selfcal_information['RUN']['end_time'] = time.time()
+    #
     self_cal_info = 'FINAL_IMAGE_'+source_name+'_SELFCALINFO'+fim_imagedir_ext+'.json'
     if len(self_cal_info) > 0:
         C2GC.save_to_json(selfcal_information,self_cal_info,homedir)
 
+    # keep the timings for the runtime estimates of the next runs
+    #
+    C2GC.save_step_timings(homedir,PLAN.runtime_history_file)
+
+    # add the run to the run history database
+    #
+    try:
+        RUNDB.add_run(RUNDB.get_rundb_file(workdir),C2GC.get_json(self_cal_info,homedir),workdir+self_cal_info,source_name,C2GC.step_timings)
+    except RUNDB.sqlite3.Error as err:
+        print('Run history database ',RUNDB.get_rundb_file(workdir),' not updated: ',err)
+
+    # synchronise the products from the scratch disk
+    #
+    if homedir != workdir:
+        SCRATCH.stage_out(homedir,workdir,scratch_keep)
+
+    PROGRESS.finish_progress()
+
     print('finish !')
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except BaseException:
+        PROGRESS.finish_progress('failed')
+        raise
@@ -32,7 +32,6 @@ import glob
 import json
 import copy
 #
-import casatasks
 import numpy as np
 import CAL2GC_lib as C2GC
 
@@ -46,7 +45,6 @@ import CAL2GC_lib as C2GC
 # 1. Prepare the working directory
 #
 #    git clone https://github.com/JonahDW/Image-processing.git
-#    git clone https://github.com/hrkloeck/DASKMSWERKZEUGKASTEN.git
 #    git clone https://github.com/hrkloeck/2GC.git
 #
 # 3. copy your MS file into the directory
@@ -0,0 +1,213 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Lightweight access to the meta data of a MS
+#
+# - only the FIELD, SPECTRAL_WINDOW, ANTENNA and OBSERVATION
+#   sub-tables are read (python-casacore), the visibilities
+#   are never touched
+#
+# - the result is cached in a sidecar JSON file next to the MS
+#   (MSFILE_MSINFO.json) and is re-used as long as the
+#   modification time of the MS has not changed
+#
+import os
+import json
+
+import numpy as np
+
+
+#
+# LIBS
+#
+
+global msinfo_version
+
+msinfo_version = 1
+
+
+def msinfo_cachefile(MSFILE,homedir=''):
+    """
+    name of the sidecar JSON file of the MS
+    """
+    return homedir + MSFILE.rstrip('/') + '_MSINFO.json'
+
+
+def ms_modification_time(msfile):
+    """
+    return the latest modification time of the MS
+
+    only the top level of the MS directory is checked,
+    every write into the main table changes one of those
+    entries (the lock file is touched by every reader)
+    """
+    mtime = 0.
+    for entry in os.scandir(msfile):
+        if entry.name != 'table.lock':
+            mtime = max(mtime,entry.stat().st_mtime)
+
+    return mtime
+
+
+def ms_disk_size(msfile):
+    """
+    return the size of the MS on disk in bytes
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(msfile):
+        for f in filenames:
+            fp = os.path.join(dirpath,f)
+            if not os.path.islink(fp):
+                size += os.path.getsize(fp)
+
+    return size
+
+
+def read_ms_metadata(msfile):
+    """
+    read the meta data of the MS
+    (FIELD, SPECTRAL_WINDOW, ANTENNA and OBSERVATION sub-tables)
+    """
+    from casacore.tables import table
+
+    msinfo = {}
+
+    # main table only the number of rows and the integration time
+    #
+    maintab            = table(msfile,readonly=True,ack=False)
+    msinfo['nrows']    = maintab.nrows()
+    if maintab.nrows() > 0:
+        msinfo['integration_time_s'] = float(maintab.getcell('INTERVAL',0))
+    else:
+        msinfo['integration_time_s'] = 0.
+    maintab.close()
+
+    # source information
+    #
+    fieldtab                 = table(msfile+'/FIELD',readonly=True,ack=False)
+    msinfo['source_names']   = list(fieldtab.getcol('NAME'))
+    phase_dir                = fieldtab.getcol('PHASE_DIR')[:,0,:]
+    msinfo['field_dir_deg']  = np.rad2deg(phase_dir).tolist()
+    fieldtab.close()
+
+    # spectral information
+    #
+    spwtab = table(msfile+'/SPECTRAL_WINDOW',readonly=True,ack=False)
+    msinfo['spw'] = []
+    for i in range(spwtab.nrows()):
+        chan_freq  = spwtab.getcell('CHAN_FREQ',i)
+        chan_width = spwtab.getcell('CHAN_WIDTH',i)
+        spw_info = {}
+        spw_info['nchan']           = len(chan_freq)
+        spw_info['ref_freq_hz']     = float(spwtab.getcell('REF_FREQUENCY',i))
+        spw_info['min_freq_hz']     = float(np.min(chan_freq))
+        spw_info['max_freq_hz']     = float(np.max(chan_freq))
+        spw_info['chan_width_hz']   = float(np.abs(chan_width).mean())
+        spw_info['bandwidth_hz']    = float(spwtab.getcell('TOTAL_BANDWIDTH',i))
+        msinfo['spw'].append(spw_info)
+    spwtab.close()
+
+    # antenna information
+    #
+    anttab                  = table(msfile+'/ANTENNA',readonly=True,ack=False)
+    msinfo['antenna_names'] = list(anttab.getcol('NAME'))
+    ant_pos                 = anttab.getcol('POSITION')
+    anttab.close()
+    #
+    bsl_length              = np.sqrt(np.sum((ant_pos[:,None,:] - ant_pos[None,:,:])**2,axis=-1))
+    msinfo['max_baseline_m'] = float(bsl_length.max()) if len(ant_pos) > 0 else 0.
+
+    # observation information
+    #
+    obstab                  = table(msfile+'/OBSERVATION',readonly=True,ack=False)
+    time_range              = obstab.getcol('TIME_RANGE')
+    msinfo['telescope']     = list(obstab.getcol('TELESCOPE_NAME'))
+    obstab.close()
+    #
+    msinfo['time_range_s']  = [float(time_range[:,0].min()),float(time_range[:,1].max())]
+
+    return msinfo
+
+
+def get_ms_metadata(MSFILE,homedir='',usecache=True):
+    """
+    return the meta data of the MS,
+    uses the sidecar JSON file if the MS has not been modified
+    """
+    msfile    = homedir + MSFILE
+    cachefile = msinfo_cachefile(MSFILE,homedir)
+    mtime     = ms_modification_time(msfile)
+
+    if usecache and os.path.exists(cachefile):
+        try:
+            with open(cachefile) as f:
+                msinfo = json.load(f)
+            if msinfo.get('ms_mtime') == mtime and msinfo.get('msinfo_version') == msinfo_version:
+                return msinfo
+        except (OSError,ValueError):
+            pass
+
+    msinfo                   = read_ms_metadata(msfile)
+    msinfo['msfile']         = MSFILE
+    msinfo['ms_mtime']       = mtime
+    msinfo['ms_size_bytes']  = ms_disk_size(msfile)
+    msinfo['msinfo_version'] = msinfo_version
+
+    # write the sidecar, a read-only directory just means no caching
+    #
+    try:
+        with open(cachefile,'w') as fout:
+            json.dump(msinfo,fout,indent=4)
+    except OSError:
+        print('Caution could not write MS info cache file ',cachefile)
+
+    return msinfo
+
+
+def get_source_name(MSFILE,homedir='',field_id=0):
+    """
+    return the source name of the field
+    """
+    return get_ms_metadata(MSFILE,homedir)['source_names'][field_id]
+
+
+def get_spw_frequencies(msinfo,spwds=None):
+    """
+    return the centre frequencies [Hz] of the selected spectral windows
+    spwds is a string like '0,1,2' or a list of integers
+    """
+    if spwds is None:
+        spw_ids = range(len(msinfo['spw']))
+    elif isinstance(spwds,str):
+        spw_ids = [int(s) for s in spwds.split(',') if len(s.strip()) > 0]
+    else:
+        spw_ids = spwds
+
+    freqs = []
+    for s in spw_ids:
+        spw_info = msinfo['spw'][s]
+        freqs.append(0.5 * (spw_info['min_freq_hz'] + spw_info['max_freq_hz']))
+
+    return freqs
+
+
+def get_fractional_bandwidth(msinfo,spwds=None):
+    """
+    return the fractional bandwidth of the selected spectral windows
+    """
+    if spwds is None:
+        spw_ids = range(len(msinfo['spw']))
+    elif isinstance(spwds,str):
+        spw_ids = [int(s) for s in spwds.split(',') if len(s.strip()) > 0]
+    else:
+        spw_ids = spwds
+
+    min_freq = min([msinfo['spw'][s]['min_freq_hz'] - 0.5 * msinfo['spw'][s]['chan_width_hz'] for s in spw_ids])
+    max_freq = max([msinfo['spw'][s]['max_freq_hz'] + 0.5 * msinfo['spw'][s]['chan_width_hz'] for s in spw_ids])
+
+    return (max_freq - min_freq) / (0.5 * (max_freq + min_freq))
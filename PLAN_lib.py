@@ -0,0 +1,468 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Dry-run of the self-calibration and final imaging
+#
+# - expands the run into the explicit list of wsclean, CASA
+#   and source finding commands with the resolved parameter
+#
+# - validates the input before any processing is done
+#
+# - estimates the memory of each step (image size, channels-out
+#   and MS size) and the runtime of each step from the timings
+#   of previous runs (run history database RUNDB_lib and
+#   2GC_RUNTIME_HISTORY.json)
+#
+import os
+import re
+import shutil
+
+import numpy as np
+
+import CAL2GC_lib as C2GC
+import BACKEND_lib as BACKEND
+import RUNDB_lib as RUNDB
+
+
+#
+# LIBS
+#
+
+global runtime_history_file
+
+runtime_history_file = '2GC_RUNTIME_HISTORY.json'
+
+GB = 1024.**3
+
+
+def get_node_resources():
+    """
+    return cores and memory [bytes] of the node
+    """
+    node = {}
+    node['cores'] = len(os.sched_getaffinity(0))
+
+    meminfo = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':')
+            meminfo[key] = int(value.split()[0]) * 1024
+
+    node['mem_total']     = meminfo['MemTotal']
+    node['mem_available'] = meminfo.get('MemAvailable',meminfo['MemFree'])
+
+    return node
+
+
+def get_runtime_history(homedir):
+    """
+    return the recorded step timings of previous runs
+    (run history database and the history file of the
+    working directory, each timing only once)
+    """
+    history = RUNDB.get_step_timings(RUNDB.get_rundb_file(homedir))
+
+    if os.path.exists(homedir+runtime_history_file):
+        known    = set([(rec['kind'],rec['time'],rec['seconds']) for rec in history])
+        history += [rec for rec in C2GC.get_json(runtime_history_file,homedir) \
+                        if (rec['kind'],rec.get('time'),rec['seconds']) not in known]
+
+    return history
+
+
+def step_work(kind,imsize=0,chan_out=1,ms_bytes=0,spw_fraction=1.):
+    """
+    measure of the amount of work of a step [bytes touched]
+    the runtime is assumed to scale linearly with it
+    """
+    image_bytes = 4. * imsize**2
+
+    if kind == 'wsclean':
+        return ms_bytes * spw_fraction + image_bytes * chan_out
+    if kind in ['pybdsf','casa_makemask','mask_regrid']:
+        return image_bytes
+
+    return ms_bytes
+
+
+def estimate_runtime(kind,history,imsize=0,chan_out=1,ms_bytes=0,spw_fraction=1.):
+    """
+    estimate the runtime [s] of a step from previous timings
+    returns None if no timing of that kind has been recorded
+    """
+    work  = step_work(kind,imsize,chan_out,ms_bytes,spw_fraction)
+
+    rates, seconds = [], []
+    for rec in history:
+        if rec['kind'] == kind:
+            seconds.append(rec['seconds'])
+            rec_work = step_work(kind,rec['imsize'],rec['chan_out'],rec['ms_bytes'],rec['spw_fraction'])
+            if rec_work > 0:
+                rates.append(rec['seconds']/rec_work)
+
+    if len(rates) > 0 and work > 0:
+        return float(np.median(rates) * work)
+    if len(seconds) > 0:
+        return float(np.median(seconds))
+
+    return None
+
+
+def estimate_memory(kind,node,imsize=0,chan_out=1,ms_bytes=0,spw_fraction=1.,wsc_para={}):
+    """
+    estimate the peak memory [bytes] of a step
+    """
+    image_bytes = 4. * imsize**2
+
+    if kind == 'wsclean':
+        # images of all output channels (dirty, psf, residual, model, image)
+        #
+        images   = 5. * chan_out * image_bytes
+        #
+        # padded uv-grids of the gridder threads
+        #
+        n_grid   = int(C2GC.get_wsclean_value(wsc_para,'-parallel-gridding','1'))
+        grids    = n_grid * 2. * 8. * (1.2 * imsize)**2
+        #
+        # visibility buffer limited by -mem / -abs-mem
+        #
+        if C2GC.get_wsclean_value(wsc_para,'-abs-mem') != None:
+            mem_limit = float(C2GC.get_wsclean_value(wsc_para,'-abs-mem')) * GB
+        else:
+            mem_limit = float(C2GC.get_wsclean_value(wsc_para,'-mem','100')) / 100. * node['mem_total']
+        vis      = min(ms_bytes * spw_fraction,mem_limit)
+        #
+        return images + grids + vis
+
+    if kind == 'pybdsf':
+        return 12. * image_bytes + 0.5 * GB
+    if kind == 'casa_makemask':
+        return 3. * image_bytes + 0.5 * GB
+    if kind == 'mask_regrid':
+        return 1. * image_bytes + 0.5 * GB
+    if kind == 'casa_calibration':
+        return 2. * GB
+    if kind == 'shadems':
+        return min(0.1 * ms_bytes,8. * GB) + 0.5 * GB
+
+    return 0.5 * GB
+
+
+def validate_selfcal_para(default_selfcal_para,msinfo,homedir):
+    """
+    check the self-calibration input
+    returns a list of errors and warnings
+    """
+    errors, warnings = [], []
+
+    selfcal_modes = default_selfcal_para.get('selfcal_modes',[])
+    if len(selfcal_modes) == 0:
+        errors.append('selfcal_modes is empty')
+
+    for m in selfcal_modes:
+        if m not in ['p','a','ap']:
+            errors.append('selfcal_modes unknown mode '+str(m)+' use p, a or ap')
+
+    solint = default_selfcal_para.get('selfcal_solint',[])
+    if len(solint) != len(selfcal_modes):
+        errors.append('selfcal_solint needs one entry per selfcal_modes '+str(solint))
+    for si in solint:
+        if re.match(r'^(\d+(\.\d+)?(s|min|h)|int|inf)$',str(si)) == None:
+            errors.append('selfcal_solint wrong format '+str(si))
+
+    for k in C2GC.selfcal_perround_keys:
+        if k not in default_selfcal_para and k in C2GC.selfcal_perround_defaults:
+            continue
+        if k not in default_selfcal_para:
+            errors.append('SELFCAL_PARAMETER misses '+k)
+            continue
+        if len(default_selfcal_para[k]) == 0:
+            errors.append(k+' is empty')
+        elif len(default_selfcal_para[k]) > len(selfcal_modes):
+            errors.append(k+' has more entries than selfcal_modes '+str(default_selfcal_para[k]))
+        elif len(default_selfcal_para[k]) < len(selfcal_modes):
+            warnings.append(k+' is enlarged with its last entry '+str(default_selfcal_para[k]))
+
+    for k in ['selfcal_threshold','selfcal_weighting','uvrange','ref_ant']:
+        if k not in default_selfcal_para:
+            errors.append('SELFCAL_PARAMETER misses '+k)
+
+    if len(errors) > 0:
+        return errors, warnings
+
+    if default_selfcal_para.get('selfcal_solver','casa') not in ['casa','native']:
+        errors.append('selfcal_solver unknown solver '+str(default_selfcal_para['selfcal_solver'])+' use casa or native')
+
+    if default_selfcal_para.get('selfcal_applycal','casa') not in ['casa','native']:
+        errors.append('selfcal_applycal unknown apply '+str(default_selfcal_para['selfcal_applycal'])+' use casa or native')
+
+    if not 0 <= default_selfcal_para.get('selfcal_max_flagged_solutions',1.) <= 1:
+        errors.append('selfcal_max_flagged_solutions needs to be within 0 and 1 '+str(default_selfcal_para['selfcal_max_flagged_solutions']))
+
+    if not default_selfcal_para.get('selfcal_badant_nsigma',0) >= 0:
+        errors.append('selfcal_badant_nsigma needs to be positive (0 switches off) '+str(default_selfcal_para['selfcal_badant_nsigma']))
+
+    if default_selfcal_para.get('selfcal_resiflag',False) and not default_selfcal_para.get('selfcal_resiflag_nsigma',5.) > 0:
+        errors.append('selfcal_resiflag_nsigma needs to be positive '+str(default_selfcal_para['selfcal_resiflag_nsigma']))
+
+    if not default_selfcal_para.get('selfcal_flag_memory_mb',512) > 0:
+        errors.append('selfcal_flag_memory_mb needs to be positive '+str(default_selfcal_para['selfcal_flag_memory_mb']))
+
+    for k in C2GC.selfcal_perround_defaults:
+        for v in default_selfcal_para.get(k,[]):
+            if not isinstance(v,(int,float)) or v < 0:
+                errors.append(k+' needs numbers >= 0 (0 uses the imaging input) '+str(v))
+
+    for d in default_selfcal_para['selfcal_data']:
+        if d not in ['DATA','CORRECTED_DATA']:
+            errors.append('selfcal_data unknown data column '+str(d))
+
+    for i in default_selfcal_para['selfcal_interp']:
+        if str(i).split(',')[0].replace('PD','') not in ['nearest','linear','cubic','spline']:
+            errors.append('selfcal_interp unknown interpolation '+str(i))
+
+    for n in default_selfcal_para['selfcal_niter']:
+        if not isinstance(n,int) or n < 0:
+            errors.append('selfcal_niter needs to be a positive integer '+str(n))
+
+    for k in ['selfcal_gain','selfcal_mgain']:
+        for g in default_selfcal_para[k]:
+            if not isinstance(g,(int,float)) or g <= 0 or g > 1:
+                errors.append(k+' needs to be in (0,1] '+str(g))
+
+    for mf in default_selfcal_para['selfcal_usemaskfile']:
+        if len(mf) > 0 and not os.path.exists(homedir+mf):
+            errors.append('selfcal_usemaskfile does not exist '+homedir+mf)
+
+    if re.match(r'^\s*[<>]?\s*\d+(\.\d+)?\s*(~\s*\d+(\.\d+)?)?\s*(m|km|lambda|klambda)?\s*$',str(default_selfcal_para['uvrange'])) == None:
+        errors.append('uvrange wrong format '+str(default_selfcal_para['uvrange']))
+
+    if msinfo != None and default_selfcal_para['ref_ant'] not in msinfo['antenna_names']:
+        errors.append('ref_ant '+str(default_selfcal_para['ref_ant'])+' is not an antenna of the MS')
+
+    return errors, warnings
+
+
+def validate_run(MSFILE,homedir,iminput,spwds,do_selfcal,msinfo):
+    """
+    check the input of the entire run
+    (the imaging default file is checked by C2GC.load_input)
+    returns a list of errors and warnings
+    """
+    errors, warnings = [], []
+
+    if not os.path.isdir(homedir+MSFILE):
+        errors.append('MS file does not exist '+homedir+MSFILE)
+
+    if msinfo != None:
+        for s in str(spwds).split(','):
+            if len(s.strip()) > 0 and (not s.strip().isdigit() or int(s) >= len(msinfo['spw'])):
+                errors.append('spectral window '+s+' not in the MS')
+
+    if BACKEND.backend_name == 'real':
+        if shutil.which('wsclean') == None:
+            errors.append('wsclean not found')
+
+        if not os.path.exists(homedir+'Image-processing/sourcefinding.py'):
+            errors.append('source finding not found '+homedir+'Image-processing/sourcefinding.py')
+
+    if do_selfcal:
+        if 'SELFCAL_PARAMETER' in iminput:
+            sc_errors, sc_warnings = validate_selfcal_para(iminput['SELFCAL_PARAMETER'],msinfo,homedir)
+            errors   += sc_errors
+            warnings += sc_warnings
+
+        if BACKEND.backend_name == 'real' and shutil.which('shadems') == None:
+            warnings.append('shadems not found, no calibration plots')
+
+    return errors, warnings
+
+
+def plan_step(name,kind,command,node,history,msinfo,imsize=0,chan_out=1,spw_fraction=1.,wsc_para={}):
+    """
+    one step of the plan
+    """
+    ms_bytes = msinfo['ms_size_bytes'] if msinfo != None else 0
+
+    step = {}
+    step['name']          = name
+    step['kind']          = kind
+    step['command']       = command
+    if len(wsc_para) > 0:
+        step['wsclean_para'] = wsc_para
+    step['est_mem_bytes'] = estimate_memory(kind,node,imsize,chan_out,ms_bytes,spw_fraction,wsc_para)
+    step['est_runtime_s'] = estimate_runtime(kind,history,imsize,chan_out,ms_bytes,spw_fraction)
+
+    return step
+
+
+def compile_plan(MSFILE,homedir,iminput,templates,chan_out,do_selfcal,do_imaging,selfcal_para={},source_name='',msinfo=None):
+    """
+    expand the run into the list of steps
+
+    templates are the compiled wsclean parameter of the stages
+    (C2GC.compile_wsclean_templates), selfcal_para the resolved
+    self-calibration settings
+    """
+    full_default_wsclean_para = templates['base']
+
+    node    = get_node_resources()
+    history = get_runtime_history(homedir)
+
+    imsize       = C2GC.get_wsclean_imsize(full_default_wsclean_para)
+    spw_fraction = 1.
+    if msinfo != None:
+        spw_fraction = C2GC.get_wsclean_spw_fraction(MSFILE,homedir,full_default_wsclean_para)
+
+    msfile = homedir + MSFILE
+    plan   = []
+
+    if do_selfcal:
+
+        selfcal_modes              = selfcal_para['selfcal_modes']
+
+        plan.append(plan_step('delmod','casa_delmod','casatasks.delmod(vis='+msfile+',otf=True,scr=False)',node,history,msinfo))
+
+        addgaintable, addinterp = [],[]
+        for sc in range(len(selfcal_modes)):
+
+            # spectral setting without the snr of the previous round
+            #
+            spectral = {'chan_out':chan_out,'fit_spectral_pol':0}
+            if msinfo != None:
+                spectral = C2GC.get_spectral_setting(MSFILE,homedir,C2GC.get_wsclean_value(full_default_wsclean_para,'-spws'),chan_out,\
+                                                         selfcal_modes[sc],0,iminput.get('SPECTRAL_SETTING',{}))
+            sc_chan_out = spectral['chan_out']
+
+            outname  = 'MKMASK'+str(sc)
+            wsc_para = C2GC.get_selfcal_wsclean_para(templates,selfcal_para,sc,sc_chan_out,fit_spectral_pol=spectral['fit_spectral_pol'])
+            if msinfo != None:
+                wsc_para, bda = C2GC.set_baseline_averaging(MSFILE,homedir,wsc_para,iminput.get('BASELINE_AVERAGING',{}),'selfcal')
+            sc_imsize, sc_scale = C2GC.get_selfcal_geometry(full_default_wsclean_para,selfcal_para,sc)
+            plan.append(plan_step('SC'+str(sc)+'_'+outname,'wsclean',C2GC.wsclean_command(MSFILE,outname,homedir,wsc_para),\
+                                      node,history,msinfo,sc_imsize,sc_chan_out,spw_fraction,wsc_para))
+
+            if sc_chan_out > 1:
+                mfs_image = outname+'-MFS-image.fits'
+            else:
+                mfs_image = outname+'-image.fits'
+
+            plan.append(plan_step('SC'+str(sc)+'_SOURCEFINDING','pybdsf',C2GC.python_def+' '+homedir+'Image-processing/sourcefinding.py mask '+homedir+mfs_image+' -o fits:srl kvis --plot',\
+                                      node,history,msinfo,sc_imsize))
+
+            mask_file = 'SC'+str(sc)+'_MASK_'+str(sc)+'.fits'
+            plan.append(plan_step('SC'+str(sc)+'_MAKEMASK','casa_makemask','casatasks.importfits/makemask/exportfits(fitsimage='+homedir+mfs_image+',output='+homedir+mask_file+')',\
+                                      node,history,msinfo,sc_imsize))
+
+            if len(selfcal_para['selfcal_usemaskfile'][sc]) > 0:
+                mask_file = selfcal_para['selfcal_usemaskfile'][sc]
+                plan.append(plan_step('SC'+str(sc)+'_REGRIDMASK','mask_regrid','regrid_mask('+homedir+mask_file+',imsize='+str(sc_imsize)+',scale='+str(sc_scale)+'asec)',\
+                                          node,history,msinfo,sc_imsize))
+
+            outname  = 'MODIM'+str(sc)
+            wsc_para = C2GC.get_selfcal_wsclean_para(templates,selfcal_para,sc,sc_chan_out,mask_file,homedir,spectral['fit_spectral_pol'])
+            if msinfo != None:
+                wsc_para, bda = C2GC.set_baseline_averaging(MSFILE,homedir,wsc_para,iminput.get('BASELINE_AVERAGING',{}),'selfcal')
+            plan.append(plan_step('SC'+str(sc)+'_'+outname,'wsclean',C2GC.wsclean_command(MSFILE,outname,homedir,wsc_para),\
+                                      node,history,msinfo,sc_imsize,sc_chan_out,spw_fraction,wsc_para))
+
+            caltab = homedir+'SC'+str(sc)+'_CALTAB_'+selfcal_modes[sc]
+            if selfcal_para.get('selfcal_solver','casa') == 'native' and selfcal_modes[sc] == 'p':
+                solve_command = 'GAINSOLVE.gaincal_phase('+msfile+','+caltab+',solint='+selfcal_para['selfcal_solint'][sc]+\
+                                    ',refant='+selfcal_para['ref_ant']+',uvrange='+selfcal_para['uvrange']+')'
+            else:
+                solve_command = 'casatasks.gaincal(vis='+msfile+',caltable='+caltab+',gaintype=T,calmode='+selfcal_modes[sc]+\
+                                    ',solint='+selfcal_para['selfcal_solint'][sc]+',refant='+selfcal_para['ref_ant']+',uvrange='+selfcal_para['uvrange']+\
+                                    ',gaintable='+str(addgaintable)+')'
+            if selfcal_para.get('selfcal_applycal','casa') == 'native':
+                apply_command = 'APPLYCAL.apply_gaintables('+msfile+','+str(addgaintable+[caltab])+','+str(addinterp+[selfcal_para['selfcal_interp'][sc]])+')'
+            else:
+                apply_command = 'casatasks.applycal(vis='+msfile+',gaintable='+str(addgaintable+[caltab])+\
+                                    ',interp='+str(addinterp+[selfcal_para['selfcal_interp'][sc]])+')'
+            plan.append(plan_step('SC'+str(sc)+'_CALIBRATION','casa_calibration',solve_command+'; '+apply_command,node,history,msinfo))
+            addgaintable = addgaintable + [caltab]
+            addinterp    = addinterp + [selfcal_para['selfcal_interp'][sc]]
+
+            if selfcal_modes[sc] in ['p','ap']:
+                plotypes = ['phase']
+                if selfcal_modes[sc] == 'ap':
+                    plotypes.append('amp')
+                for plotype in plotypes:
+                    plan.append(plan_step('SC'+str(sc)+'_CALCHECK_'+plotype,'shadems','shadems --aaxis CORRECTED_DATA-MODEL_DATA:'+plotype+' '+msfile,\
+                                              node,history,msinfo))
+
+            plan.append(plan_step('SC'+str(sc)+'_delmod','casa_delmod','casatasks.delmod(vis='+msfile+',otf=True,scr=False)',node,history,msinfo))
+
+    if do_imaging:
+
+        spectral = {'chan_out':chan_out,'fit_spectral_pol':0}
+        if msinfo != None:
+            spectral = C2GC.get_spectral_setting(MSFILE,homedir,C2GC.get_wsclean_value(full_default_wsclean_para,'-spws'),chan_out,\
+                                                     None,0,iminput.get('SPECTRAL_SETTING',{}))
+
+        outname  = 'FINAL_SC_IMAGE_'+source_name
+        wsc_para = C2GC.get_final_wsclean_para(templates,chan_out,spectral['fit_spectral_pol'])
+        if msinfo != None:
+            wsc_para, bda = C2GC.set_baseline_averaging(MSFILE,homedir,wsc_para,iminput.get('BASELINE_AVERAGING',{}),'final')
+        plan.append(plan_step('FINAL_IMAGE','wsclean',C2GC.wsclean_command(MSFILE,outname,homedir,wsc_para),\
+                                  node,history,msinfo,imsize,chan_out,spw_fraction,wsc_para))
+
+        if chan_out > 1:
+            final_image = outname+'-MFS-image.fits'
+        else:
+            final_image = outname+'-image.fits'
+
+        plan.append(plan_step('FINAL_CATALOGING','pybdsf',C2GC.python_def+' '+homedir+'Image-processing/sourcefinding.py cataloging '+homedir+final_image+' -o fits:srl kvis --plot',\
+                                  node,history,msinfo,imsize))
+
+    return plan
+
+
+def check_plan(plan,node=None):
+    """
+    check that the steps fit onto the node
+    returns a list of errors
+    """
+    if node == None:
+        node = get_node_resources()
+
+    errors = []
+    for step in plan:
+        if step['est_mem_bytes'] > node['mem_available']:
+            errors.append('step '+step['name']+' needs about '+'{:.1f}'.format(step['est_mem_bytes']/GB)+\
+                              ' GB, node has '+'{:.1f}'.format(node['mem_available']/GB)+' GB available')
+
+    return errors
+
+
+def print_plan(plan,errors=[],warnings=[]):
+    """
+    print the plan
+    """
+    total_runtime = 0.
+    unknown       = 0
+
+    print('\n=== PLAN ===\n')
+    for i, step in enumerate(plan):
+        if step['est_runtime_s'] == None:
+            runtime = 'unknown'
+            unknown += 1
+        else:
+            runtime = '{:.0f} s'.format(step['est_runtime_s'])
+            total_runtime += step['est_runtime_s']
+
+        print('{:3d} {:25s} mem {:7.1f} GB  time {:>10s}'.format(i,step['name'],step['est_mem_bytes']/GB,runtime))
+        print('      ',step['command'])
+
+    print('\n Estimated runtime ','{:.1f}'.format(total_runtime/3600.),' h',' (',unknown,' steps without timing history)')
+
+    for w in warnings:
+        print(' Warning: ',w)
+    for e in errors:
+        print(' Error: ',e)
+    print('\n')
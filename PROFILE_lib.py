@@ -0,0 +1,281 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Tracing of the pipeline stages
+#
+# - records per stage the wall time, CPU time (process and
+#   child processes e.g. wsclean, pybdsf), peak RSS (process
+#   and children) and the bytes read and written (/proc/self/io)
+#
+# - exports a Chrome trace-event JSON file (chrome://tracing,
+#   https://ui.perfetto.dev) and a per stage summary table
+#
+# - the counters are of the whole process, stages outside of the main
+#   thread (e.g. the tasks of TASKGRAPH_lib) overlap with others and
+#   record the wall time only (marked as overlapping, own track of the
+#   trace), their resources are part of the enclosing main thread stage
+#
+import os
+import time
+import json
+import resource
+import functools
+import threading
+
+from contextlib import contextmanager
+
+
+#
+# LIBS
+#
+
+global trace_events, trace_stacks, trace_tids, trace_t0
+
+trace_events = []
+trace_stacks = {}
+trace_tids   = {}
+trace_t0     = time.time()
+
+
+def get_trace_stack():
+    """
+    the stack of the open stages of the current thread
+    """
+    ident = threading.get_ident()
+    if ident not in trace_stacks:
+        trace_tids[ident]   = len(trace_tids)
+        trace_stacks[ident] = []
+
+    return trace_stacks[ident]
+
+
+def read_proc_io():
+    """
+    return the I/O counters of the process
+    """
+    io = {'read_bytes':0,'write_bytes':0,'rchar':0,'wchar':0}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in io:
+                    io[key] = int(value)
+    except OSError:
+        pass
+
+    return io
+
+
+def read_peak_rss():
+    """
+    return the peak RSS [bytes] of the process since the last reset
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def read_rss():
+    """
+    return the current RSS [bytes] of the process
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return 0
+
+
+def reset_peak_rss():
+    """
+    reset the peak RSS of the process (linux only)
+    """
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def snapshot():
+    """
+    the current resource usage
+    """
+    times = os.times()
+    snap  = {}
+    snap['wall']          = time.time()
+    snap['cpu']           = times.user + times.system
+    snap['child_cpu']     = times.children_user + times.children_system
+    snap['child_maxrss']  = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    snap['io']            = read_proc_io()
+
+    return snap
+
+
+def begin_stage(name,category='2GC',**args):
+    """
+    start the tracing of a stage
+    """
+    trace_stack = get_trace_stack()
+
+    if threading.current_thread() is not threading.main_thread():
+        trace_stack.append({'name':name,'cat':category,'args':args,'start':{'wall':time.time()},'overlapping':True})
+        return
+
+    # the peak RSS of the outer stage so far
+    #
+    if len(trace_stack) > 0:
+        trace_stack[-1]['peak_rss'] = max(trace_stack[-1]['peak_rss'],read_peak_rss())
+    reset_peak_rss()
+
+    trace_stack.append({'name':name,'cat':category,'args':args,'start':snapshot(),'peak_rss':read_peak_rss()})
+
+
+def end_stage():
+    """
+    finish the tracing of the latest stage
+    """
+    trace_stack = get_trace_stack()
+    if len(trace_stack) == 0:
+        return {}
+
+    stage    = trace_stack.pop()
+    start    = stage['start']
+
+    event = {}
+    event['name'] = stage['name']
+    event['cat']  = stage['cat']
+    event['ph']   = 'X'
+    event['ts']   = (start['wall'] - trace_t0) * 1E6
+    event['pid']  = os.getpid()
+    event['tid']  = trace_tids[threading.get_ident()]
+    event['args'] = dict(stage['args'])
+    event['args']['depth']           = len(trace_stack)
+
+    if stage.get('overlapping',False):
+        event['dur']  = (time.time() - start['wall']) * 1E6
+        event['args']['overlapping']     = True
+        trace_events.append(event)
+        return event
+
+    end      = snapshot()
+    peak_rss = max(stage['peak_rss'],read_peak_rss())
+    if len(trace_stack) > 0:
+        trace_stack[-1]['peak_rss'] = max(trace_stack[-1]['peak_rss'],peak_rss)
+
+    event['dur']  = (end['wall'] - start['wall']) * 1E6
+    event['args']['cpu_s']           = end['cpu'] - start['cpu']
+    event['args']['child_cpu_s']     = end['child_cpu'] - start['child_cpu']
+    event['args']['peak_rss_bytes']  = peak_rss
+    event['args']['child_peak_rss_bytes'] = end['child_maxrss'] if end['child_maxrss'] > start['child_maxrss'] else 0
+    for k in start['io'].keys():
+        event['args'][k] = end['io'][k] - start['io'][k]
+
+    trace_events.append(event)
+
+    return event
+
+
+@contextmanager
+def trace_stage(name,category='2GC',**args):
+    """
+    trace the stage within a with statement
+    """
+    begin_stage(name,category,**args)
+    try:
+        yield
+    finally:
+        end_stage()
+
+
+def traced(name=None,category='2GC'):
+    """
+    decorator to trace each call of a function
+    """
+    def decorator(func):
+        stage_name = name if name != None else func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with trace_stage(stage_name,category):
+                return func(*args,**kwargs)
+        return wrapper
+
+    return decorator
+
+
+def get_stage_summary():
+    """
+    summary table of all stages (summed over all calls)
+
+    the overlapping calls count to the wall time only, stages
+    with only overlapping calls have no resource usage (None)
+    """
+    summary = {}
+    for event in trace_events:
+        name = event['name']
+        if name not in summary:
+            summary[name] = {'calls':0,'wall_s':0.,'cpu_s':0.,'child_cpu_s':0.,'peak_rss_bytes':0,'child_peak_rss_bytes':0,\
+                                 'read_bytes':0,'write_bytes':0,'rchar':0,'wchar':0,'overlapping_calls':0}
+        stage = summary[name]
+        stage['calls']  += 1
+        stage['wall_s'] += event['dur'] / 1E6
+        if event['args'].get('overlapping',False):
+            stage['overlapping_calls'] += 1
+            continue
+        for k in ['cpu_s','child_cpu_s','read_bytes','write_bytes','rchar','wchar']:
+            stage[k] += event['args'][k]
+        for k in ['peak_rss_bytes','child_peak_rss_bytes']:
+            stage[k] = max(stage[k],event['args'][k])
+
+    for stage in summary.values():
+        if stage['overlapping_calls'] == stage['calls']:
+            for k in ['cpu_s','child_cpu_s','peak_rss_bytes','child_peak_rss_bytes','read_bytes','write_bytes','rchar','wchar']:
+                stage[k] = None
+
+    return summary
+
+
+def print_stage_summary(summary=None):
+    """
+    print the summary table
+    """
+    if summary == None:
+        summary = get_stage_summary()
+
+    print('\n{:30s} {:>6s} {:>10s} {:>10s} {:>10s} {:>9s} {:>9s} {:>9s}'.format('stage','calls','wall [s]','cpu [s]','child [s]','rss [MB]','read[MB]','write[MB]'))
+    for name in sorted(summary,key=lambda n: -summary[n]['wall_s']):
+        stage = summary[name]
+        if stage['cpu_s'] == None:
+            print('{:30s} {:6d} {:10.1f}   (overlapping)'.format(name,stage['calls'],stage['wall_s']))
+            continue
+        print('{:30s} {:6d} {:10.1f} {:10.1f} {:10.1f} {:9.1f} {:9.1f} {:9.1f}'.format(name,stage['calls'],stage['wall_s'],stage['cpu_s'],stage['child_cpu_s'],\
+                                                                                              stage['peak_rss_bytes']/1024**2,stage['rchar']/1024**2,stage['wchar']/1024**2))
+    print('\n')
+
+
+def save_chrome_trace(tracefile,homedir=''):
+    """
+    save the trace in the Chrome trace-event format
+    """
+    trace = {'traceEvents':sorted(trace_events,key=lambda e: e['ts']),'displayTimeUnit':'ms'}
+
+    with open(homedir+tracefile,'w') as fout:
+        json.dump(trace,fout)
+
+    return homedir+tracefile
@@ -0,0 +1,304 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Live progress of a run for monitoring (scheduler dashboards)
+#
+# - 2GC_PROGRESS_<source>.prom : Prometheus textfile format (e.g. for
+#   the textfile collector of the node exporter)
+#
+# - 2GC_PROGRESS_<source>.json : the same status in JSON
+#
+# - current stage, self-calibration round and tool (wsclean, PyBDSF,
+#   CASA task), the wsclean major cycle and the peak flux versus the
+#   threshold (parsed from the wsclean output)
+#
+# - ETA from the estimated runtimes of the remaining steps of the
+#   plan (timings of previous runs, PLAN_lib), scaled by the ratio
+#   of the actual and estimated runtimes of the finished steps
+#
+# the files are replaced atomically and written at most every
+# write_interval seconds (and at each change of the stage or step)
+#
+import os
+import re
+import json
+import time
+import socket
+import threading
+
+
+#
+# LIBS
+#
+
+global status, plan_steps, progress_files, write_interval, last_write, write_lock, flux_units, wsclean_patterns
+
+status         = {}
+plan_steps     = []
+progress_files = []
+
+write_interval = 1.
+last_write     = 0.
+
+# the files may be written from the tasks of TASKGRAPH_lib
+#
+write_lock     = threading.Lock()
+
+# flux density units of the wsclean output
+#
+flux_units = {'Jy':1.,'mJy':1E-3,'µJy':1E-6,'uJy':1E-6,'nJy':1E-9,'kJy':1E3,'KJy':1E3}
+
+flux_re = r'([-+]?[\d.]+(?:[eE][-+]?\d+)?)\s*([a-zA-Zµ]*Jy)'
+
+wsclean_patterns = {'major_cycle'  :re.compile(r'== Deconvolving \((\d+)\) =='),\
+                        'iteration':re.compile(r'Iteration (\d+),.*?:\s*'+flux_re),\
+                        'next_major':re.compile(r'Next major iteration at:\s*'+flux_re),\
+                        'stopped'  :re.compile(r'Stopped on peak\s*'+flux_re),\
+                        'noise'    :re.compile(r'standard deviation of background noise:\s*'+flux_re)}
+
+
+def to_jy(value,unit='Jy'):
+    """
+    flux density in Jy
+    """
+    return float(value) * flux_units.get(unit,1.)
+
+
+def parse_threshold(value):
+    """
+    wsclean threshold (e.g. 1e-06 or 0.1mJy) in Jy
+    """
+    match = re.match(flux_re+'?$',str(value).strip())
+    if match == None:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    return to_jy(match.group(1),match.group(2) if match.group(2) != None else 'Jy')
+
+
+def start_progress(plan,progressdir,source_name,MSFILE):
+    """
+    start the progress of a run (plan steps with their
+    estimated runtimes)
+    """
+    global status, plan_steps, progress_files, last_write
+
+    plan_steps = [{'name':s['name'],'kind':s['kind'],'est_s':s['est_runtime_s'],'done_s':None} for s in plan]
+
+    progress_files = [progressdir+'2GC_PROGRESS_'+source_name+'.prom',progressdir+'2GC_PROGRESS_'+source_name+'.json']
+    last_write     = 0.
+
+    status = {'source':source_name,'msfile':MSFILE,'hostname':socket.gethostname(),'pid':os.getpid(),\
+                  'state':'running','start_time':time.time(),'stage':'PREPARATION','round':-1,'task':'',\
+                  'steps_total':len(plan_steps),'steps_done':0,'step_start_time':time.time(),\
+                  'wsclean':{}}
+
+    write_progress(force=True)
+
+
+def set_stage(stage,sc=-1):
+    """
+    the stage (and self-calibration round) of the run
+    """
+    if len(status) == 0:
+        return
+
+    status['stage'] = stage
+    status['round'] = sc
+    status['task']  = ''
+
+    write_progress(force=True)
+
+
+def set_task(task,wsc_para={}):
+    """
+    the tool or CASA task that is running
+    """
+    if len(status) == 0:
+        return
+
+    status['task'] = task
+    if task == 'wsclean':
+        threshold = None
+        auto      = None
+        for k in wsc_para:
+            if k.strip() == '-threshold':
+                threshold = parse_threshold(wsc_para[k])
+            if k.strip() == '-auto-threshold':
+                auto      = float(str(wsc_para[k]).split()[0])
+        status['wsclean'] = {'major_cycle':0,'iteration':0,'peak_jy':None,'next_major_jy':None,\
+                                 'threshold_jy':threshold,'auto_threshold':auto}
+
+    write_progress(force=True)
+
+
+def wsclean_line(line):
+    """
+    progress information of a line of the wsclean output
+    """
+    if len(status) == 0 or len(status['wsclean']) == 0:
+        return
+
+    wsc   = status['wsclean']
+    force = False
+
+    match = wsclean_patterns['major_cycle'].search(line)
+    if match:
+        wsc['major_cycle'] = int(match.group(1))
+        force              = True
+
+    match = wsclean_patterns['iteration'].search(line)
+    if match:
+        wsc['iteration'] = int(match.group(1))
+        wsc['peak_jy']   = abs(to_jy(match.group(2),match.group(3)))
+
+    match = wsclean_patterns['next_major'].search(line)
+    if match:
+        wsc['next_major_jy'] = to_jy(match.group(1),match.group(2))
+
+    match = wsclean_patterns['stopped'].search(line)
+    if match:
+        wsc['peak_jy'] = abs(to_jy(match.group(1),match.group(2)))
+        force          = True
+
+    # the auto-threshold is relative to the noise
+    #
+    match = wsclean_patterns['noise'].search(line)
+    if match and wsc['auto_threshold'] != None:
+        auto_jy = wsc['auto_threshold'] * to_jy(match.group(1),match.group(2))
+        wsc['threshold_jy'] = max(auto_jy,wsc['threshold_jy'] if wsc['threshold_jy'] != None else 0.)
+
+    # each major cycle is written, the minor iterations at most
+    # every write_interval
+    #
+    write_progress(force)
+
+
+def step_done(kind,seconds):
+    """
+    a step of the plan has finished (first pending step of that kind)
+    """
+    if len(status) == 0:
+        return
+
+    for step in plan_steps:
+        if step['kind'] == kind and step['done_s'] == None:
+            step['done_s'] = seconds
+            break
+
+    status['steps_done']      = len([s for s in plan_steps if s['done_s'] != None])
+    status['step_start_time'] = time.time()
+    status['task']            = ''
+
+    write_progress(force=True)
+
+
+def get_eta():
+    """
+    estimated remaining time [s] of the run (None without estimates)
+    and the number of pending steps without estimate
+    """
+    pending  = [s for s in plan_steps if s['done_s'] == None]
+    done     = [s for s in plan_steps if s['done_s'] != None and s['est_s'] != None and s['est_s'] > 0]
+    unknown  = len([s for s in pending if s['est_s'] == None])
+
+    if len(pending) == 0:
+        return 0., 0
+    if len(pending) == unknown:
+        return None, unknown
+
+    # speed of this run compared to the previous ones
+    #
+    ratio = sum([s['done_s'] for s in done]) / sum([s['est_s'] for s in done]) if len(done) > 0 else 1.
+
+    current = pending[0]['est_s'] if pending[0]['est_s'] != None else 0.
+    elapsed = time.time() - status['step_start_time']
+    rest    = sum([s['est_s'] for s in pending[1:] if s['est_s'] != None])
+
+    return ratio * rest + max(0.,ratio * current - elapsed), unknown
+
+
+def finish_progress(state='finished'):
+    """
+    end of the run
+    """
+    if len(status) == 0:
+        return
+
+    status['state'] = state
+    status['stage'] = 'DONE'
+    status['task']  = ''
+
+    write_progress(force=True)
+
+
+def prometheus_text(status):
+    """
+    the status in the Prometheus text format
+    """
+    def esc(v):
+        return str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+    def num(v):
+        return 'NaN' if v == None else repr(float(v))
+
+    labels = '{source="'+esc(status['source'])+'",ms="'+esc(status['msfile'])+'",host="'+esc(status['hostname'])+'"}'
+    info   = '{source="'+esc(status['source'])+'",ms="'+esc(status['msfile'])+'",host="'+esc(status['hostname'])+\
+                 '",state="'+esc(status['state'])+'",stage="'+esc(status['stage'])+'",task="'+esc(status['task'])+'"}'
+    wsc    = status['wsclean']
+
+    metrics = [['c2gc_info','gauge','stage, task and state of the run',info,1],\
+               ['c2gc_round','gauge','self-calibration round (-1 outside of the rounds)',labels,status['round']],\
+               ['c2gc_steps_total','gauge','number of steps of the plan',labels,status['steps_total']],\
+               ['c2gc_steps_done','gauge','number of finished steps',labels,status['steps_done']],\
+               ['c2gc_start_timestamp_seconds','gauge','start of the run',labels,status['start_time']],\
+               ['c2gc_elapsed_seconds','gauge','elapsed time of the run',labels,status['elapsed_s']],\
+               ['c2gc_eta_seconds','gauge','estimated remaining time of the run',labels,status['eta_s']],\
+               ['c2gc_steps_without_estimate','gauge','pending steps without runtime history',labels,status['steps_without_estimate']],\
+               ['c2gc_wsclean_major_cycle','gauge','major cycle of the running wsclean',labels,wsc.get('major_cycle')],\
+               ['c2gc_wsclean_iteration','gauge','minor iteration of the running wsclean',labels,wsc.get('iteration')],\
+               ['c2gc_wsclean_peak_jy','gauge','current peak flux density of the running wsclean',labels,wsc.get('peak_jy')],\
+               ['c2gc_wsclean_threshold_jy','gauge','clean threshold of the running wsclean',labels,wsc.get('threshold_jy')],\
+               ['c2gc_last_update_timestamp_seconds','gauge','time of the last update',labels,status['update_time']]]
+
+    text = ''
+    for name,mtype,helptext,lab,value in metrics:
+        text += '# HELP '+name+' '+helptext+'\n'
+        text += '# TYPE '+name+' '+mtype+'\n'
+        text += name+lab+' '+num(value)+'\n'
+
+    return text
+
+
+def write_progress(force=False):
+    """
+    write the progress files (atomic replace)
+    """
+    global last_write
+
+    if len(status) == 0 or (not force and time.time() - last_write < write_interval):
+        return
+
+    with write_lock:
+        last_write = time.time()
+
+        status['update_time']                             = last_write
+        status['elapsed_s']                               = last_write - status['start_time']
+        status['eta_s'], status['steps_without_estimate'] = get_eta()
+        if status['state'] != 'running':
+            status['eta_s'] = 0.
+
+        for filename,content in zip(progress_files,[prometheus_text(status),json.dumps(status,indent=1)]):
+            try:
+                with open(filename+'.tmp','w') as fout:
+                    fout.write(content)
+                os.replace(filename+'.tmp',filename)
+            except OSError as err:
+                print('Progress file ',filename,' not written: ',err)
@@ -0,0 +1,168 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Query and bulk import of the run history database (RUNDB_lib)
+#
+# - import existing SELFCALINFO and runtime history files
+#
+#   python3 QUERY_RUNDB.py --RUNDB=ALL_FIELDS.sqlite --IMPORT='/data/*/FINAL_IMAGE_*_SELFCALINFO*.json,/data/*/2GC_RUNTIME_HISTORY.json'
+#
+# - list the runs, rounds, images, stages or step timings
+#
+#   python3 QUERY_RUNDB.py --RUNDB=ALL_FIELDS.sqlite --TABLE=rounds --SOURCE=J0408-6545
+#   python3 QUERY_RUNDB.py --RUNDB=ALL_FIELDS.sqlite --WHERE='robust < 0 AND imsize >= 8192'
+#
+# - any SELECT statement
+#
+#   python3 QUERY_RUNDB.py --SQL='SELECT source, MIN(final_noise_jy) FROM runs GROUP BY source'
+#
+import os
+import sys
+import csv
+import json
+#
+import RUNDB_lib as RUNDB
+#
+from optparse import OptionParser
+
+
+#
+# LIBS
+#
+
+global table_columns
+
+# columns shown per table (all columns with --ALLCOLUMNS)
+#
+table_columns = {}
+table_columns['runs']         = ['run_id','source','msfile','hostname','end_time','imsize','scale_asec','robust','niter',\
+                                     'chan_out','nrounds','final_noise_jy','final_flux_jy','bmaj_deg','bmin_deg','wall_s']
+table_columns['rounds']       = ['run_id','source','round','imsize','chan_out','solint','calmode','model_flux_jy',\
+                                     'pybdsf_noise_jy','image_std','sol_flagged','phase_rms_deg','bad_antennas','wall_s']
+table_columns['images']       = ['run_id','source','image','mean','std','min','max','unit']
+table_columns['stages']       = ['run_id','source','stage','calls','wall_s','cpu_s','peak_rss_bytes']
+table_columns['step_timings'] = ['run_id','source','kind','seconds','imsize','chan_out','spw_fraction','ms_bytes']
+
+
+def table_query(table,allcolumns=False,source='',msfile='',where='',limit=0):
+    """
+    SQL of a table joined with the runs (source and MS selection)
+    """
+    if table == 'runs':
+        columns = ['runs.*'] if allcolumns else ['runs.'+c for c in table_columns['runs']]
+        sql     = 'SELECT '+','.join(columns)+' FROM runs'
+    else:
+        columns = [table+'.*','runs.source'] if allcolumns else \
+                      ['runs.source' if c == 'source' else table+'.'+c for c in table_columns[table]]
+        sql     = 'SELECT '+','.join(columns)+' FROM '+table+' LEFT JOIN runs ON runs.run_id = '+table+'.run_id'
+
+    conditions, parameters = [], []
+    if len(source) > 0:
+        conditions.append('runs.source = ?')
+        parameters.append(source)
+    if len(msfile) > 0:
+        conditions.append('runs.msfile = ?')
+        parameters.append(msfile)
+    if len(where) > 0:
+        conditions.append('('+where+')')
+
+    if len(conditions) > 0:
+        sql += ' WHERE '+' AND '.join(conditions)
+    sql += ' ORDER BY '+table+'.rowid'
+    if limit > 0:
+        sql += ' LIMIT '+str(int(limit))
+
+    return sql, parameters
+
+
+def main():
+
+    # argument parsing
+    #
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option('--RUNDB', dest='rundb', default='', type=str,
+                      help='database file [default C2GC_RUNDB or 2GC_RUNDB.sqlite]')
+
+    parser.add_option('--IMPORT', dest='importfiles', default='', type=str,
+                      help='comma separated glob patterns of SELFCALINFO and 2GC_RUNTIME_HISTORY.json files to import')
+
+    parser.add_option('--TABLE', dest='table', default='runs', type=str,
+                      help='runs, rounds, images, stages or step_timings [default runs]')
+
+    parser.add_option('--SOURCE', dest='source', default='', type=str,
+                      help='select a source')
+
+    parser.add_option('--MS_FILE', dest='msfile', default='', type=str,
+                      help='select a MS')
+
+    parser.add_option('--WHERE', dest='where', default='', type=str,
+                      help='additional SQL condition e.g. "imsize >= 8192"')
+
+    parser.add_option('--SQL', dest='sql', default='', type=str,
+                      help='SELECT statement (replaces the table selection)')
+
+    parser.add_option('--LIMIT', dest='limit', default=0, type=int,
+                      help='maximum number of rows [default all]')
+
+    parser.add_option('--ALLCOLUMNS', dest='allcolumns', action='store_true', default=False,
+                      help='show all columns of the table [default selected columns]')
+
+    parser.add_option('--OUTPUT', dest='output', default='', type=str,
+                      help='save the result as .csv or .json file [default print]')
+
+    # ----
+
+    (opts, args)         = parser.parse_args()
+
+    dbfile = opts.rundb if len(opts.rundb) > 0 else RUNDB.get_rundb_file()
+
+    if len(opts.importfiles) > 0:
+        nruns, ntimings, failed = RUNDB.import_files(dbfile,[p.strip() for p in opts.importfiles.split(',') if len(p.strip()) > 0])
+        print('\n Imported ',nruns,' runs and ',ntimings,' step timings into ',dbfile)
+        for f,err in failed:
+            print('   failed ',f,' ',err)
+        print('\n')
+        return
+
+    if not os.path.exists(dbfile):
+        print('Database ',dbfile,' does not exist')
+        sys.exit(-1)
+
+    if len(opts.sql) > 0:
+        if not opts.sql.lstrip().upper().startswith(('SELECT','WITH')):
+            print('Only SELECT statements are allowed')
+            sys.exit(-1)
+        sql, parameters = opts.sql, []
+    else:
+        if opts.table not in table_columns:
+            print('Unknown table ',opts.table,' use one of ',', '.join(table_columns))
+            sys.exit(-1)
+        sql, parameters = table_query(opts.table,opts.allcolumns,opts.source,opts.msfile,opts.where,opts.limit)
+
+    try:
+        cols, rows = RUNDB.query(dbfile,sql,parameters)
+    except RUNDB.sqlite3.Error as err:
+        print('Query failed: ',err)
+        sys.exit(-1)
+
+    if opts.output.endswith('.csv'):
+        with open(opts.output,'w',newline='') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(cols)
+            writer.writerows(rows)
+    elif opts.output.endswith('.json'):
+        with open(opts.output,'w') as fout:
+            json.dump([dict(zip(cols,r)) for r in rows],fout,indent=1)
+    else:
+        RUNDB.print_rows(cols,rows)
+
+
+if __name__ == "__main__":
+    main()
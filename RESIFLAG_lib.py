@@ -0,0 +1,189 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Flagging of the residual visibilities between the self-calibration rounds
+#
+# - the residuals CORRECTED_DATA - MODEL_DATA are read per spw in
+#   groups of complete baselines and blocks of channels in a process
+#   pool (python-casacore), the groups and channel blocks are sized
+#   to chunk_mb (memory of each worker)
+#
+# - per baseline, channel and correlation the median and the MAD of
+#   the residual amplitudes are determined over time and outliers
+#   beyond nsigma robust sigma are flagged
+#
+# - the new flags are written in the main process per group and
+#   channel block (the workers only read the MS)
+#
+import multiprocessing
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+import FLAGSTATS_lib as FLAGSTATS
+
+
+#
+# LIBS
+#
+
+global chunk_mb, vis_bytes, min_samples
+
+chunk_mb    = 512
+
+# memory per visibility of a worker: CORRECTED_DATA and MODEL_DATA
+# (complex64), the amplitudes, the flags and the per baseline copies
+#
+vis_bytes   = 32
+
+# minimum number of unflagged samples of a baseline and channel
+#
+min_samples = 5
+
+
+def baseline_groups(rows,ant1,ant2,nant,nchan,ncorr,memory_mb):
+    """
+    groups of rows of complete baselines and the channel blocks
+    so that a group and block fits into memory_mb
+    """
+    bsl    = ant1[rows] * nant + ant2[rows]
+    order  = np.argsort(bsl,kind='stable')
+    rows   = rows[order]
+    bsl    = bsl[order]
+    bounds = list(np.flatnonzero(np.diff(bsl)) + 1) + [len(rows)]
+
+    # the longest baseline sets the channel block
+    #
+    max_bsl_rows = int(np.max(np.diff([0] + bounds))) if len(rows) > 0 else 1
+    max_vis      = memory_mb * 1024**2 // vis_bytes
+    nchan_block  = int(min(nchan,max(1,max_vis // (max_bsl_rows * ncorr))))
+    max_rows     = FLAGSTATS.rows_per_chunk(nchan_block,ncorr,vis_bytes,memory_mb)
+
+    groups, start = [], 0
+    for i, b in enumerate(bounds):
+        if i + 1 == len(bounds) or bounds[i+1] - start > max_rows:
+            groups.append(rows[start:b])
+            start = b
+
+    channels = [[c0,min(c0+nchan_block,nchan)] for c0 in range(0,nchan,nchan_block)]
+
+    return [g for g in groups if len(g) > 0], channels
+
+
+def robust_outliers(amp,flag,bsl,nsigma):
+    """
+    outliers of the residual amplitudes amp [nrow,nchan,ncorr]
+    per baseline, channel and correlation
+    (the flagged amplitudes of amp are set to NaN)
+    """
+    outlier = np.zeros(amp.shape,dtype=bool)
+    amp[flag] = np.nan
+
+    for b in np.unique(bsl):
+        sel     = bsl == b
+        samples = np.sum(~flag[sel],axis=0)
+        if np.max(samples) < min_samples:
+            continue
+
+        with np.errstate(all='ignore'):
+            median = np.nanmedian(amp[sel],axis=0)
+            sigma  = 1.4826 * np.nanmedian(np.abs(amp[sel] - median),axis=0)
+            bad    = (amp[sel] - median) > nsigma * sigma
+
+        bad[:,(samples < min_samples) | ~(sigma > 0)] = False
+        outlier[sel] = bad
+
+    return outlier & ~flag
+
+
+def residual_outliers_chunk(para):
+    """
+    new flags of a group of baselines and a block of channels
+    (runs in its own process, returns row, channel and correlation indices)
+    """
+    from casacore.tables import table
+
+    msfile, rownrs, chans, ncorr, nant, nsigma = para
+
+    blc, trc = [chans[0],0], [chans[1]-1,ncorr-1]
+    with table(msfile,ack=False) as t:
+        sel      = t.selectrows(rownrs)
+        resi     = sel.getcolslice('CORRECTED_DATA',blc,trc)
+        resi    -= sel.getcolslice('MODEL_DATA',blc,trc)
+        amp      = np.abs(resi).astype(np.float32,copy=False)
+        del resi
+        flag     = sel.getcolslice('FLAG',blc,trc)
+        flag    |= sel.getcol('FLAG_ROW')[:,None,None]
+        bsl      = sel.getcol('ANTENNA1') * nant + sel.getcol('ANTENNA2')
+
+    outlier = robust_outliers(amp,flag,bsl,nsigma)
+    r, c, p = np.nonzero(outlier)
+
+    return rownrs[r], c + chans[0], p, int(np.sum(~flag))
+
+
+def residual_flagging(MSFILE,homedir='',nsigma=5.,nproc=4,memory_mb=None):
+    """
+    flag the outliers of the residual visibilities
+    (memory_mb per worker, default chunk_mb)
+    returns the newly flagged fraction per spw
+    """
+    from casacore.tables import table
+
+    memory_mb = memory_mb if memory_mb != None else chunk_mb
+
+    msfile = homedir + MSFILE
+    layout = FLAGSTATS.read_ms_layout(msfile)
+    nant   = len(layout['antenna_names'])
+
+    with table(msfile,ack=False) as t:
+        ant1 = t.getcol('ANTENNA1')
+        ant2 = t.getcol('ANTENNA2')
+
+    jobs, job_spw = [], []
+    for ddid in layout['ddid_rows']:
+        spw    = int(layout['ddid_spw'][ddid])
+        nchan  = int(layout['spw_nchan'][spw])
+        ncorr  = int(layout['pol_ncorr'][layout['ddid_pol'][ddid]])
+        groups, channels = baseline_groups(layout['ddid_rows'][ddid],ant1,ant2,nant,nchan,ncorr,memory_mb)
+        for rows in groups:
+            for chans in channels:
+                jobs.append([msfile,rows,chans,ncorr,nant,nsigma])
+                job_spw.append(spw)
+
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(nproc,len(jobs)),mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(residual_outliers_chunk,jobs))
+    else:
+        results = [residual_outliers_chunk(j) for j in jobs]
+
+    # write the new flags (channel block of the job only)
+    #
+    newflags, unflagged = {}, {}
+    with table(msfile,readonly=False,ack=False) as t:
+        for job,spw,(rownr,chan,corr,nvis) in zip(jobs,job_spw,results):
+            newflags[spw]  = newflags.get(spw,0) + len(rownr)
+            unflagged[spw] = unflagged.get(spw,0) + nvis
+            if len(rownr) == 0:
+                continue
+
+            chans, ncorr = job[2], job[3]
+            blc, trc     = [chans[0],0], [chans[1]-1,ncorr-1]
+            rows, ridx   = np.unique(rownr,return_inverse=True)
+            sel          = t.selectrows(rows)
+            flag         = sel.getcolslice('FLAG',blc,trc)
+            flag[ridx,chan-chans[0],corr] = True
+            sel.putcolslice('FLAG',flag,blc,trc)
+
+    fractions = {'nsigma':nsigma,'spw':{}}
+    for spw in sorted(newflags):
+        fractions['spw'][str(spw)] = float(FLAGSTATS.fraction(newflags[spw],unflagged[spw]))
+    fractions['total'] = float(FLAGSTATS.fraction(sum(newflags.values()),sum(unflagged.values())))
+
+    return fractions
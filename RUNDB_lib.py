@@ -0,0 +1,468 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Run history of the self-calibration and final imaging (SQLite)
+#
+# - each run (FINAL_IMAGE_<source>_SELFCALINFO.json) is stored in
+#   normalized tables
+#
+#      runs         source, MS, host, image parameter, final noise and beam
+#      rounds       per self-calibration round: model, noise, solutions, flags
+#      images       statistics of the round and final images
+#      stages       wall and cpu time of the stages (PROFILE)
+#      step_timings runtime of the steps (runtime estimates of PLAN_lib)
+#
+# - existing SELFCALINFO and 2GC_RUNTIME_HISTORY.json files can be
+#   imported in bulk, runs and timings are only stored once
+#
+# - the database is selected via set_rundb_file or the environment
+#   variable C2GC_RUNDB (e.g. one database for all fields), the
+#   default is 2GC_RUNDB.sqlite in the working directory
+#
+# python3 QUERY_RUNDB.py --help
+#
+import os
+import re
+import glob
+import json
+import sqlite3
+import hashlib
+import urllib.parse
+
+
+#
+# LIBS
+#
+
+global rundb_file, rundb_name, rundb_schema, timing_keys
+
+rundb_file = os.environ.get('C2GC_RUNDB','')
+
+rundb_name = '2GC_RUNDB.sqlite'
+
+# tables and indexes
+#
+rundb_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id            INTEGER PRIMARY KEY,
+    info_hash         TEXT UNIQUE,
+    infofile          TEXT,
+    source            TEXT,
+    msfile            TEXT,
+    workdir           TEXT,
+    hostname          TEXT,
+    backend           TEXT,
+    start_time        REAL,
+    end_time          REAL,
+    imsize            INTEGER,
+    scale_asec        REAL,
+    robust            REAL,
+    niter             INTEGER,
+    chan_out          INTEGER,
+    stokes            TEXT,
+    selfcal           INTEGER,
+    nrounds           INTEGER,
+    parallel_gridding INTEGER,
+    final_noise_jy    REAL,
+    final_flux_jy     REAL,
+    nsource           INTEGER,
+    bmaj_deg          REAL,
+    bmin_deg          REAL,
+    pa_deg            REAL,
+    wall_s            REAL,
+    parameters        TEXT,
+    autotune          TEXT
+);
+CREATE TABLE IF NOT EXISTS rounds (
+    run_id            INTEGER REFERENCES runs(run_id) ON DELETE CASCADE,
+    round             INTEGER,
+    imsize            INTEGER,
+    scale_asec        REAL,
+    chan_out          INTEGER,
+    fit_spectral_pol  INTEGER,
+    niter             INTEGER,
+    datacolumn        TEXT,
+    mgain             REAL,
+    solint            TEXT,
+    calmode           TEXT,
+    model_flux_jy     REAL,
+    model_growth_jy   REAL,
+    n_components      INTEGER,
+    pybdsf_flux_jy    REAL,
+    pybdsf_noise_jy   REAL,
+    image_std         REAL,
+    sol_flagged       REAL,
+    phase_rms_deg     REAL,
+    amp_scatter       REAL,
+    bad_antennas      INTEGER,
+    rejected          INTEGER,
+    flagged_fraction  REAL,
+    resiflag_fraction REAL,
+    wall_s            REAL,
+    PRIMARY KEY (run_id, round)
+);
+CREATE TABLE IF NOT EXISTS images (
+    run_id            INTEGER REFERENCES runs(run_id) ON DELETE CASCADE,
+    image             TEXT,
+    mean              REAL,
+    std               REAL,
+    min               REAL,
+    max               REAL,
+    unit              TEXT,
+    PRIMARY KEY (run_id, image)
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id            INTEGER REFERENCES runs(run_id) ON DELETE CASCADE,
+    stage             TEXT,
+    calls             INTEGER,
+    wall_s            REAL,
+    cpu_s             REAL,
+    child_cpu_s       REAL,
+    peak_rss_bytes    INTEGER,
+    read_bytes        INTEGER,
+    write_bytes       INTEGER,
+    PRIMARY KEY (run_id, stage)
+);
+CREATE TABLE IF NOT EXISTS step_timings (
+    run_id            INTEGER,
+    kind              TEXT,
+    seconds           REAL,
+    imsize            INTEGER,
+    chan_out          INTEGER,
+    spw_fraction      REAL,
+    ms_bytes          INTEGER,
+    time              REAL,
+    UNIQUE (kind, time, seconds)
+);
+CREATE INDEX IF NOT EXISTS runs_source  ON runs (source);
+CREATE INDEX IF NOT EXISTS runs_msfile  ON runs (msfile);
+CREATE INDEX IF NOT EXISTS runs_para    ON runs (imsize, scale_asec, robust, niter);
+CREATE INDEX IF NOT EXISTS runs_host    ON runs (hostname, imsize, chan_out);
+CREATE INDEX IF NOT EXISTS timings_kind ON step_timings (kind);
+CREATE INDEX IF NOT EXISTS timings_run  ON step_timings (run_id);
+"""
+
+# step timing columns (same keys as the runtime history)
+#
+timing_keys = ['kind','seconds','imsize','chan_out','spw_fraction','ms_bytes','time']
+
+
+def set_rundb_file(dbfile):
+    """
+    select the database (the environment variable C2GC_RUNDB has priority)
+    """
+    global rundb_file
+
+    if len(os.environ.get('C2GC_RUNDB','')) == 0:
+        rundb_file = dbfile
+
+
+def get_rundb_file(homedir=''):
+    """
+    the selected database or the default of the working directory
+    """
+    if len(rundb_file) > 0:
+        return rundb_file
+
+    return homedir+rundb_name
+
+
+def connect(dbfile):
+    """
+    open (and create) the database
+    """
+    con = sqlite3.connect(dbfile,timeout=60.)
+    con.row_factory = sqlite3.Row
+    con.execute('PRAGMA foreign_keys = ON')
+    con.executescript(rundb_schema)
+
+    return con
+
+
+def get_value(info,keys,default=None):
+    """
+    value of nested keys/indices or default
+    """
+    for k in keys:
+        try:
+            info = info[k]
+        except (KeyError,IndexError,TypeError):
+            return default
+
+    return info
+
+
+def to_json(value):
+    """
+    JSON text of a value (NumPy types as python types)
+    """
+    return json.dumps(value,sort_keys=True,default=lambda v: v.tolist() if hasattr(v,'tolist') else str(v))
+
+
+def source_from_infofile(infofile):
+    """
+    source name of a FINAL_IMAGE_<source>_SELFCALINFO.json file
+    """
+    match = re.match(r'FINAL_IMAGE_(.+)_SELFCALINFO',os.path.basename(infofile))
+
+    return match.group(1) if match else ''
+
+
+def guess_run_info(infofile):
+    """
+    run information of a file written before the RUN section
+    was added (MS from the MSINFO cache in the same directory)
+    """
+    workdir = os.path.dirname(os.path.abspath(infofile))+'/'
+    msinfo  = glob.glob(workdir+'*_MSINFO.json')
+    mtime   = os.path.getmtime(infofile)
+
+    run_info = {'workdir':workdir,'end_time':mtime,'parameters':{}}
+    if len(msinfo) == 1:
+        run_info['msfile'] = os.path.basename(msinfo[0])[:-len('_MSINFO.json')]
+
+    return run_info
+
+
+def run_rows(selfcal_information,infofile,source):
+    """
+    rows of the runs, rounds, images and stages tables of a run
+    """
+    info     = selfcal_information
+    run_info = info.get('RUN',{})
+    para     = run_info.get('parameters',{})
+    rounds   = sorted([int(k[2:]) for k in info if re.match(r'SC\d+$',k)])
+    final    = info.get('FINALIMAGES',{})
+    profile  = info.get('PROFILE',{})
+
+    run = {}
+    run['info_hash']         = hashlib.sha1(to_json({k:info[k] for k in info if k != 'RUN'}).encode()).hexdigest()
+    run['infofile']          = os.path.abspath(infofile) if len(infofile) > 0 else ''
+    run['source']            = source
+    run['msfile']            = run_info.get('msfile','')
+    run['workdir']           = run_info.get('workdir','')
+    run['hostname']          = run_info.get('hostname','')
+    run['backend']           = run_info.get('backend','')
+    run['start_time']        = run_info.get('start_time')
+    run['end_time']          = run_info.get('end_time')
+    run['imsize']            = para.get('imsize')
+    run['scale_asec']        = para.get('scale_asec')
+    run['robust']            = para.get('robust')
+    run['niter']             = para.get('niter')
+    run['chan_out']          = para.get('chan_out',get_value(info,['FINAL_SPECTRAL','chan_out']))
+    run['stokes']            = para.get('stokes')
+    run['selfcal']           = int(len(rounds) > 0)
+    run['nrounds']           = len(rounds)
+    run['parallel_gridding'] = para.get('parallel_gridding')
+    run['final_noise_jy']    = get_value(final,['pybdsf_info','residual_image_noise_jy'])
+    run['final_flux_jy']     = get_value(final,['pybdsf_info','nsource_flux_jy'])
+    run['nsource']           = get_value(final,['pybdsf_info','nsource'])
+    run['bmaj_deg']          = get_value(final,['pybdsf_info','bmaj_deg'])
+    run['bmin_deg']          = get_value(final,['pybdsf_info','bmin_deg'])
+    run['pa_deg']            = get_value(final,['pybdsf_info','PA_deg'])
+    run['wall_s']            = run['end_time'] - run['start_time'] if run['start_time'] != None and run['end_time'] != None else \
+                                   sum([profile[s]['wall_s'] for s in ['PREPARATION','SELFCAL','FINAL_IMAGING'] if s in profile])
+    run['parameters']        = to_json(para)
+    run['autotune']          = to_json(info['AUTOTUNE']) if 'AUTOTUNE' in info else None
+
+    round_rows, image_rows = [], []
+    for sc in rounds:
+        sci = info['SC'+str(sc)]
+        calstats = sci.get('CALSTATS',{})
+        round_rows.append({'round':sc,'imsize':get_value(sci,['imsize',0]),'scale_asec':get_value(sci,['imsize',1]),\
+                               'chan_out':get_value(sci,['spectral','chan_out']),'fit_spectral_pol':get_value(sci,['spectral','fit_spectral_pol']),\
+                               'niter':get_value(sci,['calip_setting',0]),'datacolumn':get_value(sci,['calip_setting',1]),\
+                               'mgain':get_value(sci,['calip_setting',2]),'solint':get_value(sci,['calip_setting',3]),\
+                               'calmode':get_value(sci,['calip_setting',4]),\
+                               'model_flux_jy':get_value(sci,['Model_info','total_flux_jy'],get_value(sci,['Model',0,0])),\
+                               'model_growth_jy':sci.get('Model_growth_jy'),'n_components':get_value(sci,['Model_info','n_components']),\
+                               'pybdsf_flux_jy':get_value(sci,['pybdsf_info_b4_masking',0]),\
+                               'pybdsf_noise_jy':get_value(sci,['pybdsf_info_b4_masking',1]),\
+                               'image_std':get_value(sci,['Stats',1]),'sol_flagged':calstats.get('flagged_fraction'),\
+                               'phase_rms_deg':calstats.get('median_phase_rms_deg'),'amp_scatter':calstats.get('median_amp_scatter'),\
+                               'bad_antennas':len([d for d in calstats.get('bad_antennas',[]) if d.get('flag')]),\
+                               'rejected':int(calstats.get('rejected',False)),\
+                               'flagged_fraction':get_value(sci,['FLAGSTATS','total']),\
+                               'resiflag_fraction':get_value(sci,['RESIFLAG','total']),\
+                               'wall_s':get_value(profile,['SC'+str(sc),'wall_s'])})
+        if isinstance(sci.get('Stats'),list):
+            image_rows.append(['SC'+str(sc)]+sci['Stats'][:5])
+
+    for k in sorted(final):
+        if k.startswith('Stats') and isinstance(final[k],list):
+            image_rows.append(['FINAL'+k[len('Stats'):]]+final[k][:5])
+
+    image_rows = [{'image':r[0],'mean':r[1],'std':r[2],'min':r[3],'max':r[4],'unit':r[5] if len(r) > 5 else ''} for r in image_rows]
+
+    stage_rows = [{'stage':s,'calls':profile[s].get('calls'),'wall_s':profile[s].get('wall_s'),'cpu_s':profile[s].get('cpu_s'),\
+                       'child_cpu_s':profile[s].get('child_cpu_s'),'peak_rss_bytes':profile[s].get('peak_rss_bytes'),\
+                       'read_bytes':profile[s].get('rchar'),'write_bytes':profile[s].get('wchar')} for s in profile]
+
+    return run, round_rows, image_rows, stage_rows
+
+
+def insert_rows(con,table,rows,run_id=None,ignore=False):
+    """
+    insert a list of dictionaries into a table
+    """
+    if len(rows) == 0:
+        return 0
+
+    keys = list(rows[0])
+    if run_id != None:
+        keys = ['run_id'] + keys
+        rows = [dict(r,run_id=run_id) for r in rows]
+
+    sql  = 'INSERT '+('OR IGNORE ' if ignore else '')+'INTO '+table+' ('+','.join(keys)+') VALUES ('+','.join(['?']*len(keys))+')'
+    cur  = con.executemany(sql,[[r[k] for k in keys] for r in rows])
+
+    return cur.rowcount
+
+
+def add_run_con(con,selfcal_information,infofile='',source='',step_timings=[]):
+    """
+    store a run (returns the run_id, None if already stored)
+    """
+    if len(source) == 0:
+        source = selfcal_information.get('RUN',{}).get('source',source_from_infofile(infofile))
+
+    run, round_rows, image_rows, stage_rows = run_rows(selfcal_information,infofile,source)
+
+    if con.execute('SELECT run_id FROM runs WHERE info_hash = ?',[run['info_hash']]).fetchone() != None:
+        return None
+
+    insert_rows(con,'runs',[run])
+    run_id = con.execute('SELECT run_id FROM runs WHERE info_hash = ?',[run['info_hash']]).fetchone()[0]
+
+    insert_rows(con,'rounds',round_rows,run_id)
+    insert_rows(con,'images',image_rows,run_id)
+    insert_rows(con,'stages',stage_rows,run_id)
+    insert_rows(con,'step_timings',[{k:t.get(k) for k in timing_keys} for t in step_timings],run_id,ignore=True)
+
+    return run_id
+
+
+def add_run(dbfile,selfcal_information,infofile='',source='',step_timings=[]):
+    """
+    store the information and the step timings of a run
+    """
+    con = connect(dbfile)
+    with con:
+        run_id = add_run_con(con,selfcal_information,infofile,source,step_timings)
+    con.close()
+
+    return run_id
+
+
+def import_runtime_history_con(con,historyfile):
+    """
+    add the timings of a runtime history file
+    """
+    with open(historyfile) as fin:
+        history = json.load(fin)
+
+    return insert_rows(con,'step_timings',[{k:t.get(k) for k in timing_keys} for t in history],ignore=True)
+
+
+def import_files(dbfile,patterns):
+    """
+    bulk import of SELFCALINFO and runtime history files
+    (glob patterns), returns the number of new runs and timings
+    """
+    files = sorted(set([f for p in patterns for f in glob.glob(p,recursive=True)]))
+
+    nruns, ntimings, failed = 0, 0, []
+
+    con = connect(dbfile)
+    with con:
+        for f in files:
+            try:
+                if re.match(r'FINAL_IMAGE_.+_SELFCALINFO',os.path.basename(f)):
+                    with open(f) as fin:
+                        info = json.load(fin)
+                    if 'RUN' not in info:
+                        info['RUN'] = guess_run_info(f)
+                    if add_run_con(con,info,f) != None:
+                        nruns += 1
+                elif 'RUNTIME_HISTORY' in os.path.basename(f):
+                    ntimings += max(0,import_runtime_history_con(con,f))
+                else:
+                    failed.append([f,'neither a SELFCALINFO nor a runtime history file'])
+            except (OSError,ValueError,KeyError,TypeError,sqlite3.Error) as err:
+                failed.append([f,str(err)])
+    con.close()
+
+    return nruns, ntimings, failed
+
+
+def get_step_timings(dbfile,kind=None):
+    """
+    step timings (same records as the runtime history)
+    """
+    if not os.path.exists(dbfile):
+        return []
+
+    con = connect(dbfile)
+    sql = 'SELECT '+','.join(timing_keys)+' FROM step_timings'
+    if kind != None:
+        rows = con.execute(sql+' WHERE kind = ?',[kind]).fetchall()
+    else:
+        rows = con.execute(sql).fetchall()
+    con.close()
+
+    return [dict(r) for r in rows]
+
+
+def get_autotune_history(dbfile,hostname,chan_out):
+    """
+    wsclean timings of previous runs on a host with the used
+    -parallel-gridding (same number of output channels)
+    """
+    if not os.path.exists(dbfile):
+        return []
+
+    con  = connect(dbfile)
+    rows = con.execute('SELECT runs.parallel_gridding,'+','.join(['step_timings.'+k for k in timing_keys])+\
+                           ' FROM step_timings JOIN runs ON runs.run_id = step_timings.run_id'+\
+                           ' WHERE step_timings.kind = ? AND runs.hostname = ? AND step_timings.chan_out = ?'+\
+                           ' AND runs.parallel_gridding IS NOT NULL',['wsclean',hostname,chan_out]).fetchall()
+    con.close()
+
+    return [dict(r) for r in rows]
+
+
+def query(dbfile,sql,parameters=[]):
+    """
+    result of a SQL query (column names and rows)
+    the database is opened read-only
+    """
+    con  = sqlite3.connect('file:'+urllib.parse.quote(os.path.abspath(dbfile))+'?mode=ro',uri=True,timeout=60.)
+    cur  = con.execute(sql,parameters)
+    rows = [list(r) for r in cur.fetchall()]
+    cols = [d[0] for d in cur.description] if cur.description != None else []
+    con.close()
+
+    return cols, rows
+
+
+def print_rows(cols,rows,maxwidth=30):
+    """
+    print the result of a query as a table
+    """
+    def fmt(v):
+        if isinstance(v,float):
+            return '{:.6g}'.format(v)
+        return str(v)[:maxwidth] if v != None else ''
+
+    cells  = [[fmt(v) for v in r] for r in rows]
+    widths = [max([len(c)]+[len(r[i]) for r in cells]) for i,c in enumerate(cols)]
+
+    print('\n'+'  '.join([c.rjust(w) for c,w in zip(cols,widths)]))
+    for r in cells:
+        print('  '.join([v.rjust(w) for v,w in zip(r,widths)]))
+    print('\n',len(rows),' rows\n')
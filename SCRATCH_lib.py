@@ -0,0 +1,265 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Staging of the processing onto a node-local scratch disk
+# (NVMe or tmpfs)
+#
+# - the MS is copied (reflinked if possible) into a scratch working
+#   directory, the 2GC and Image-processing directories are linked
+#
+# - the copy is done under a temporary name and renamed when complete,
+#   a copy on the scratch disk is only reused if it is unchanged since
+#   the stage-in and the MS has not changed (sizes and mtimes)
+#
+# - the entire self-calibration loop runs on the scratch disk
+#   (wsclean -temp-dir and all intermediate images)
+#
+# - at the end only the caltables, the final images and the JSON
+#   information are synchronised back and verified via checksums
+#
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import hashlib
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+#
+# LIBS
+#
+
+global sync_patterns, scratch_ms_factor
+
+# products synchronised back to the working directory
+#
+sync_patterns = ['SC*_CALTAB_*','SC*_FLAGSTATS.*','FINAL_*_IMAGES*','FINAL_IMAGE_*_SELFCALINFO*.json','FINAL_IMAGE_*_TRACE*.json',\
+                     '2GC_RUNTIME_HISTORY.json','2GC_AUTOTUNE.json','casa-*.log']
+
+# the MS grows by MODEL_DATA and CORRECTED_DATA
+#
+scratch_ms_factor = 3
+
+sync_manifest = '2GC_SCRATCH_MANIFEST.json'
+
+stage_record  = '_STAGED.json'
+
+
+def scratch_workdir(MSFILE,scratchdir):
+    """
+    the working directory on the scratch disk
+    """
+    return os.path.join(scratchdir,'2GC_SCRATCH_'+os.path.basename(MSFILE.rstrip('/')))+'/'
+
+
+def check_scratch_space(scratchdir,ms_size_bytes,image_bytes=0,ms_on_scratch=False):
+    """
+    check the free space of the scratch disk
+    (a MS already on the scratch disk only grows)
+    returns an error message or an empty string
+    """
+    if not os.path.isdir(scratchdir):
+        return 'scratch directory does not exist '+scratchdir
+
+    if ms_on_scratch:
+        required = (scratch_ms_factor - 1) * ms_size_bytes + image_bytes
+    else:
+        required = scratch_ms_factor * ms_size_bytes + image_bytes
+    free     = shutil.disk_usage(scratchdir).free
+    if required > free:
+        return 'scratch directory '+scratchdir+' needs '+str(round(required/1024**3,1))+' GB but has '+str(round(free/1024**3,1))+' GB free'
+
+    return ''
+
+
+def copy_path(src,dst):
+    """
+    copy a file or directory, reflinked if the filesystem supports it
+    """
+    if shutil.which('cp') != None:
+        result = subprocess.run(['cp','-a','--reflink=auto',src,dst])
+        if result.returncode == 0:
+            return dst
+
+    if os.path.isdir(src):
+        shutil.copytree(src,dst,symlinks=True,dirs_exist_ok=True)
+    else:
+        shutil.copy2(src,dst)
+
+    return dst
+
+
+def path_signature(path):
+    """
+    number of files, total size and latest mtime [ns] of a file or
+    directory (the casacore lock files are changed by every reader)
+    """
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = [os.path.join(root,f) for root, dirs, fs in os.walk(path) for f in fs if f != 'table.lock']
+
+    nbytes, mtime = 0, 0
+    for f in files:
+        st     = os.stat(f)
+        nbytes += st.st_size
+        mtime  = max(mtime,st.st_mtime_ns)
+
+    return [len(files),nbytes,mtime]
+
+
+def staged_copy_valid(MSFILE,homedir,scratchdir):
+    """
+    True if the copy of the MS on the scratch disk can be reused
+    (the copy and the MS are unchanged since the stage-in)
+    """
+    staged_ms = scratch_workdir(MSFILE,scratchdir)+MSFILE.rstrip('/')
+    if not os.path.exists(staged_ms) or not os.path.exists(staged_ms+stage_record):
+        return False
+
+    try:
+        with open(staged_ms+stage_record) as fin:
+            record = json.load(fin)
+    except (OSError,ValueError):
+        return False
+
+    return record.get('source') == path_signature(homedir+MSFILE) and record.get('copy') == path_signature(staged_ms)
+
+
+def remove_path(path):
+    """
+    delete a file or directory
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path,ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def stage_in(MSFILE,homedir,scratchdir,ms_size_bytes,image_bytes=0):
+    """
+    copy the MS into the scratch working directory
+    returns the scratch working directory
+    """
+    workdir   = scratch_workdir(MSFILE,scratchdir)
+    staged_ms = workdir+MSFILE.rstrip('/')
+    reuse     = staged_copy_valid(MSFILE,homedir,scratchdir)
+
+    # a copy modified by a previous run or left by an
+    # interrupted stage-in is staged again
+    #
+    if not reuse:
+        for f in [staged_ms,staged_ms+stage_record,staged_ms+'.staging']:
+            remove_path(f)
+
+    error = check_scratch_space(scratchdir,ms_size_bytes,image_bytes,ms_on_scratch=reuse)
+    if len(error) > 0:
+        print(error)
+        sys.exit(-1)
+
+    os.makedirs(workdir,exist_ok=True)
+
+    t_start = time.time()
+
+    if reuse:
+        print('\n Reuse the unchanged copy ',staged_ms)
+    else:
+        copy_path(homedir+MSFILE.rstrip('/'),staged_ms+'.staging')
+        os.rename(staged_ms+'.staging',staged_ms)
+        record = {'source':path_signature(homedir+MSFILE),'copy':path_signature(staged_ms),'time':time.time()}
+        with open(staged_ms+stage_record+'.tmp','w') as fout:
+            json.dump(record,fout,indent=1)
+        os.replace(staged_ms+stage_record+'.tmp',staged_ms+stage_record)
+
+    # the cached MS information (mtimes are kept by the copy)
+    # and the information of previous runs
+    #
+    for f in glob.glob(homedir+MSFILE.rstrip('/')+'_MSINFO.json') + [homedir+'2GC_RUNTIME_HISTORY.json',homedir+'2GC_AUTOTUNE.json']:
+        if os.path.exists(f):
+            shutil.copy2(f,workdir)
+
+    # the software
+    #
+    for d in ['2GC','Image-processing']:
+        if os.path.exists(homedir+d) and not os.path.lexists(workdir+d):
+            os.symlink(os.path.abspath(homedir+d),workdir+d)
+
+    print('\n Staged ',homedir+MSFILE,' to ',workdir,' in ',round(time.time()-t_start,1),' s\n')
+
+    return workdir
+
+
+def file_checksum(filename,blocksize=16*1024**2):
+    """
+    sha256 of a file
+    """
+    sha = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(blocksize),b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def tree_checksums(path,nthreads=4):
+    """
+    checksums of all files of a file or directory
+    """
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted([os.path.join(root,f) for root, dirs, fs in os.walk(path) for f in fs])
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        checksums = list(pool.map(file_checksum,files))
+
+    return {os.path.relpath(f,os.path.dirname(path.rstrip('/'))):c for f,c in zip(files,checksums)}
+
+
+def stage_out(workdir,homedir,keep_scratch=False):
+    """
+    synchronise the products back and verify the checksums
+    returns the manifest of the synchronised files
+    """
+    t_start  = time.time()
+    manifest = {'scratch':workdir,'files':{},'mismatch':[]}
+
+    products = []
+    for p in sync_patterns:
+        products += sorted(glob.glob(workdir+p))
+
+    for src in products:
+        dst = homedir+os.path.basename(src.rstrip('/'))
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        copy_path(src,dst)
+
+        src_checksums = tree_checksums(src)
+        dst_checksums = tree_checksums(dst)
+        manifest['files'].update(src_checksums)
+        for f in src_checksums:
+            if dst_checksums.get(f) != src_checksums[f]:
+                manifest['mismatch'].append(f)
+
+    manifest['sync_s'] = time.time() - t_start
+
+    with open(homedir+sync_manifest,'w') as fout:
+        json.dump(manifest,fout,indent=1)
+
+    if len(manifest['mismatch']) > 0:
+        print('Checksum mismatch of the synchronised files ',manifest['mismatch'],' keep ',workdir)
+    else:
+        print('\n Synchronised ',len(manifest['files']),' files from ',workdir,' in ',round(manifest['sync_s'],1),' s\n')
+        if not keep_scratch:
+            shutil.rmtree(workdir,ignore_errors=True)
+
+    return manifest
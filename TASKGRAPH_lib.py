@@ -0,0 +1,258 @@
+#
+# Hans-Rainer Kloeckner
+#
+# MPIfR 2024
+# hrk@mpifr-bonn.mpg.de
+#
+# ======================
+#
+# Small dependency graph executor for the post-processing of images
+# (statistics, source finding, log parsing, moving the products)
+#
+# - a task starts as soon as all tasks it depends on are finished,
+#   independent tasks run concurrently in a thread pool (the tools
+#   run in child processes, the statistics release the GIL in NumPy)
+#
+# - arguments can refer to the results of other tasks (result_of),
+#   these tasks are added to the dependencies
+#
+# - the start and end of each task and the critical path (longest
+#   chain of dependent tasks) are recorded
+#
+#   graph = TASKGRAPH.new_graph('FINAL_POSTPROCESSING')
+#   TASKGRAPH.add_task(graph,'catalog',C2GC.cataloging_fits,final_image,homedir)
+#   TASKGRAPH.add_task(graph,'pybdsf_info',C2GC.get_info_from_pybdsflog,TASKGRAPH.result_of('catalog',2),...)
+#   results = TASKGRAPH.run_graph(graph)
+#
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import PROFILE_lib as PROF
+
+
+#
+# LIBS
+#
+
+global max_workers
+
+max_workers = 4
+
+
+class TaskResult:
+    """
+    reference to the result (or an item of it) of a task
+    """
+    def __init__(self,name,index=None):
+        self.name  = name
+        self.index = index
+
+
+def result_of(name,index=None):
+    """
+    argument of a task that is replaced by the result of the task name
+    """
+    return TaskResult(name,index)
+
+
+def new_graph(name):
+    """
+    an empty task graph
+    """
+    return {'name':name,'tasks':{},'order':[]}
+
+
+def add_task(graph,name,func,*args,deps=[],**kwargs):
+    """
+    add a task, it runs after the tasks in deps and the
+    tasks whose results are used as arguments
+    """
+    if name in graph['tasks']:
+        raise ValueError('task '+name+' already in the graph '+graph['name'])
+
+    refs = [a.name for a in list(args) + list(kwargs.values()) if isinstance(a,TaskResult)]
+
+    graph['tasks'][name] = {'func':func,'args':args,'kwargs':kwargs,'deps':sorted(set(list(deps) + refs))}
+    graph['order'].append(name)
+
+
+def check_graph(graph):
+    """
+    errors of the graph (unknown dependencies and cycles)
+    """
+    errors = []
+    tasks  = graph['tasks']
+
+    for name in graph['order']:
+        for d in tasks[name]['deps']:
+            if d not in tasks:
+                errors.append(graph['name']+' task '+name+' depends on the unknown task '+d)
+
+    # Kahn's algorithm, the remaining tasks are on a cycle
+    #
+    ndeps = {n:len([d for d in tasks[n]['deps'] if d in tasks]) for n in tasks}
+    ready = [n for n in graph['order'] if ndeps[n] == 0]
+    seen  = 0
+    while len(ready) > 0:
+        n = ready.pop()
+        seen += 1
+        for m in tasks:
+            if n in tasks[m]['deps']:
+                ndeps[m] -= 1
+                if ndeps[m] == 0:
+                    ready.append(m)
+
+    if seen < len(tasks):
+        errors.append(graph['name']+' tasks with cyclic dependencies: '+', '.join(sorted([n for n in tasks if ndeps[n] > 0])))
+
+    return errors
+
+
+def resolve(value,results):
+    """
+    replace a result reference by the result
+    """
+    if not isinstance(value,TaskResult):
+        return value
+
+    if value.index == None:
+        return results[value.name]
+
+    return results[value.name][value.index]
+
+
+def run_task(graph_name,name,task,results):
+    """
+    run a single task (traced), returns the result, start and end
+    """
+    args   = [resolve(a,results) for a in task['args']]
+    kwargs = {k:resolve(v,results) for k,v in task['kwargs'].items()}
+
+    t_start = time.time()
+    with PROF.trace_stage(graph_name+':'+name,'taskgraph'):
+        result = task['func'](*args,**kwargs)
+
+    return result, t_start, time.time()
+
+
+def run_graph(graph,nworkers=None):
+    """
+    run all tasks of the graph, returns the results of the tasks
+
+    if a task fails, the tasks depending on it are skipped and
+    the first exception is raised after the other tasks are done
+    """
+    errors = check_graph(graph)
+    if len(errors) > 0:
+        raise ValueError('; '.join(errors))
+
+    tasks   = graph['tasks']
+    results = {}
+    timing  = {}
+    failed  = {}
+    pending = list(graph['order'])
+    running = {}
+
+    nworkers = max_workers if nworkers == None else nworkers
+
+    t_start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1,nworkers)) as pool:
+        while len(pending) > 0 or len(running) > 0:
+
+            # skip the tasks of failed dependencies
+            #
+            for name in [n for n in pending if any([d in failed for d in tasks[n]['deps']])]:
+                failed[name] = None
+                pending.remove(name)
+
+            # start all tasks that are ready
+            #
+            for name in [n for n in pending if all([d in results for d in tasks[n]['deps']])]:
+                running[pool.submit(run_task,graph['name'],name,tasks[name],results)] = name
+                pending.remove(name)
+
+            if len(running) == 0:
+                break
+
+            done, _ = wait(list(running),return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name], t0, t1 = future.result()
+                    timing[name] = [t0,t1]
+                except Exception as err:
+                    failed[name] = err
+
+    graph['timing']  = timing
+    graph['wall_s']  = time.time() - t_start
+    graph['t_start'] = t_start
+
+    errors = [failed[n] for n in graph['order'] if n in failed and failed[n] != None]
+    if len(errors) > 0:
+        raise errors[0]
+
+    return results
+
+
+def critical_path(graph):
+    """
+    the longest chain of dependent tasks (by runtime)
+    returns the task names and the summed runtime [s]
+    """
+    tasks  = graph['tasks']
+    timing = graph.get('timing',{})
+    dur    = {n:timing[n][1] - timing[n][0] if n in timing else 0. for n in tasks}
+
+    # longest path to each task (memoized recursion over the
+    # dependencies)
+    #
+    length, previous = {}, {}
+
+    def path_length(n):
+        if n not in length:
+            best = None
+            for d in tasks[n]['deps']:
+                if best == None or path_length(d) > length[best]:
+                    best = d
+            previous[n] = best
+            length[n]   = dur[n] + (length[best] if best != None else 0.)
+        return length[n]
+
+    if len(tasks) == 0:
+        return [], 0.
+
+    last = max(graph['order'],key=path_length)
+    path = [last]
+    while previous[path[-1]] != None:
+        path.append(previous[path[-1]])
+
+    return path[::-1], length[last]
+
+
+def get_graph_summary(graph):
+    """
+    runtimes of the tasks, the wall time and the critical path
+    """
+    path, path_s = critical_path(graph)
+    t0 = graph.get('t_start',0.)
+
+    summary = {'wall_s':graph.get('wall_s',0.),'critical_path':path,'critical_path_s':path_s,'tasks':{}}
+    for n in graph['order']:
+        if n in graph.get('timing',{}):
+            summary['tasks'][n] = {'start_s':graph['timing'][n][0] - t0,'dur_s':graph['timing'][n][1] - graph['timing'][n][0],\
+                                       'deps':graph['tasks'][n]['deps']}
+    summary['serial_s'] = sum([t['dur_s'] for t in summary['tasks'].values()])
+
+    return summary
+
+
+def print_graph_summary(summary,name=''):
+    """
+    print the runtimes of the tasks and the critical path
+    """
+    print('\n === Task graph ',name,' wall ','{:.2f}'.format(summary['wall_s']),' s  serial ',\
+              '{:.2f}'.format(summary['serial_s']),' s ===')
+    for n,t in summary['tasks'].items():
+        print('   ',n.ljust(30),' start ','{:8.2f}'.format(t['start_s']),' s  runtime ','{:8.2f}'.format(t['dur_s']),' s')
+    print('    critical path ',' -> '.join(summary['critical_path']),' ','{:.2f}'.format(summary['critical_path_s']),' s\n')